@@ -0,0 +1,134 @@
+"""
+Replays a synthetic oplog backlog through Triggers, tailing entry by entry versus in catch-up mode.
+
+The backlog is generated lazily, so a million entries do not have to fit in memory. Reading the oplog
+costs `--read-ms` per cursor batch (a getMore round trip) and applying costs `--apply-us` per dispatched
+entry (the destination writes). Catch-up mode reads large batches ahead while applying, and skips
+entries superseded by a later delete of the same document.
+
+    python -m bench.catch_up --entries 1000000 --documents 10000
+"""
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import random
+import time
+
+import bson
+
+from mmm.catchup import CatchUpPolicy
+from mmm.triggers import Triggers
+
+NS = "bench.backlog"
+# ts of the first entry, far enough in the past for any lag threshold
+EPOCH = 1000000000
+TAILING_BATCH_SIZE = 101
+
+class SyntheticCursor(object):
+
+  def __init__(self, oplog, after):
+    self._oplog = oplog
+    self._after = after
+    self._batch_size = TAILING_BATCH_SIZE
+    # nothing is appended to the synthetic oplog, a cursor that ran dry is done
+    self.alive = True
+
+  def add_option(self, mask):
+    return self
+
+  def sort(self, *args, **kwargs):
+    return self
+
+  def batch_size(self, size):
+    self._batch_size = size
+    return self
+
+  def __iter__(self):
+    for i, entry in enumerate(self._oplog.entries(self._after)):
+      if i % self._batch_size == 0:
+        time.sleep(self._oplog.read_seconds)
+      yield entry
+    self.alive = False
+
+  def close(self):
+    self.alive = False
+
+class SyntheticOplog(object):
+  """
+  `count` entries over `documents` _ids: 20% inserts, 70% $set updates, 10% deletes
+  """
+
+  def __init__(self, count, documents, read_seconds):
+    self.count = count
+    self.documents = documents
+    self.read_seconds = read_seconds
+
+  def entries(self, after):
+    rng = random.Random(42)
+    first = after.time - EPOCH + 1 if after.time >= EPOCH else 0
+    for i in xrange(self.count):
+      op, _id = rng.choice("iuuuuuuuid"), rng.randrange(self.documents)
+      if i < first:
+        continue
+      entry = {"ts": bson.Timestamp(EPOCH + i, 0), "h": i, "v": 2, "op": op, "ns": NS}
+      if op == "u":
+        entry["o2"] = {"_id": _id}
+        entry["o"] = {"$set": {"n": i}}
+      else:
+        entry["o"] = {"_id": _id, "n": i} if op == "i" else {"_id": _id}
+      yield entry
+
+  def find(self, spec, **kwargs):
+    return SyntheticCursor(self, spec["ts"]["$gt"])
+
+  def find_one(self, **kwargs):
+    # the newest entry, as catch-up mode looks it up
+    return {"ts": bson.Timestamp(EPOCH + self.count - 1, 0)} if self.count else None
+
+class Destination(object):
+  """
+  Costs apply_seconds per entry, paid in one sleep per 1000 entries
+  """
+
+  def __init__(self, apply_seconds):
+    self.apply_seconds = apply_seconds
+    self.applied = 0
+
+  def __call__(self, **op_doc):
+    self.applied += 1
+    if self.applied % 1000 == 0:
+      time.sleep(1000 * self.apply_seconds)
+
+def replay(oplog, catch_up, apply_seconds):
+  triggers = Triggers("bench-source", "mongodb://unused")
+  triggers._oplog = oplog
+  triggers._checkpoint = type("Checkpoint", (object,), {"update": lambda self, *args, **kwargs: None})()
+  triggers.catch_up = catch_up
+  destination = Destination(apply_seconds)
+  triggers.register(NS, "iud", destination)
+  start = time.time()
+  checkpoint = bson.Timestamp(EPOCH - 1, 0)
+  while checkpoint.time < EPOCH + oplog.count - 1:
+    checkpoint = triggers._tail_oplog(checkpoint)
+  return time.time() - start, destination.applied, triggers._coalesced.value
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--entries", type=int, default=1000000, help="number of oplog entries in the backlog")
+  parser.add_argument("--documents", type=int, default=10000, help="number of distinct _ids")
+  parser.add_argument("--read-ms", type=float, default=1.0, help="milliseconds per cursor batch")
+  parser.add_argument("--apply-us", type=float, default=20.0, help="microseconds per applied entry")
+  parser.add_argument("--batch-size", type=int, default=5000, help="cursor batch size in catch-up mode")
+  parser.add_argument("--chunk-size", type=int, default=1000, help="entries per catch-up chunk")
+  args = parser.parse_args()
+
+  oplog = SyntheticOplog(args.entries, args.documents, args.read_ms / 1000.0)
+  print "%-9s %8s %10s %10s %10s" % ("mode", "secs", "entries/s", "applied", "skipped")
+  for name, catch_up in (("tailing", None),
+      ("catch-up", CatchUpPolicy(lag_seconds=0, batch_size=args.batch_size, chunk_size=args.chunk_size))):
+    elapsed, applied, skipped = replay(oplog, catch_up, args.apply_us / 1000000.0)
+    print "%-9s %8.2f %10d %10d %10d" % (name, elapsed, args.entries / elapsed, applied, skipped)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,48 @@
+"""
+Measures oplog apply throughput against the checkpoint interval.
+
+The checkpoint collection is an in-memory fake that sleeps for a configurable round trip on every
+write, so the numbers show how much of the apply loop is spent persisting the oplog position.
+
+    python -m bench.checkpoint_interval --ops 5000 --latency-ms 1
+"""
+import argparse
+import time
+
+import bson
+
+from mmm.checkpoint import CheckpointPolicy
+from mmm.testing import FakeCollection
+from mmm.triggers import Triggers
+
+def synthetic_oplog(count, ns="bench.things"):
+  return [{"ts": bson.Timestamp(1000000000 + i, 0), "h": i, "op": "i", "ns": ns,
+    "o": {"_id": i, "value": i}} for i in xrange(count)]
+
+def measure(oplog, checkpoint_ops, latency):
+  triggers = Triggers("bench-source", "mongodb://unused")
+  triggers._oplog = FakeCollection(oplog)
+  triggers._checkpoint = FakeCollection([{"_id": "bench-source"}], latency=latency)
+  triggers.checkpoint_policy = CheckpointPolicy(ops=checkpoint_ops, interval_ms=60 * 1000)
+  triggers.register("bench.things", "i", lambda **op: None)
+  start = time.time()
+  triggers._tail_oplog(bson.Timestamp(0, 0))
+  triggers.save_checkpoint()
+  elapsed = time.time() - start
+  return len(oplog) / elapsed, triggers._checkpoint.calls["update"]
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--ops", type=int, default=5000, help="number of oplog entries to apply")
+  parser.add_argument("--latency-ms", type=float, default=1.0, help="simulated checkpoint write round trip")
+  parser.add_argument("--intervals", default="1,10,100,1000", help="comma separated checkpoint op intervals")
+  args = parser.parse_args()
+
+  oplog = synthetic_oplog(args.ops)
+  print "%10s %12s %18s" % ("interval", "ops/sec", "checkpoint writes")
+  for interval in [int(i) for i in args.intervals.split(",")]:
+    ops_per_sec, writes = measure(oplog, interval, args.latency_ms / 1000.0)
+    print "%10d %12.0f %18d" % (interval, ops_per_sec, writes)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,44 @@
+"""
+Micro-benchmarks document hashing over small, wide and deeply nested documents.
+
+    python -m bench.hashing --repeat 2000
+"""
+import argparse
+import datetime
+import timeit
+
+import bson
+
+from mmm.hashing import HASH_ALGORITHMS, hash_document
+
+def small():
+  return {"_id": bson.ObjectId(), "name": u"widget", "count": 12, "price": 9.99,
+    "created": datetime.datetime(2013, 7, 2), "__mmm": {"source": "a"}}
+
+def wide(fields=1000):
+  document = dict(("field%04d" % i, i if i % 2 else u"value %d" % i) for i in xrange(fields))
+  document["_id"] = bson.ObjectId()
+  return document
+
+def deep(depth=50, fanout=3):
+  document = {"leaf": [1, 2.5, u"three"]}
+  for i in xrange(depth):
+    document = dict(("level%d_%d" % (i, j), document if j == 0 else j) for j in xrange(fanout))
+  document["_id"] = bson.ObjectId()
+  return document
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--repeat", type=int, default=2000, help="hashes per document and algorithm")
+  args = parser.parse_args()
+
+  documents = (("small", small()), ("wide", wide()), ("deep", deep()))
+  print "%-8s %-8s %14s" % ("document", "hash", "usec/hash")
+  for name, document in documents:
+    repeat = args.repeat if name == "small" else max(args.repeat / 20, 1)
+    for algorithm in HASH_ALGORITHMS:
+      seconds = timeit.timeit(lambda: hash_document(document, algorithm, "__mmm"), number=repeat)
+      print "%-8s %-8s %14.1f" % (name, algorithm, seconds / repeat * 1e6)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,111 @@
+"""
+Compares keyword dispatch of decoded oplog entries with OplogOp on large documents.
+
+For every entry: the time to classify it (namespace, operation and the _id it changes) as a dict
+versus as an OplogOp; the time to hand it to `--callbacks` callbacks as keyword arguments versus one
+shared OplogOp; and the memory and garbage collected objects taken by a backlog of entries held in a
+queue either way. Python 2 has no allocation tracer, so memory is
+the deep size of what the queue holds.
+
+    python -m bench.oplog_op --entries 2000 --doc-bytes 65536 --callbacks 3
+"""
+import argparse
+import gc
+import sys
+import timeit
+
+import bson
+
+from mmm.catchup import op_key
+from mmm.oplog import OplogOp, dispatch
+
+NS = "bench.large"
+
+def entry(i, doc_bytes):
+  fields = max(doc_bytes / 64, 1)
+  o = dict(("field%05d" % f, u"%-50d" % (i + f)) for f in xrange(fields))
+  if i % 2:
+    return {"ts": bson.Timestamp(1000000000, i), "h": i, "v": 2, "op": "u", "ns": NS, "o": {"$set": o},
+      "o2": {"_id": i}}
+  o["_id"] = i
+  return {"ts": bson.Timestamp(1000000000, i), "h": i, "v": 2, "op": "i", "ns": NS, "o": o}
+
+def deep_size(value, seen=None):
+  seen = seen if seen is not None else set()
+  if id(value) in seen:
+    return 0
+  seen.add(id(value))
+  size = sys.getsizeof(value)
+  if isinstance(value, dict):
+    size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in value.iteritems())
+  elif isinstance(value, (list, tuple)):
+    size += sum(deep_size(v, seen) for v in value)
+  elif isinstance(value, OplogOp):
+    size += sum(deep_size(getattr(value, slot), seen) for slot in OplogOp.__slots__)
+  return size
+
+class KeywordCallback(object):
+
+  def __call__(self, **op_doc):
+    return op_doc['ns']
+
+class OpCallback(object):
+
+  def apply_op(self, op):
+    return op.ns
+
+def held(build):
+  """
+  :return: (deep size, gc objects) of the backlog build() returns
+  """
+  gc.collect()
+  objects = len(gc.get_objects())
+  backlog = build()
+  gc.collect()
+  return deep_size(backlog), len(gc.get_objects()) - objects
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--entries", type=int, default=2000, help="oplog entries")
+  parser.add_argument("--doc-bytes", type=int, default=65536, help="approximate BSON size of a document")
+  parser.add_argument("--callbacks", type=int, default=3, help="callbacks registered for the namespace")
+  args = parser.parse_args()
+
+  raw = [bson.BSON.encode(entry(i, args.doc_bytes)) for i in xrange(args.entries)]
+  decoded = [bson.BSON(data).decode() for data in raw]
+  keyword_callbacks = [KeywordCallback() for _ in xrange(args.callbacks)]
+  op_callbacks = [OpCallback() for _ in xrange(args.callbacks)]
+
+  def classify_decoded():
+    for op_doc in decoded:
+      op_key(op_doc)
+
+  def classify_op():
+    for op_doc in decoded:
+      op_key(OplogOp.from_document(op_doc))
+
+  def keyword_dispatch():
+    for op_doc in decoded:
+      for callback in keyword_callbacks:
+        callback(**op_doc)
+
+  def op_dispatch():
+    for op_doc in decoded:
+      op = OplogOp.from_document(op_doc)
+      for callback in op_callbacks:
+        dispatch(callback, op)
+
+  print "%-24s %12s" % ("per entry", "usec")
+  for name, run in (("classify decoded", classify_decoded), ("classify OplogOp", classify_op),
+      ("dispatch keywords", keyword_dispatch), ("dispatch OplogOp", op_dispatch)):
+    print "%-24s %12.1f" % (name, timeit.timeit(run, number=1) / args.entries * 1e6)
+
+  print
+  print "%-24s %12s %12s" % ("backlog", "KB", "gc objects")
+  for name, build in (("decoded dicts", lambda: [bson.BSON(data).decode() for data in raw]),
+      ("OplogOp", lambda: [OplogOp.from_document(bson.BSON(data).decode()) for data in raw])):
+    size, objects = held(build)
+    print "%-24s %12d %12d" % (name, size / 1024, objects)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,136 @@
+"""
+Replays an oplog backlog through the real Triggers -> AggregateReplicator -> Replicator path.
+
+The source and destinations are in-memory servers from mmm.testing, each call to them sleeping for the
+configured latency. The backlog is either a SyntheticWorkload written to the source, or a recorded oplog:
+a BSON dump of local.oplog.rs, e.g. from `mongodump -d local -c oplog.rs`. Once the backlog is in place,
+the engine applies it until replication settles. The benchmark reports ops/s, p50/p99 apply latency per
+oplog entry, CPU time per op and memory. Python 2 has no allocation tracer, so allocations are reported as
+the garbage collected objects left behind and the growth of the peak resident set.
+
+    python -m bench.replay --ops 20000 --doc-bytes 1024 --namespaces 4 --latency-ms 0.1
+    python -m bench.replay --oplog dump/local/oplog.rs.bson --lanes 4
+"""
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import gc
+import resource
+import time
+
+import bson
+
+from mmm import metrics
+from mmm.replication import METADATA_INLINE, METADATA_MODES, ReplicationEngine
+from mmm.testing import SyntheticWorkload, FakeServer, fake_connections
+
+SOURCE = "mongodb://bench-source"
+
+class LatencyRecorder(object):
+  """
+  Stands in for the apply latency histogram of Triggers, keeping every observation
+  """
+
+  def __init__(self):
+    self.observations = []
+
+  def observe(self, seconds):
+    self.observations.append(seconds)
+
+  def quantile(self, q):
+    ordered = sorted(self.observations)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)] if ordered else 0
+
+def parse_mix(text):
+  """
+  :param text: e.g. "insert=25,set=45,replace=20,delete=10"
+  """
+  return dict((kind, float(share)) for kind, share in (item.split("=") for item in text.split(",")))
+
+def build(args):
+  servers = {SOURCE: FakeServer(args.source_latency_ms / 1000.0)}
+  destinations = []
+  for i in xrange(args.destinations):
+    uri = "mongodb://bench-destination-%s" % i
+    servers[uri] = FakeServer(args.latency_ms / 1000.0)
+    destinations.append({"id": "destination-%s" % i, "uri": uri, "batch_size": args.batch_size,
+      "namespaces": [{"source": ns, "dest": ns} for ns in args.namespace_names]})
+  options = {"metadata": args.metadata, "checkpoint": {"ops": 1000}}
+  if args.lanes > 1:
+    options["parallel_apply"] = {"lanes": args.lanes}
+  return servers, ReplicationEngine("bench-source", SOURCE, destinations, options, fake_connections(servers))
+
+def load(args, source):
+  """
+  Puts the backlog in the source oplog, without latency
+  :return: number of oplog entries
+  """
+  latency, source.latency = source.latency, 0
+  if args.oplog:
+    with open(args.oplog, "rb") as dump:
+      entries = bson.decode_all(dump.read())
+    source.oplog.extend(entry for entry in entries if entry.get("ns") in args.namespace_names)
+  else:
+    workload = SyntheticWorkload(args.namespace_names, args.documents, args.doc_bytes, parse_mix(args.mix))
+    workload.run(source, args.ops)
+  for collection in [source.oplog] + source._collections.values():
+    collection.latency = latency
+  return source.oplog.count()
+
+def replay(args):
+  servers, engine = build(args)
+  backlog = load(args, servers[SOURCE])
+  triggers = engine.triggers
+  triggers.connect()
+  latencies = triggers._apply_latency = LatencyRecorder()
+
+  gc.collect()
+  objects = len(gc.get_objects())
+  peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  cpu = sum(resource.getrusage(resource.RUSAGE_SELF)[:2])
+  start = time.time()
+  position = bson.Timestamp(0, 0)
+  while True:
+    # write-backs add to the oplog while it is applied, tail until they are applied too
+    applied = triggers._tail_oplog(position)
+    triggers.save_checkpoint()
+    if applied == position:
+      break
+    position = applied
+  elapsed = time.time() - start
+  cpu = sum(resource.getrusage(resource.RUSAGE_SELF)[:2]) - cpu
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_rss
+  gc.collect()
+  objects = len(gc.get_objects()) - objects
+
+  ops = len(latencies.observations)
+  engine.close()
+  metrics.registry.remove(source="bench-source")
+  return {"backlog": backlog, "ops": ops, "ops/s": ops / elapsed, "p50 ms": latencies.quantile(0.5) * 1000,
+    "p99 ms": latencies.quantile(0.99) * 1000, "cpu us/op": cpu / ops * 1000000, "objects/op": float(objects) / ops,
+    "rss KB": rss}
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--ops", type=int, default=20000, help="synthetic application writes")
+  parser.add_argument("--documents", type=int, default=1000, help="distinct _ids per namespace")
+  parser.add_argument("--doc-bytes", type=int, default=256, help="approximate BSON size of a document")
+  parser.add_argument("--namespaces", type=int, default=1, help="namespaces the writes are spread over")
+  parser.add_argument("--mix", default="insert=25,set=45,replace=20,delete=10", help="share of each kind of write")
+  parser.add_argument("--oplog", help="BSON dump of a recorded oplog, replayed instead of synthetic writes")
+  parser.add_argument("--destinations", type=int, default=1, help="destinations every namespace replicates to")
+  parser.add_argument("--latency-ms", type=float, default=0.0, help="round trip of every destination call")
+  parser.add_argument("--source-latency-ms", type=float, default=0.0, help="round trip of every source call")
+  parser.add_argument("--metadata", default=METADATA_INLINE, choices=METADATA_MODES)
+  parser.add_argument("--batch-size", type=int, default=1, help="destination writes per batch")
+  parser.add_argument("--lanes", type=int, default=1, help="parallel apply lanes")
+  args = parser.parse_args()
+  args.namespace_names = ["bench.things%s" % i for i in xrange(args.namespaces)]
+
+  result = replay(args)
+  for key in ("backlog", "ops", "ops/s", "p50 ms", "p99 ms", "cpu us/op", "objects/op", "rss KB"):
+    print "%-12s %12.3f" % (key, result[key])
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,42 @@
+"""
+Measures source write amplification of each metadata mode.
+
+Two in-memory masters replicate one namespace to each other. For every application write the
+benchmark counts the writes MMM makes to the source master (write-backs, sidecar records and the
+acknowledgements from the other master), the oplog entries both masters end up with, and the oplog
+entries MMM has to read back and classify.
+
+    python -m bench.write_amplification --writes 1000
+"""
+import argparse
+
+from mmm.replication import METADATA_MODES
+from mmm.testing import FakeMesh
+
+NS = "bench.things"
+
+def measure(mode, writes):
+  mesh = FakeMesh(["a", "b"], [NS], {"metadata": mode})
+  collection = mesh.collection("a", NS)
+  applied = 0
+  for i in xrange(writes):
+    if i % 2 == 0:
+      collection.insert({"_id": i, "value": i})
+    else:
+      collection.update({"_id": i - 1}, {"$set": {"value": i}})
+    applied += mesh.pump()
+  source_writes = collection.calls["update"] - writes / 2 + mesh.collection("a", "local.mmm_metadata").calls["update"]
+  oplog_entries = mesh.server("a").oplog.count() + mesh.server("b").oplog.count()
+  return float(source_writes) / writes, float(oplog_entries) / writes, float(applied) / writes
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--writes", type=int, default=1000, help="application writes on one master")
+  args = parser.parse_args()
+
+  print "%-12s %22s %20s %18s" % ("metadata", "mmm writes on source", "oplog entries/write", "ops read/write")
+  for mode in METADATA_MODES:
+    print "%-12s %22.2f %20.2f %18.2f" % ((mode,) + measure(mode, args.writes))
+
+if __name__ == '__main__':
+  main()
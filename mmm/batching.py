@@ -0,0 +1,215 @@
+from bson.son import SON
+from collections import namedtuple
+import logging
+from pymongo.errors import DuplicateKeyError, OperationFailure
+import time
+
+from mmm import rawbson
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024
+DEFAULT_BATCH_LINGER_MS = 50
+# maxWireVersion of MongoDB 2.6, the first release with the insert/update/delete write commands
+WRITE_COMMANDS_WIRE_VERSION = 2
+DUPLICATE_KEY_CODES = (11000, 11001)
+
+class WriteOp(namedtuple("WriteOp", "op query document upsert ts")):
+  """
+  A single destination write: op is "i", "u" or "d", query selects the document for updates and deletes,
+  document is the inserted document or the update, ts is the timestamp of the oplog entry it came from.
+  "c" is an update conditional on its query: when it matches nothing, or its upsert hits an existing
+  `_id`, the write lost a conflict and is dropped.
+  """
+  __slots__ = ()
+
+class BulkWriteError(OperationFailure):
+  """
+  Raised when a write in a batch fails. Writes before it were applied, the failed write and
+  everything after it are still buffered.
+  """
+
+  def __init__(self, write_op, error, code=None):
+    OperationFailure.__init__(self, "%s failed for %r: %s" % (write_op.op, write_op.query, error), code)
+    self.write_op = write_op
+
+def supports_write_commands(connection):
+  """
+  :param connection: pymongo connection to the destination
+  :return: True if the server accepts batched insert/update/delete commands
+  """
+  return connection.admin.command("ismaster").get("maxWireVersion", 0) >= WRITE_COMMANDS_WIRE_VERSION
+
+class BulkWriter(object):
+  """
+  Buffers the writes for one destination collection and applies them in order.
+
+  A batch is due once it holds `size` writes or `max_bytes` of documents; the owner is expected to
+  flush it no later than `linger_ms` after the first write was buffered. Documents are encoded once to be
+  counted, and write commands send those bytes. Consecutive writes of the same
+  kind are sent as one ordered write command, so the relative order of all writes, and in particular
+  of the writes to a single _id, is kept. Servers without write commands get one write per op.
+  Conditional writes that lost a conflict are counted in `conflicts`.
+  """
+
+  def __init__(self, size=DEFAULT_BATCH_SIZE, max_bytes=DEFAULT_BATCH_BYTES, linger_ms=DEFAULT_BATCH_LINGER_MS):
+    self.size = size
+    self.max_bytes = max_bytes
+    self.linger_ms = linger_ms
+    self._ops = []
+    # per buffered op: its encoded size, and the RawDocument holding the encoded document
+    self._sizes = []
+    self._encoded = []
+    self._bytes = 0
+    self.first_buffered_at = None
+    self.conflicts = 0
+
+  @classmethod
+  def from_config(cls, config):
+    """
+    :param config: a destination of the `replications` config, which may set batch_size, batch_bytes and batch_linger_ms
+    """
+    return cls(int(config.get("batch_size", DEFAULT_BATCH_SIZE)),
+        int(config.get("batch_bytes", DEFAULT_BATCH_BYTES)),
+        int(config.get("batch_linger_ms", DEFAULT_BATCH_LINGER_MS)))
+
+  def __len__(self):
+    return len(self._ops)
+
+  def add(self, write_op):
+    """
+    Buffers a write
+    :return: True if the batch is full and should be flushed now
+    """
+    if not self._ops:
+      self.first_buffered_at = time.time()
+    encoded = None
+    if self.size > 1:
+      # raw documents keep their bytes, the others are encoded once here
+      document = write_op.document
+      encoded = document if rawbson.is_raw(document) else rawbson.RawDocument.encode(document)
+    self._ops.append(write_op)
+    self._encoded.append(encoded)
+    self._sizes.append(len(encoded.raw) if encoded is not None else 0)
+    self._bytes += self._sizes[-1]
+    return len(self._ops) >= self.size or self._bytes >= self.max_bytes
+
+  def expired(self):
+    """
+    :return: True if the oldest buffered write has waited at least linger_ms
+    """
+    return bool(self._ops) and (time.time() - self.first_buffered_at) * 1000 >= self.linger_ms
+
+  def oldest_pending(self):
+    """
+    :return: oplog timestamp of the oldest buffered write, or None
+    """
+    return self._ops[0].ts if self._ops else None
+
+  def drop(self, write_op):
+    """
+    Drops a write that failed and would fail the same way again, it must be the oldest buffered one
+    :return: True if it was dropped
+    """
+    if not self._ops or self._ops[0] is not write_op:
+      return False
+    self._acknowledge(1)
+    return True
+
+  def write(self, collection, write_commands=False):
+    """
+    Applies the buffered writes in order, dropping each run from the buffer once it is acknowledged
+    :param collection: destination pymongo collection
+    :param write_commands: True if the destination supports batched write commands
+    :raise BulkWriteError: if a write fails, with the failed write attached
+    """
+    while self._ops:
+      run = self._next_run()
+      if write_commands and len(run) > 1:
+        applied, error = self._write_command(collection, run, self._encoded[:len(run)])
+      else:
+        applied, error = self._write_legacy(collection, run)
+      self._acknowledge(applied)
+      if error:
+        raise error
+    self._bytes = 0
+    self.first_buffered_at = None
+
+  def _next_run(self):
+    run = [self._ops[0]]
+    for write_op in self._ops[1:]:
+      if write_op.op != run[0].op:
+        break
+      run.append(write_op)
+    return run
+
+  def _acknowledge(self, count):
+    del self._ops[:count]
+    del self._encoded[:count]
+    del self._sizes[:count]
+    self._bytes = sum(self._sizes)
+
+  def _write_legacy(self, collection, run):
+    # pymongo.Connection doesn't wait for acknowledgement unless asked, errors would then go unnoticed
+    for i, write_op in enumerate(run):
+      try:
+        raw = rawbson.is_raw(write_op.document)
+        if write_op.op == 'i':
+          if raw:
+            rawbson.insert(collection, [write_op.document], w=1)
+          else:
+            collection.insert(write_op.document, w=1)
+        elif write_op.op == 'u':
+          self._update(collection, write_op, raw)
+        elif write_op.op == 'd':
+          collection.remove(write_op.query, w=1)
+        elif write_op.op == 'c':
+          result = self._update(collection, write_op, raw)
+          if isinstance(result, dict) and not result.get("n"):
+            self.conflicts += 1
+      except DuplicateKeyError as e:
+        if write_op.op != 'c':
+          return i, BulkWriteError(write_op, e, e.code)
+        self.conflicts += 1
+      except OperationFailure as e:
+        return i, BulkWriteError(write_op, e, e.code)
+    return len(run), None
+
+  @staticmethod
+  def _update(collection, write_op, raw):
+    if raw:
+      return rawbson.update(collection, write_op.query, write_op.document, write_op.upsert, w=1)
+    return collection.update(write_op.query, write_op.document, write_op.upsert, w=1)
+
+  def _write_command(self, collection, run, encoded):
+    """
+    :param encoded: the RawDocument of each write's document, None where it was not encoded
+    """
+    kind = run[0].op
+    documents = [e if e is not None else w.document for w, e in zip(run, encoded)]
+    if kind == 'i':
+      command = SON([("insert", collection.name), ("documents", documents)])
+    elif kind in ('u', 'c'):
+      command = SON([("update", collection.name),
+        ("updates", [{"q": w.query, "u": d, "upsert": bool(w.upsert)} for w, d in zip(run, documents)])])
+    else:
+      command = SON([("delete", collection.name), ("deletes", [{"q": w.query, "limit": 0} for w in run])])
+    command["ordered"] = True
+    if kind != 'd' and any(rawbson.is_raw(d) for d in documents):
+      result = rawbson.command(collection.database, command)
+    else:
+      result = collection.database.command(command)
+    write_errors = result.get("writeErrors")
+    if not write_errors:
+      if kind == 'c':
+        self.conflicts += len(run) - result.get("n", len(run))
+      return len(run), None
+    error = write_errors[0]
+    index = error["index"]
+    if kind == 'c' and error.get("code") in DUPLICATE_KEY_CODES:
+      # the writes up to the failed one were applied or lost their conflicts, the rest are sent again
+      self.conflicts += index - result.get("n", index) + 1
+      return index + 1, None
+    log.debug("batched %s failed at %s of %s: %s", kind, index, len(run), error.get("errmsg"))
+    return index, BulkWriteError(run[index], error.get("errmsg"), error.get("code"))
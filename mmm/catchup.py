@@ -0,0 +1,122 @@
+"""
+Catch-up mode: how Triggers reads the oplog while it is far behind.
+
+Instead of applying entries one by one as the cursor yields them, a reader greenlet fetches large
+cursor batches and cuts them into chunks while the previous chunk is being applied, so waiting on the
+source overlaps with waiting on destinations. Within a chunk, operations on a document that is
+deleted later in the same chunk are skipped: the delete alone leaves every destination in the same state.
+That only holds for namespaces whose destinations all get the deletes, not with `operations: 'iu'`.
+Other operations are never merged here, as loop detection depends on seeing each update.
+"""
+import time
+
+DEFAULT_CATCH_UP_LAG_SECONDS = 60
+DEFAULT_CATCH_UP_BATCH_SIZE = 5000
+DEFAULT_CATCH_UP_CHUNK_SIZE = 1000
+# chunks read ahead of the one being applied
+DEFAULT_CATCH_UP_READ_AHEAD = 4
+# seconds between two lookups of the newest oplog entry while tailing
+DEFAULT_CATCH_UP_CHECK_INTERVAL = 1
+
+def op_key(op_doc):
+  """
+  :return: (namespace, _id) of the document an oplog entry changes, None if it cannot be told
+  """
+  document = op_doc.get('o2') if op_doc['op'] == 'u' else op_doc.get('o')
+  if not isinstance(document, dict) or '_id' not in document:
+    return None
+  _id = document['_id']
+  try:
+    hash(_id)
+  except TypeError:
+    return None
+  return op_doc['ns'], _id
+
+def superseded(chunk, deletes_replicated=None):
+  """
+  :param chunk: list of (oplog entry, op_key) in oplog order
+  :param deletes_replicated: optional function of a namespace, True if every destination that gets its
+  inserts and updates gets its deletes too; by default they all do
+  :return: set of the indexes of entries followed by a delete of the same document within the chunk
+  """
+  deleted = set()
+  redundant = set()
+  replicated = {}
+  for i in xrange(len(chunk) - 1, -1, -1):
+    op_doc, key = chunk[i]
+    if key is None:
+      continue
+    if op_doc['op'] == 'd':
+      namespace = key[0]
+      if namespace not in replicated:
+        replicated[namespace] = deletes_replicated is None or deletes_replicated(namespace)
+      if replicated[namespace]:
+        deleted.add(key)
+    elif key in deleted:
+      redundant.add(i)
+  return redundant
+
+class CatchUpPolicy(object):
+  """
+  Switches Triggers to catch-up mode while the last applied entry is more than `lag_seconds` older than
+  the newest entry in the oplog, and back to tailing entry by entry once it is within `lag_seconds` / 2.
+  An idle source is never behind, however old its newest entry is.
+  """
+
+  def __init__(self, lag_seconds=DEFAULT_CATCH_UP_LAG_SECONDS, batch_size=DEFAULT_CATCH_UP_BATCH_SIZE,
+      chunk_size=DEFAULT_CATCH_UP_CHUNK_SIZE, read_ahead=DEFAULT_CATCH_UP_READ_AHEAD,
+      check_interval=DEFAULT_CATCH_UP_CHECK_INTERVAL, clock=time.time):
+    if chunk_size < 1 or read_ahead < 1:
+      raise ValueError("catch_up chunk_size and read_ahead must be at least 1")
+    self.lag_seconds = lag_seconds
+    self.batch_size = batch_size
+    self.chunk_size = chunk_size
+    self.read_ahead = read_ahead
+    self.check_interval = check_interval
+    self._clock = clock
+    self._checked_at = clock()
+
+  @classmethod
+  def from_config(cls, config):
+    """
+    :param config: the optional `catch_up` section of the master config, e.g. {"lag_seconds": 30}
+    :return: a CatchUpPolicy, or None if catch-up mode is not configured
+    """
+    if not config:
+      return None
+    return cls(float(config.get("lag_seconds", DEFAULT_CATCH_UP_LAG_SECONDS)),
+        int(config.get("batch_size", DEFAULT_CATCH_UP_BATCH_SIZE)),
+        int(config.get("chunk_size", DEFAULT_CATCH_UP_CHUNK_SIZE)),
+        int(config.get("read_ahead", DEFAULT_CATCH_UP_READ_AHEAD)),
+        float(config.get("check_interval", DEFAULT_CATCH_UP_CHECK_INTERVAL)))
+
+  def lag(self, ts, newest):
+    """
+    :param newest: timestamp of the newest oplog entry, None if the oplog is empty
+    :return: seconds between the oplog timestamps ts and newest
+    """
+    if newest is None:
+      return 0
+    return max(newest.time - ts.time, 0)
+
+  def due(self):
+    """
+    :return: True if the newest oplog entry should be looked up again while tailing
+    """
+    now = self._clock()
+    if now - self._checked_at < self.check_interval:
+      return False
+    self._checked_at = now
+    return True
+
+  def behind(self, ts, newest):
+    """
+    :return: True if catch-up mode should start at ts
+    """
+    return ts is not None and self.lag(ts, newest) > self.lag_seconds
+
+  def caught_up(self, ts, newest):
+    """
+    :return: True if catch-up mode should end at ts
+    """
+    return self.lag(ts, newest) <= self.lag_seconds / 2.0
@@ -0,0 +1,135 @@
+import bson
+from bson.son import SON
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHECKPOINT_OPS = 1000
+DEFAULT_CHECKPOINT_INTERVAL_MS = 1000
+# where the engine checkpoint and destination positions are kept, unless `checkpoint.namespace` says otherwise
+DEFAULT_CHECKPOINT_NAMESPACE = "local.mmm"
+MAX_TIMESTAMP_INC = 2 ** 32 - 1
+
+def timestamp_key(ts):
+  """
+  :param ts: a bson.Timestamp, which does not define an ordering in older pymongo releases
+  :return: a key that orders oplog timestamps
+  """
+  return (ts.time, ts.inc)
+
+def previous_timestamp(ts):
+  """
+  :param ts: a bson.Timestamp
+  :return: the greatest timestamp before ts, so that resuming with {"ts": {"$gt": previous}} re-reads ts
+  """
+  if ts.inc > 0:
+    return bson.Timestamp(ts.time, ts.inc - 1)
+  return bson.Timestamp(ts.time - 1, MAX_TIMESTAMP_INC)
+
+def earliest(*timestamps):
+  """
+  :return: the earliest of the given timestamps, ignoring None
+  """
+  timestamps = [ts for ts in timestamps if ts is not None]
+  return min(timestamps, key=timestamp_key) if timestamps else None
+
+def latest(*timestamps):
+  """
+  :return: the latest of the given timestamps, ignoring None
+  """
+  timestamps = [ts for ts in timestamps if ts is not None]
+  return max(timestamps, key=timestamp_key) if timestamps else None
+
+class CheckpointStore(object):
+  """
+  Oplog positions of individual destinations, kept in local.mmm next to the engine checkpoint.
+
+  Each position is keyed by (source, destination, namespace) and is the timestamp up to which that
+  destination has acknowledged every op for the namespace. The engine checkpoint is never ahead of
+  any of them, so the oplog is read once from the minimum and each destination skips what it already has.
+  """
+
+  def __init__(self, collection, source_id):
+    self._collection = collection
+    self.source_id = source_id
+
+  def _id(self, destination_id, namespace):
+    return SON([("source", self.source_id), ("destination", destination_id), ("ns", namespace)])
+
+  def load(self, destination_id, namespace):
+    """
+    :return: the persisted position of the destination namespace, or None if it has none yet
+    """
+    document = self._collection.find_one({"_id": self._id(destination_id, namespace)}) or {}
+    return document.get("checkpoint")
+
+  def save(self, destination_id, namespace, ts):
+    self._collection.update({"_id": self._id(destination_id, namespace)}, {"$set": {"checkpoint": ts}}, upsert=True)
+
+  def replay_until(self, destination_id, namespace):
+    """
+    :return: end of the oplog window replayed over an initial sync of the destination namespace, or None
+    """
+    document = self._collection.find_one({"_id": self._id(destination_id, namespace)}) or {}
+    return document.get("replay_until")
+
+  def save_replay_until(self, destination_id, namespace, ts):
+    self._collection.update({"_id": self._id(destination_id, namespace)}, {"$set": {"replay_until": ts}}, upsert=True)
+
+class CheckpointPolicy(object):
+  """
+  Decides when the oplog position reached by Triggers is persisted.
+
+  A checkpoint is written once `ops` operations have been applied since the last write, or once
+  `interval_ms` milliseconds have passed, whichever comes first. Triggers also forces a write when
+  it stops and after it reconnects.
+
+  Safety: the persisted position only ever trails operations that were fully applied, so after a
+  crash MMM replays at most one window (`ops` operations or `interval_ms` of traffic) and never
+  skips an operation. Setting `ops` to 1 restores the write-per-operation behaviour.
+  """
+
+  def __init__(self, ops=DEFAULT_CHECKPOINT_OPS, interval_ms=DEFAULT_CHECKPOINT_INTERVAL_MS, clock=time.time):
+    if ops < 1:
+      raise ValueError("checkpoint ops must be at least 1, got %r" % ops)
+    if interval_ms < 0:
+      raise ValueError("checkpoint interval_ms must not be negative, got %r" % interval_ms)
+    self.ops = ops
+    self.interval_ms = interval_ms
+    self._clock = clock
+    self.pending = 0
+    self._last_flush = clock()
+
+  @classmethod
+  def from_config(cls, config):
+    """
+    :param config: the optional `checkpoint` section of the master config, e.g. {"ops": 500, "interval_ms": 250}
+    :return: a CheckpointPolicy, using defaults for missing settings
+    """
+    config = config or {}
+    return cls(int(config.get("ops", DEFAULT_CHECKPOINT_OPS)),
+        int(config.get("interval_ms", DEFAULT_CHECKPOINT_INTERVAL_MS)))
+
+  def applied(self):
+    """
+    Records that one more operation has been applied since the last flush
+    :return: True if the checkpoint should be persisted now
+    """
+    self.pending += 1
+    return self.due()
+
+  def due(self):
+    """
+    :return: True if there are unpersisted operations and either window has been exceeded
+    """
+    if not self.pending:
+      return False
+    return self.pending >= self.ops or (self._clock() - self._last_flush) * 1000 >= self.interval_ms
+
+  def flushed(self):
+    """
+    Records that the checkpoint was persisted
+    """
+    self.pending = 0
+    self._last_flush = self._clock()
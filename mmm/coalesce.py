@@ -0,0 +1,223 @@
+"""
+Coalescing window: merges consecutive updates of a hot document before they are replicated.
+
+Oplog entries of a namespace are held for at most `window_ms`. An application update of a document whose
+latest held entry is also an application update is merged into it, and the merged update takes the place
+of the last one in oplog order. Only the merged update is hashed, written back and sent to the destinations.
+A replacement supersedes what it follows. $set, $unset and $inc updates are merged field by field, as long
+as no field of one is a parent or child path of a field of the other.
+
+Inserts, deletes, other modifiers and every entry carrying MMM metadata are held unmerged, so that the
+order of all writes to a document is kept and loop detection sees every replicated write.
+"""
+from collections import OrderedDict
+import gevent
+import itertools
+try:
+  from gevent.lock import Semaphore
+except ImportError: # gevent < 1.0
+  from gevent.coros import Semaphore
+import logging
+
+from mmm import metrics
+from mmm.catchup import op_key
+from mmm.checkpoint import earliest, previous_timestamp
+from mmm.oplog import OplogOp, dispatch
+
+log = logging.getLogger(__name__)
+
+DEFAULT_COALESCE_WINDOW_MS = 50
+DEFAULT_COALESCE_MAX_OPS = 1000
+MERGED_OPERATORS = ("$set", "$unset", "$inc")
+
+def _overlaps(field, other):
+  return field == other or field.startswith(other + ".") or other.startswith(field + ".")
+
+def _is_integer(value):
+  return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+def _is_number(value):
+  return _is_integer(value) or isinstance(value, float)
+
+def merge_updates(previous, update):
+  """
+  :param previous: an update document
+  :param update: an update document applied right after previous
+  :return: one update document with the effect of both, None if they cannot be merged
+  """
+  if not any(k.startswith('$') for k in update):
+    return update
+  if not any(k.startswith('$') for k in previous):
+    return None
+  if any(operator not in MERGED_OPERATORS for operator in list(previous) + list(update)):
+    return None
+  merged = dict((operator, dict(fields)) for operator, fields in previous.iteritems())
+  for operator, fields in update.iteritems():
+    for field, value in fields.iteritems():
+      if any(_overlaps(field, other) and field != other for other_fields in merged.values() for other in other_fields):
+        return None
+      if operator != "$inc":
+        for other_fields in merged.values():
+          other_fields.pop(field, None)
+        merged.setdefault(operator, {})[field] = value
+      elif field in merged.get("$inc", {}):
+        # integer increments add up exactly, floating point ones might not
+        if not (_is_integer(value) and _is_integer(merged["$inc"][field])):
+          return None
+        merged["$inc"][field] += value
+      elif field in merged.get("$set", {}):
+        if not (_is_number(value) and _is_number(merged["$set"][field])):
+          return None
+        merged["$set"][field] += value
+      elif field in merged.get("$unset", {}):
+        # incrementing a missing field sets it
+        del merged["$unset"][field]
+        merged.setdefault("$set", {})[field] = value
+      else:
+        merged.setdefault("$inc", {})[field] = value
+  return dict((operator, fields) for operator, fields in merged.iteritems() if fields)
+
+class CoalescingWindow(object):
+  """
+  Holds the oplog entries of one namespace for up to window_ms before handing them to a callback (its
+  AggregateReplicator), merging consecutive updates of a document in the meantime, see the module
+  documentation. Every merged update saves a write-back to the source and a write to each destination,
+  they are counted in `updates_coalesced`.
+
+  The window is flushed once its oldest entry was held window_ms, once it holds max_ops entries, and
+  whenever Triggers flushes its callbacks. oldest_pending() keeps the checkpoint before held entries.
+  """
+
+  def __init__(self, callback, source_id, namespace, metadata_field, window_ms=DEFAULT_COALESCE_WINDOW_MS,
+      max_ops=DEFAULT_COALESCE_MAX_OPS):
+    """
+    :param metadata_field: name of the MMM metadata field, updates touching it are never merged
+    """
+    self.callback = callback
+    self.metadata_field = metadata_field
+    self.window_ms = window_ms
+    self.max_ops = max_ops
+    # sequence number to (timestamp of the first entry merged into it, entry), in the order they are handed over
+    self._held = OrderedDict()
+    self._sequence = itertools.count()
+    # (ns, _id) to the sequence number of the held update of that document, while it is open to merging
+    self._open = {}
+    # timestamp of the first entry a failed flush did not replicate, until Triggers replays it
+    self._failed = None
+    self._error = None
+    self._timer = None
+    self._flush_lock = Semaphore()
+    self._coalesced = metrics.registry.counter("updates_coalesced", source=source_id, ns=namespace)
+
+  @classmethod
+  def from_config(cls, callback, source_id, namespace, metadata_field, config):
+    """
+    :param config: the namespace's entry of the `coalesce` master config, e.g. {"window_ms": 20}
+    """
+    return cls(callback, source_id, namespace, metadata_field, int(config.get("window_ms", DEFAULT_COALESCE_WINDOW_MS)),
+      int(config.get("max_ops", DEFAULT_COALESCE_MAX_OPS)))
+
+  def __call__(self, **op_doc):
+    return self.replicate(**op_doc)
+
+  def replicate(self, **op_doc):
+    return self.apply_op(OplogOp.from_document(op_doc))
+
+  def apply_op(self, op):
+    """
+    :param op: OplogOp, held as is until the window is flushed
+    """
+    self._raise_error()
+    self._failed = None
+    key = op_key(op)
+    held = self._open.pop(key, None) if key is not None else None
+    merged = self._merge(self._held[held][1], op) if held is not None else None
+    sequence = next(self._sequence)
+    if merged is not None:
+      # the merged update takes the place of the last one, after everything held before it
+      self._coalesced.inc()
+      self._held[sequence] = (self._held.pop(held)[0], merged)
+      self._open[key] = sequence
+    else:
+      # a held update that could not be merged keeps its place, closed to merging
+      self._held[sequence] = (op.ts, op)
+      if op.op == 'u' and key is not None and self._mergeable(op.o):
+        self._open[key] = sequence
+    if self._timer is None:
+      self._timer = gevent.spawn_later(self.window_ms / 1000.0, self._flush_expired)
+    if len(self._held) >= self.max_ops:
+      self._emit()
+
+  def _mergeable(self, o):
+    fields = o.keys() if not any(k.startswith('$') for k in o) else [f for fields in o.values() for f in fields]
+    return not any(field.startswith(self.metadata_field) for field in fields)
+
+  def _merge(self, held, op):
+    if op.op != 'u' or not self._mergeable(op.o):
+      return None
+    o = merge_updates(held.o, op.o)
+    if o is None:
+      return None
+    return op.replace(o=o)
+
+  def _flush_expired(self):
+    self._timer = None
+    try:
+      self._emit()
+    except Exception as e:
+      log.error("Replicating coalesced writes failed", exc_info=1)
+      self._error = e
+
+  def _emit(self):
+    with self._flush_lock:
+      held, self._held = self._held.values(), OrderedDict()
+      self._open = {}
+      if self._timer is not None:
+        self._timer.kill()
+        self._timer = None
+      for i, (_, op) in enumerate(held):
+        try:
+          dispatch(self.callback, op)
+        except Exception:
+          # Triggers replays the rest from its checkpoint, which has to stay before all of it
+          self._failed = earliest(*[first for first, _ in held[i:]])
+          raise
+
+  def _raise_error(self):
+    error, self._error = self._error, None
+    if error is not None:
+      raise error
+
+  def flush(self):
+    """
+    Replicates every held entry, then flushes the callback
+    """
+    self._raise_error()
+    self._emit()
+    if hasattr(self.callback, "flush"):
+      self.callback.flush()
+
+  def replicates_deletes(self, namespace):
+    return not hasattr(self.callback, "replicates_deletes") or self.callback.replicates_deletes(namespace)
+
+  def oldest_pending(self):
+    """
+    :return: oplog timestamp of the oldest entry held or not replicated, or of the oldest the callback
+    has not finished with
+    """
+    pending = self.callback.oldest_pending() if hasattr(self.callback, "oldest_pending") else None
+    return earliest(self._failed, pending, *[first for first, _ in self._held.itervalues()])
+
+  def save_positions(self, last_applied):
+    """
+    Persists how far the destinations got, which is no further than the oldest held entry
+    """
+    pending = self.oldest_pending()
+    if hasattr(self.callback, "save_positions"):
+      self.callback.save_positions(earliest(previous_timestamp(pending), last_applied) if pending is not None
+        else last_applied)
+
+  def close(self):
+    if self._timer is not None:
+      self._timer.kill()
+      self._timer = None
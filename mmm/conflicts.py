@@ -0,0 +1,80 @@
+"""
+Conflict policies: which of two writes of the same document by different masters is kept.
+
+A policy maps the MMM metadata of a replicated write (`source` and `source_ts`) to the condition the
+document it overwrites must meet for the write to apply. The condition is added to the query of the
+destination write, so the destination decides atomically and nothing is read first. A write whose
+condition fails is dropped and counted as a conflict: an update matches nothing, and an insert, sent as an
+upsert, fails on its duplicate `_id`. Source writes of inline metadata are conditional too, so a local
+write that lost to a replicated write applied before its metadata was written back doesn't overwrite it.
+
+Writes of the same master always apply, they arrive in the order they were made. Documents without
+metadata accept any write, so policies need `metadata: 'inline'` to see local writes.
+
+A custom policy is any callable taking the metadata and returning a query condition, or None to apply the
+write unconditionally.
+"""
+import importlib
+
+from mmm.metadata import MMM_METADATA, MMM_TIMESTAMP
+
+POLICY_LAST_WRITER_WINS = "lww"
+POLICY_FIRST_WRITER_WINS = "fww"
+# writes of different masters this close together are concurrent for first-writer-wins
+DEFAULT_CONFLICT_WINDOW_MS = 1000
+
+SOURCE = "%s.source" % MMM_METADATA
+TIMESTAMP = "%s.%s" % (MMM_METADATA, MMM_TIMESTAMP)
+
+def _writer_wins(metadata, window_ms):
+  source, timestamp = metadata["source"], metadata[MMM_TIMESTAMP]
+  conditions = [
+    {SOURCE: source},
+    {TIMESTAMP: {"$exists": False}},
+    # written long enough before to have been seen by this write's master
+    {TIMESTAMP: {"$lt": timestamp - window_ms}},
+    # a tie goes to the higher source id
+    {TIMESTAMP: timestamp, SOURCE: {"$lte": source}},
+  ]
+  if window_ms:
+    # concurrent, but written after this write
+    conditions.append({TIMESTAMP: {"$gt": timestamp, "$lt": timestamp + window_ms}})
+  return {"$or": conditions}
+
+def last_writer_wins(metadata):
+  """
+  Keeps the write with the later `source_ts`, and the one from the higher source id on a tie
+  """
+  return _writer_wins(metadata, 0)
+
+class FirstWriterWins(object):
+  """
+  Keeps the earlier of two writes less than window_ms apart, writes further apart are sequential and the
+  later one is kept
+  """
+
+  def __init__(self, window_ms=DEFAULT_CONFLICT_WINDOW_MS):
+    self.window_ms = window_ms
+
+  def __call__(self, metadata):
+    return _writer_wins(metadata, self.window_ms)
+
+def policy_from_config(config):
+  """
+  :param config: the optional `conflicts` section of the master config
+  :return: the conflict policy, or None if writes apply in the order they arrive
+  """
+  if not config:
+    return None
+  policy = config.get("policy", POLICY_LAST_WRITER_WINS)
+  if callable(policy):
+    return policy
+  if policy == POLICY_LAST_WRITER_WINS:
+    return last_writer_wins
+  if policy == POLICY_FIRST_WRITER_WINS:
+    return FirstWriterWins(int(config.get("window_ms", DEFAULT_CONFLICT_WINDOW_MS)))
+  module, _, name = policy.rpartition(".")
+  if not module:
+    raise ValueError("unknown conflict policy %r, expected %r, %r or a module.function" % (policy,
+      POLICY_LAST_WRITER_WINS, POLICY_FIRST_WRITER_WINS))
+  return getattr(importlib.import_module(module), name)
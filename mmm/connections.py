@@ -0,0 +1,81 @@
+try:
+  from gevent.lock import Semaphore
+except ImportError: # gevent < 1.0
+  from gevent.coros import Semaphore
+import logging
+from pymongo import Connection
+
+log = logging.getLogger(__name__)
+
+class ConnectionManager(object):
+  """
+  Shares one pymongo connection, and so one socket pool, per URI and connection options between
+  every Triggers, AggregateReplicator and Replicator talking to that server.
+
+  Connections are created lazily: the first connect() for a URI creates it without opening a socket,
+  pymongo connects on first use. Each connection has a generation that callers remember. A caller
+  that saw a connection fail asks connect() again with the generation it was using: the first caller
+  for a failure disconnects the pool and checks the server is reachable again, every other caller
+  finds the generation already bumped and simply gets the recovered connection back.
+  """
+
+  def __init__(self, factory=None):
+    """
+    :param factory: callable creating a connection from a URI and options, pymongo.Connection by default
+    """
+    self._factory = factory
+    self._connections = {}
+    self._generations = {}
+    self._locks = {}
+
+  @staticmethod
+  def _key(uri, args, kwargs):
+    return (uri, args, tuple(sorted(kwargs.items())))
+
+  def _create(self, uri, args, kwargs):
+    if self._factory is not None:
+      return self._factory(uri, *args, **kwargs)
+    return Connection(uri, *args, _connect=False, **kwargs)
+
+  def connect(self, uri, generation=None, *args, **kwargs):
+    """
+    :param uri: mongo URI of the server
+    :param generation: generation of the connection the caller saw fail, None if it has none yet
+    :return: a tuple of the shared connection and its generation
+    """
+    key = self._key(uri, args, kwargs)
+    if key not in self._locks:
+      self._locks[key] = Semaphore()
+    with self._locks[key]:
+      if key not in self._connections:
+        log.info("Creating connection to %s", uri)
+        self._connections[key] = self._create(uri, args, kwargs)
+        self._generations[key] = 0
+      elif generation is not None and generation == self._generations[key]:
+        self._reconnect(uri, self._connections[key])
+        self._generations[key] += 1
+      return self._connections[key], self._generations[key]
+
+  def _reconnect(self, uri, connection):
+    log.info("Reconnecting to %s", uri)
+    connection.disconnect()
+    # raises if the server is still unreachable, the generation is only bumped on success
+    connection.admin.command("ping")
+
+  def healthy(self, uri, *args, **kwargs):
+    """
+    :return: True if there is a connection to uri and its server answers
+    """
+    connection = self._connections.get(self._key(uri, args, kwargs))
+    return connection is not None and connection.alive()
+
+  def close(self):
+    """
+    Disconnects and forgets every connection
+    """
+    for connection in self._connections.values():
+      connection.disconnect()
+    self._connections.clear()
+    self._generations.clear()
+
+default_manager = ConnectionManager()
@@ -0,0 +1,131 @@
+from collections import deque
+import gevent
+import gevent.queue
+import logging
+import time
+
+from mmm import metrics
+from mmm.checkpoint import earliest, previous_timestamp
+
+log = logging.getLogger(__name__)
+
+RETRY_SLEEP_TIME = 1
+DRAIN_SLEEP_TIME = 0.01
+
+class DestinationQueue(object):
+  """
+  Decouples a single Replicator from the oplog tailer with a bounded queue drained by its own greenlet.
+
+  A slow or reconnecting destination only holds up its own queue: other destinations keep replicating
+  until this queue is full, at which point replicate() blocks and so applies backpressure to Triggers.
+  A write that fails stays buffered in the Replicator and is retried ahead of later writes, so the
+  destination catches up from its own position once it is healthy again. Fatal errors are handled by
+  Replicator.handle_failure(); one it cannot skip stops the worker and is raised by the next replicate(),
+  flush() or drain().
+  """
+
+  def __init__(self, replicator, maxsize):
+    self.replicator = replicator
+    self.destination_id = replicator.destination_id
+    self._queue = gevent.queue.Queue(maxsize)
+    # (oplog timestamp, enqueue time) of every op handed over but not yet passed to the replicator
+    self._pending = deque()
+    self._worker = None
+    # the error that stopped the worker
+    self._error = None
+    labels = dict(source=replicator.source_id, destination=self.destination_id, ns=replicator.destination_namespace)
+    metrics.registry.gauge("queue_depth", self.depth, **labels)
+    metrics.registry.gauge("queue_lag_seconds", self.lag, **labels)
+
+  def __call__(self, *args, **kwargs):
+    return self.replicate(*args, **kwargs)
+
+  def replicate(self, op, ns, o, o2=None, b=False, ts=None):
+    self._raise_error()
+    if self._worker is None:
+      self._worker = gevent.spawn(self._run)
+    if self._queue.full():
+      log.debug("queue for %s is full, waiting for it to drain", self.destination_id)
+    self._pending.append((ts, time.time()))
+    self._queue.put((op, ns, o, o2, b, ts))
+
+  def _run(self):
+    try:
+      while True:
+        op, ns, o, o2, b, ts = self._queue.get()
+        try:
+          self.replicator.replicate(op, ns, o, o2, b, ts)
+          if self._queue.empty():
+            self.replicator.flush()
+        except Exception as e:
+          self.replicator.handle_failure(e)
+        # applied, buffered in the replicator or skipped
+        self._pending.popleft()
+        self._retry_buffered()
+    except Exception as e:
+      # the op stays pending, so the checkpoint does not move past it
+      self._error = e
+
+  def _retry_buffered(self):
+    # a failed write stays buffered in the replicator, retry it before handing over anything newer
+    while self.replicator.oldest_pending() is not None and self._queue.empty():
+      gevent.sleep(RETRY_SLEEP_TIME)
+      try:
+        self.replicator.flush()
+      except Exception as e:
+        self.replicator.handle_failure(e)
+
+  def _raise_error(self):
+    if self._error is not None:
+      raise self._error
+
+  def flush(self):
+    """
+    Does not wait for the destination, the worker flushes whenever its queue runs dry.
+    Triggers learns how far this destination got through oldest_pending(). Raises the error that stopped
+    the worker.
+    """
+    self._raise_error()
+
+  def drain(self):
+    """
+    Waits until the destination acknowledged every op handed over, before the queue is closed
+    """
+    while self.oldest_pending() is not None:
+      self._raise_error()
+      gevent.sleep(DRAIN_SLEEP_TIME)
+
+  def oldest_pending(self):
+    """
+    :return: oplog timestamp of the oldest op this destination has not acknowledged, or None
+    """
+    return earliest(self.replicator.oldest_pending(), self._pending[0][0] if self._pending else None)
+
+  def save_positions(self, last_applied):
+    """
+    Persists how far this destination got, given that every op up to last_applied was queued for it
+    """
+    pending = self.oldest_pending()
+    self.replicator.save_position(earliest(previous_timestamp(pending), last_applied) if pending is not None
+      else last_applied)
+
+  def depth(self):
+    """
+    :return: number of ops waiting for this destination
+    """
+    return len(self._pending) + len(self.replicator.writer)
+
+  def lag(self):
+    """
+    :return: seconds the oldest op waiting for this destination has been queued, 0 if it is caught up
+    """
+    if self.replicator.oldest_pending() is not None:
+      return time.time() - self.replicator.writer.first_buffered_at
+    if self._pending:
+      return time.time() - self._pending[0][1]
+    return 0
+
+  def close(self):
+    if self._worker is not None:
+      self._worker.kill()
+      self._worker = None
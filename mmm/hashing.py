@@ -0,0 +1,193 @@
+"""
+Canonical document hashing for loop detection.
+
+A document is hashed by walking it once in key-sorted order and feeding a tagged, length-prefixed
+encoding of every value straight into the digest, without copying or re-serializing the document.
+The top level MMM metadata field is excluded, so a replicated copy hashes like its original.
+
+Hashes are stored as "<algorithm>:<hexdigest>". Hashes without a prefix were written by earlier
+releases (md5 of the JSON dump of the sorted document) and are still verified with that algorithm,
+so nodes can be upgraded one at a time before switching `hash` in the config away from legacy.
+"""
+from bson.json_util import dumps
+import bson
+import datetime
+import hashlib
+import time
+import uuid
+import zlib
+
+from mmm import metrics
+
+HASH_LEGACY = "legacy"
+HASH_MD5 = "md5"
+HASH_FAST = "fast"
+HASH_ALGORITHMS = (HASH_LEGACY, HASH_MD5, HASH_FAST)
+# parts buffered before they are handed to the digest
+BUFFERED_PARTS = 256
+
+_latency = dict((algorithm, metrics.registry.histogram("hash_seconds", algorithm=algorithm))
+  for algorithm in HASH_ALGORITHMS)
+
+def ordered(obj):
+  if isinstance(obj, dict):
+    return sorted((k, ordered(v)) for k, v in obj.items())
+  if isinstance(obj, list):
+    return [ordered(x) for x in obj]
+  else:
+    return obj
+
+class FastDigest(object):
+  """
+  A 64 bit non-cryptographic digest, CRC-32 and Adler-32 of the same stream side by side
+  """
+
+  def __init__(self):
+    self._crc = 0
+    self._adler = 1
+
+  def update(self, data):
+    self._crc = zlib.crc32(data, self._crc)
+    self._adler = zlib.adler32(data, self._adler)
+
+  def hexdigest(self):
+    return "%08x%08x" % (self._crc & 0xffffffff, self._adler & 0xffffffff)
+
+class _Stream(object):
+
+  def __init__(self, digest):
+    self.digest = digest
+    self.parts = []
+
+  def flush(self):
+    self.digest.update("".join(self.parts))
+    del self.parts[:]
+
+def _text(parts, tag, value):
+  if type(value) is unicode:
+    value = value.encode("utf-8")
+  parts.append("%s%d:%s" % (tag, len(value), value))
+
+def _encode_dict(stream, value, exclude=None):
+  parts = stream.parts
+  keys = sorted(value)
+  if exclude is not None and exclude in value:
+    keys.remove(exclude)
+  parts.append("{%d:" % len(keys))
+  for key in keys:
+    _text(parts, "k", key)
+    item = value[key]
+    encoder = _SCALARS.get(type(item))
+    if encoder is not None:
+      parts.append(encoder(item))
+    else:
+      _encode(stream, item)
+  parts.append("}")
+  if len(parts) >= BUFFERED_PARTS:
+    stream.flush()
+
+def _encode_list(stream, value):
+  parts = stream.parts
+  parts.append("[%d:" % len(value))
+  for item in value:
+    encoder = _SCALARS.get(type(item))
+    if encoder is not None:
+      parts.append(encoder(item))
+    else:
+      _encode(stream, item)
+  parts.append("]")
+
+def _encode_text(value):
+  if type(value) is unicode:
+    value = value.encode("utf-8")
+  return "s%d:%s" % (len(value), value)
+
+# encoders for values that produce a single part, by exact type
+_SCALARS = {
+  unicode: _encode_text,
+  str: _encode_text,
+  type(None): lambda value: "n;",
+  bool: lambda value: "t;" if value else "f;",
+  int: lambda value: "i%d;" % value,
+  long: lambda value: "i%d;" % value,
+  float: lambda value: "d%r;" % value,
+  bson.ObjectId: lambda value: "o%s;" % value.binary.encode("hex"),
+  datetime.datetime: lambda value: "D%s;" % value.isoformat(),
+  bson.Timestamp: lambda value: "T%d,%d;" % (value.time, value.inc),
+  uuid.UUID: lambda value: "u%s;" % value.hex,
+}
+
+def _encode(stream, value):
+  encoder = _SCALARS.get(type(value))
+  if encoder is not None:
+    stream.parts.append(encoder(value))
+  elif isinstance(value, dict):
+    _encode_dict(stream, value)
+  elif isinstance(value, (list, tuple)):
+    _encode_list(stream, value)
+  else:
+    # subclasses and rarer types (binary, regex, code, ...) are encoded the way the legacy hash did
+    _text(stream.parts, "j", dumps(value))
+
+def _new_digest(algorithm):
+  if algorithm == HASH_MD5:
+    return hashlib.md5()
+  if algorithm == HASH_FAST:
+    return FastDigest()
+  raise ValueError("hash must be one of %s, got %r" % (", ".join(HASH_ALGORITHMS), algorithm))
+
+def hash_document(document, algorithm=HASH_LEGACY, exclude=None):
+  """
+  :param document: dictionary to generate a hash code for
+  :param algorithm: one of HASH_ALGORITHMS
+  :param exclude: top level field left out of the hash
+  :return: the hash code, prefixed with the algorithm unless it is the legacy one
+  """
+  started = time.time()
+  if algorithm == HASH_LEGACY:
+    without = dict((k, v) for k, v in document.iteritems() if k != exclude)
+    hexdigest = hashlib.md5(dumps(ordered(without))).hexdigest()
+  else:
+    stream = _Stream(_new_digest(algorithm))
+    _encode_dict(stream, document, exclude)
+    stream.flush()
+    hexdigest = "%s:%s" % (algorithm, stream.digest.hexdigest())
+  _latency[algorithm].observe(time.time() - started)
+  return hexdigest
+
+def algorithm_of(stored_hash):
+  """
+  :return: the algorithm a stored hash was computed with
+  """
+  if ":" in stored_hash:
+    return stored_hash.split(":", 1)[0]
+  return HASH_LEGACY
+
+class DocumentDigest(object):
+  """
+  Hashes one oplog document at most once per algorithm, however often loop detection asks for it
+  """
+
+  def __init__(self, document, algorithm=HASH_LEGACY, exclude=None):
+    self.document = document
+    self.algorithm = algorithm
+    self.exclude = exclude
+    self._hashes = {}
+
+  def hexdigest(self, algorithm=None):
+    """
+    :return: the document's hash with the given algorithm, the configured one by default
+    """
+    algorithm = algorithm or self.algorithm
+    if algorithm not in self._hashes:
+      self._hashes[algorithm] = hash_document(self.document, algorithm, self.exclude)
+    return self._hashes[algorithm]
+
+  def matches(self, stored_hash):
+    """
+    :return: True if stored_hash, in whichever format it was written, is the hash of this document
+    """
+    algorithm = algorithm_of(stored_hash)
+    if algorithm not in HASH_ALGORITHMS:
+      return False
+    return self.hexdigest(algorithm) == stored_hash
@@ -0,0 +1,208 @@
+"""
+Seeds a destination namespace with the documents its source already holds.
+
+The newest oplog timestamp is recorded first, then the source collection is copied in `_id` range
+partitions, each streamed by its own greenlet with batched cursors and bulk inserts. Copied documents
+carry MMM metadata as if they had been replicated, so loop detection treats them like any other copy.
+Once every partition is copied the destination's position is set to the recorded timestamp: tailing
+resumes from there and replays what changed during the copy, with inserts applied as upserts.
+
+Progress is kept per partition in local.mmm on the source, so an interrupted sync resumes after the
+last copied `_id` of each partition instead of starting over.
+"""
+from bson.son import SON
+import gevent
+import logging
+from pymongo.errors import DuplicateKeyError
+
+from mmm.connections import default_manager
+from mmm.hashing import DocumentDigest, HASH_LEGACY
+from mmm.replication import AggregateReplicator, MMM_HASH, MMM_METADATA, MMM_TIMESTAMP, MMM_WHOLE
+from mmm.throttle import TokenBucket
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SYNC_PARTITIONS = 4
+DEFAULT_SYNC_BATCH_SIZE = 1000
+
+def range_query(lower=None, upper=None):
+  """
+  :return: query for the documents with lower <= _id < upper, None meaning unbounded
+  """
+  query = {}
+  if lower is not None:
+    query["$gte"] = lower
+  if upper is not None:
+    query["$lt"] = upper
+  return {"_id": query} if query else {}
+
+def _id_at(collection, query, offset):
+  return next(iter(collection.find(query, fields=["_id"]).sort("_id", 1).skip(offset).limit(1)))["_id"]
+
+def id_bounds(collection, parts, lower=None, upper=None):
+  """
+  :return: sorted `_id`s splitting the documents with lower <= _id < upper into about equal parts
+  """
+  query = range_query(lower, upper)
+  count = collection.find(query).count()
+  if parts < 2 or count < 2 * parts:
+    return []
+  # range queries only match `_id`s of the bound's type, partition mixed types as one range
+  if type(_id_at(collection, query, 0)) is not type(_id_at(collection, query, count - 1)):
+    return []
+  return sorted(set(_id_at(collection, query, count * i // parts) for i in range(1, parts)))
+
+def stamp(document, source_id, destination_id, hash_algorithm=HASH_LEGACY):
+  """
+  Gives a document copied from the source the MMM metadata it would have if it had been replicated
+  """
+  metadata = document.get(MMM_METADATA)
+  digest = DocumentDigest(document, hash_algorithm, MMM_METADATA)
+  if not isinstance(metadata, dict) or not digest.matches(metadata.get(MMM_HASH, "")):
+    # written locally, or changed since it was replicated here
+    timestamp = AggregateReplicator.timestamp()
+    metadata = {
+      "source": source_id,
+      MMM_TIMESTAMP: timestamp,
+      source_id: timestamp,
+      MMM_HASH: digest.hexdigest()
+    }
+  else:
+    metadata = dict(metadata)
+  metadata[MMM_WHOLE] = True
+  metadata[destination_id] = metadata[MMM_TIMESTAMP]
+  document[MMM_METADATA] = metadata
+
+def newest_oplog_timestamp(connection):
+  """
+  :return: timestamp of the newest entry in the oplog of the server, None if it is empty
+  """
+  newest = connection.local.oplog.rs.find_one(sort=[('$natural', -1)], fields=['ts'])
+  return newest['ts'] if newest else None
+
+class InitialSync(object):
+  """
+  Copies one source namespace to one destination namespace, see the module documentation
+  """
+
+  def __init__(self, source_id, source_uri, destination_id, destination_uri, source_namespace, destination_namespace,
+      checkpoints, connections=None, partitions=DEFAULT_SYNC_PARTITIONS, batch_size=DEFAULT_SYNC_BATCH_SIZE,
+      throttle=None, hash_algorithm=HASH_LEGACY, transform=None):
+    """
+    :param checkpoints: the CheckpointStore of the source, positions and progress are kept next to it
+    :param throttle: optional TokenBucket limiting the documents read from the source per second
+    :param transform: optional DocumentTransform of the source namespace, the destination gets what it keeps
+    """
+    self.source_id = source_id
+    self.destination_id = destination_id
+    self.source_namespace = source_namespace
+    self.destination_namespace = destination_namespace
+    self.checkpoints = checkpoints
+    self.partitions = partitions
+    self.batch_size = batch_size
+    self.throttle = throttle
+    self.hash_algorithm = hash_algorithm
+    self.transform = transform
+    connections = connections or default_manager
+    self._source_connection, _ = connections.connect(source_uri)
+    self._source = self._source_connection[source_namespace.split(".", 1)[0]][source_namespace.split(".", 1)[1]]
+    destination_connection, _ = connections.connect(destination_uri)
+    self._destination = destination_connection[destination_namespace.split(".", 1)[0]][destination_namespace.split(".", 1)[1]]
+    self._progress = self._source_connection.local.mmm
+    self._progress_id = SON([("source", source_id), ("destination", destination_id), ("ns", destination_namespace),
+      ("initial_sync", True)])
+
+  @staticmethod
+  def throttle_from_config(config):
+    """
+    :param config: the optional `initial_sync` section of the master config
+    :return: a TokenBucket shared by every sync of the engine, or None if unthrottled
+    """
+    rate = (config or {}).get("docs_per_second")
+    return TokenBucket(float(rate)) if rate else None
+
+  def needed(self):
+    """
+    :return: True if the destination namespace was never replicated to, or its sync was interrupted
+    """
+    state = self._progress.find_one({"_id": self._progress_id})
+    if state is not None:
+      return not state.get("done")
+    return self.checkpoints.load(self.destination_id, self.destination_namespace) is None
+
+  def run(self):
+    """
+    Copies every document, then sets the destination position so that tailing picks up where the copy began
+    :return: number of documents copied
+    """
+    state = self._progress.find_one({"_id": self._progress_id}) or self._start()
+    log.info("Initial sync of %s to %s %s from %s", self.source_namespace, self.destination_id,
+      self.destination_namespace, state["ts"])
+    partitions = state["partitions"]
+    greenlets = [gevent.spawn(self._copy, key, partition) for key, partition in sorted(partitions.iteritems())
+      if not partition.get("done")]
+    try:
+      gevent.joinall(greenlets, raise_error=True)
+    except Exception:
+      # the progress of every partition is saved, a later run resumes them all
+      gevent.killall(greenlets)
+      raise
+    # ops up to the newest one now may find their document already copied
+    replay_until = newest_oplog_timestamp(self._source_connection) or state["ts"]
+    self.checkpoints.save_replay_until(self.destination_id, self.destination_namespace, replay_until)
+    self.checkpoints.save(self.destination_id, self.destination_namespace, state["ts"])
+    self._progress.update({"_id": self._progress_id}, {"$set": {"done": True}})
+    copied = sum(greenlet.value for greenlet in greenlets)
+    log.info("Initial sync of %s to %s done, %s documents copied", self.source_namespace, self.destination_id, copied)
+    return copied
+
+  def _start(self):
+    ts = newest_oplog_timestamp(self._source_connection)
+    bounds = self._bounds()
+    partitions = dict((str(i), {"lower": lower, "upper": upper})
+      for i, (lower, upper) in enumerate(zip([None] + bounds, bounds + [None])))
+    state = {"_id": self._progress_id, "ts": ts, "partitions": partitions, "done": False}
+    self._progress.save(state)
+    return state
+
+  def _bounds(self):
+    """
+    :return: sorted `_id`s splitting the source collection into partitions of about the same size
+    """
+    return id_bounds(self._source, self.partitions)
+
+  def _copy(self, key, partition):
+    query = {}
+    lower = partition.get("last", partition["lower"])
+    if lower is not None:
+      query["$gt" if "last" in partition else "$gte"] = lower
+    if partition["upper"] is not None:
+      query["$lt"] = partition["upper"]
+    cursor = self._source.find({"_id": query} if query else {}).sort("_id", 1).batch_size(self.batch_size)
+    copied = 0
+    batch = []
+    for document in cursor:
+      batch.append(document)
+      if len(batch) >= self.batch_size:
+        copied += self._insert(key, batch)
+        batch = []
+    if batch:
+      copied += self._insert(key, batch)
+    self._progress.update({"_id": self._progress_id}, {"$set": {"partitions.%s.done" % key: True}})
+    return copied
+
+  def _insert(self, key, batch):
+    if self.throttle is not None:
+      self.throttle.acquire(len(batch))
+    if self.transform is not None:
+      batch = [self.transform.apply(document) for document in batch]
+    for document in batch:
+      stamp(document, self.source_id, self.destination_id, self.hash_algorithm)
+    try:
+      # pymongo.Connection doesn't wait for acknowledgement unless asked, a failed batch would be taken as copied
+      self._destination.insert(batch, continue_on_error=True, w=1)
+    except DuplicateKeyError:
+      # copied before an interrupted sync recorded its progress
+      log.debug("partition %s of %s resumed over already copied documents", key, self.source_namespace)
+    self._progress.update({"_id": self._progress_id}, {"$set": {"partitions.%s.last" % key: batch[-1]["_id"]}})
+    return len(batch)
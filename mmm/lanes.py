@@ -0,0 +1,152 @@
+from collections import deque
+import gevent
+import gevent.queue
+import logging
+
+from mmm import metrics
+from mmm.catchup import op_key
+from mmm.checkpoint import earliest, previous_timestamp, timestamp_key
+from mmm.oplog import OplogOp, dispatch
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LANE_QUEUE_SIZE = 1000
+
+class ApplyLanes(object):
+  """
+  Applies the oplog entries of one namespace on several lanes in parallel. Each lane is a callback with
+  its own destination writers (an AggregateReplicator and its Replicators), fed by its own bounded queue
+  and greenlet.
+
+  Entries are routed by the `_id` of the document they change, so every entry of a document is applied
+  by the same lane, in oplog order. Entries whose `_id` cannot be hashed all go to the first lane.
+  oldest_pending() holds the checkpoint back to the oldest entry some lane has not applied yet, so saving
+  it does not wait for the lanes. drain() does, before the lanes are stopped.
+
+  When a lane fails, its queued entries are dropped and the error is raised to Triggers by the next
+  replicate() or flush(). Triggers then replays the oplog from its checkpoint: the failed lane applies
+  everything again, the other lanes skip the entries they already applied.
+  """
+
+  def __init__(self, source_id, namespace, lanes, maxsize=DEFAULT_LANE_QUEUE_SIZE):
+    """
+    :param lanes: list of callbacks, one per lane
+    :param maxsize: entries queued per lane before replicate() blocks
+    """
+    self.lanes = lanes
+    self._queues = [gevent.queue.JoinableQueue(maxsize) for _ in lanes]
+    # oplog timestamps of the entries handed to each lane but not applied yet
+    self._pending = [deque() for _ in lanes]
+    # timestamp of the last entry queued for each lane, entries replayed after a failure are skipped
+    self._last_queued = [None for _ in lanes]
+    self._workers = [None for _ in lanes]
+    self._failed = set()
+    self._error = None
+    for lane in xrange(len(lanes)):
+      metrics.registry.gauge("apply_lane_depth", self._pending[lane].__len__, source=source_id, ns=namespace,
+        lane=str(lane))
+
+  def __call__(self, **op_doc):
+    return self.replicate(**op_doc)
+
+  def replicate(self, **op_doc):
+    return self.apply_op(OplogOp.from_document(op_doc))
+
+  def apply_op(self, op):
+    """
+    :param op: OplogOp, queued as is for its lane
+    """
+    self._raise_error()
+    for lane in self._failed:
+      # the replay reached this lane again, what it had pending is about to be queued once more
+      self._pending[lane].clear()
+    self._failed.clear()
+    key = op_key(op)
+    lane = hash(key) % len(self.lanes) if key is not None else 0
+    ts = op.ts
+    last = self._last_queued[lane]
+    if ts is not None and last is not None and timestamp_key(ts) <= timestamp_key(last):
+      log.debug("lane %s already applied %s, skipping", lane, ts)
+      return
+    if self._workers[lane] is None:
+      self._workers[lane] = gevent.spawn(self._run, lane)
+    self._last_queued[lane] = ts
+    self._pending[lane].append(ts)
+    self._queues[lane].put(op)
+
+  def _run(self, lane):
+    callback, queue, pending = self.lanes[lane], self._queues[lane], self._pending[lane]
+    while True:
+      op = queue.get()
+      try:
+        dispatch(callback, op)
+        if queue.empty() and hasattr(callback, "flush"):
+          callback.flush()
+      except Exception as e:
+        log.error("Applying %s on lane %s failed", op.ts, lane, exc_info=1)
+        self._fail(lane, e)
+        return
+      pending.popleft()
+      queue.task_done()
+
+  def _fail(self, lane, error):
+    queue, pending = self._queues[lane], self._pending[lane]
+    # keep the failed entry pending so the checkpoint stays before it, the rest is replayed anyway
+    failed = pending[0]
+    pending.clear()
+    pending.append(failed)
+    while not queue.empty():
+      queue.get_nowait()
+      queue.task_done()
+    queue.task_done()
+    self._workers[lane] = None
+    self._last_queued[lane] = None
+    self._failed.add(lane)
+    if self._error is None:
+      self._error = error
+
+  def _raise_error(self):
+    error, self._error = self._error, None
+    if error is not None:
+      raise error
+
+  def flush(self):
+    """
+    Raises the error of a failed lane, the lanes flush their callbacks whenever their queue runs empty
+    """
+    self._raise_error()
+
+  def drain(self):
+    """
+    Waits until every lane applied and flushed the entries handed to it
+    """
+    for queue in self._queues:
+      queue.join()
+    self._raise_error()
+
+  def replicates_deletes(self, namespace):
+    return all(lane.replicates_deletes(namespace) for lane in self.lanes if hasattr(lane, "replicates_deletes"))
+
+  def oldest_pending(self):
+    """
+    :return: oplog timestamp of the oldest entry some lane has not applied, or its destinations not acknowledged
+    """
+    queued = [pending[0] for pending in self._pending if pending]
+    acknowledged = [lane.oldest_pending() for lane in self.lanes if hasattr(lane, "oldest_pending")]
+    return earliest(*(queued + acknowledged))
+
+  def save_positions(self, last_applied):
+    """
+    Persists how far the destinations got, which is no further than the slowest lane
+    """
+    pending = self.oldest_pending()
+    position = previous_timestamp(pending) if pending is not None else last_applied
+    for lane in self.lanes:
+      if hasattr(lane, "save_positions"):
+        lane.save_positions(position)
+
+  def close(self):
+    for lane, worker in enumerate(self._workers):
+      if worker is not None:
+        worker.kill()
+        self._workers[lane] = None
@@ -0,0 +1,157 @@
+"""
+Chooses the replica set member whose oplog is tailed.
+
+By default the oplog is read from the primary the source URI connects to. With `oplog_source.read_from:
+'secondary'` it is read from a secondary instead, so the primary only serves the source write-backs
+and, unless `checkpoint.uri` moves them, the checkpoint writes. Candidates are the healthy secondaries
+carrying every one of the configured `tags` and no further than `max_lag_seconds` behind the primary;
+the one answering a ping fastest from here is tailed. The primary is tailed when no secondary qualifies.
+
+Every member applies the same oplog entries with the same timestamps, so a checkpoint taken on one
+member is a position on any other. Every `check_interval` seconds the tailed member's own lag behind the
+primary is measured: when it falls further behind than `max_lag_seconds` its replication, not MMM, is
+the bottleneck and another member is chosen. A member that goes away is replaced the same way when
+Triggers reconnects.
+"""
+import logging
+import time
+
+from mmm import metrics
+
+log = logging.getLogger(__name__)
+
+READ_PRIMARY = "primary"
+READ_SECONDARY = "secondary"
+READ_MODES = (READ_PRIMARY, READ_SECONDARY)
+DEFAULT_MAX_LAG_SECONDS = 30
+DEFAULT_CHECK_INTERVAL = 10
+
+def _seconds(delta):
+  return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+class OplogSource(object):
+  """
+  The member of the source replica set tailed by Triggers, see the module documentation
+  """
+
+  def __init__(self, source_id, source_uri, connections, tags=None, max_lag_seconds=DEFAULT_MAX_LAG_SECONDS,
+      check_interval=DEFAULT_CHECK_INTERVAL, clock=time.time):
+    """
+    :param source_uri: mongo URI of the replica set, used to find its members and their state
+    :param tags: dict of tags a secondary must carry to be tailed, None accepts any secondary
+    """
+    self.source_uri = source_uri
+    self.connections = connections
+    self.tags = tags or {}
+    self.max_lag_seconds = max_lag_seconds
+    self.check_interval = check_interval
+    self._clock = clock
+    # host of the tailed secondary, None while tailing the primary
+    self.host = None
+    # seconds the tailed member was behind the primary when last checked
+    self.lag = None
+    self._checked_at = clock()
+    metrics.registry.gauge("oplog_source_lag_seconds", lambda: self.lag, source=source_id)
+
+  @classmethod
+  def from_config(cls, source_id, source_uri, connections, config):
+    """
+    :param config: the optional `oplog_source` section of the master config
+    :return: an OplogSource, or None to always tail the primary
+    """
+    config = config or {}
+    read_from = config.get("read_from", READ_PRIMARY)
+    if read_from not in READ_MODES:
+      raise ValueError("oplog_source read_from must be one of %s, got %r" % (", ".join(READ_MODES), read_from))
+    if read_from == READ_PRIMARY:
+      return None
+    return cls(source_id, source_uri, connections, config.get("tags"),
+      float(config.get("max_lag_seconds", DEFAULT_MAX_LAG_SECONDS)),
+      float(config.get("check_interval", DEFAULT_CHECK_INTERVAL)))
+
+  @staticmethod
+  def uri(host):
+    return "mongodb://%s" % host
+
+  def members(self):
+    """
+    :return: dict of host to (state, seconds behind the primary or None if there is no primary, tags)
+    """
+    primary, _ = self.connections.connect(self.source_uri)
+    status = primary.admin.command("replSetGetStatus")
+    config = primary.local.system.replset.find_one() or {}
+    tags = dict((member["host"], member.get("tags") or {}) for member in config.get("members", []))
+    optimes = [member["optimeDate"] for member in status["members"] if member.get("stateStr") == "PRIMARY"]
+    members = {}
+    for member in status["members"]:
+      state = member.get("stateStr") if member.get("health", 1) else "DOWN"
+      lag = max(_seconds(optimes[0] - member["optimeDate"]), 0) if optimes and "optimeDate" in member else None
+      members[member["name"]] = (state, lag, tags.get(member["name"], {}))
+    return members
+
+  def _qualifies(self, state, lag, tags):
+    return (state == "SECONDARY" and lag is not None and lag <= self.max_lag_seconds and
+      all(tags.get(name) == value for name, value in self.tags.iteritems()))
+
+  def _ping(self, host):
+    """
+    :return: seconds the member took to answer a ping, None if it didn't
+    """
+    connection, _ = self.connections.connect(self.uri(host), None, slave_okay=True)
+    started = self._clock()
+    try:
+      connection.admin.command("ping")
+    except Exception:
+      log.debug("%s did not answer a ping", host, exc_info=1)
+      return None
+    return self._clock() - started
+
+  def select(self, exclude=()):
+    """
+    Chooses the member to tail, the secondary answering fastest among those that qualify
+    :param exclude: hosts not to choose, e.g. one that just failed
+    :return: the chosen host, None for the primary
+    """
+    members = self.members()
+    latencies = []
+    for host, (state, lag, tags) in sorted(members.iteritems()):
+      if host not in exclude and self._qualifies(state, lag, tags):
+        latency = self._ping(host)
+        if latency is not None:
+          latencies.append((latency, host))
+    host = min(latencies)[1] if latencies else None
+    if host is None:
+      log.warn("No secondary of %s qualifies for tailing, tailing the primary", self.source_uri)
+    elif host != self.host:
+      log.info("Tailing the oplog of %s, %s seconds behind its primary", host, members[host][1])
+    self.host = host
+    self.lag = members[host][1] if host is not None else 0
+    self._checked_at = self._clock()
+    return host
+
+  def due(self):
+    """
+    :return: True if check() should run now
+    """
+    return self._clock() - self._checked_at >= self.check_interval
+
+  def check(self):
+    """
+    Measures the tailed member's lag behind the primary
+    :return: True if another member should be tailed, then select() chooses it
+    """
+    self._checked_at = self._clock()
+    members = self.members()
+    if self.host is None:
+      self.lag = 0
+      # back to a secondary as soon as one qualifies
+      return any(self._qualifies(*member) for member in members.itervalues())
+    state, lag, tags = members.get(self.host, ("REMOVED", None, {}))
+    self.lag = lag
+    if state != "SECONDARY":
+      log.warn("%s, tailed for %s, is %s now", self.host, self.source_uri, state)
+      return True
+    if lag is not None and lag > self.max_lag_seconds:
+      log.warn("%s is %s seconds behind its primary, its replication is the bottleneck", self.host, lag)
+      return True
+    return False
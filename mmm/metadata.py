@@ -0,0 +1,9 @@
+"""
+Names of the MMM metadata replication keeps in documents and oplog entries.
+"""
+MMM_METADATA = '__mmm'
+MMM_TIMESTAMP = "source_ts"
+MMM_HASH = "hash"
+# set when the hash covers the whole document, not an update of it
+MMM_WHOLE = "whole"
+MMM_SKIP_OP = "__mmm_skip"
@@ -0,0 +1,252 @@
+"""
+Counters, gauges and histograms describing replication, cheap enough to leave on in production.
+
+Components record into the module level `registry`. Counters and histograms only update a few numbers
+in place; gauges are callables evaluated when the metrics are read. The registry can be served as
+plain text over HTTP with MetricsServer and summarized periodically in the log with MetricsLogger.
+"""
+from bisect import bisect_left
+import gevent
+import json
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets in seconds, 10us doubling up to about 84s
+HISTOGRAM_BUCKETS = tuple(0.00001 * 2 ** i for i in range(24))
+DEFAULT_LOG_INTERVAL = 60
+
+def _label_text(labels):
+  if not labels:
+    return ""
+  return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+
+class Counter(object):
+
+  def __init__(self, name, labels):
+    self.name = name
+    self.labels = labels
+    self.value = 0
+
+  def inc(self, amount=1):
+    self.value += amount
+
+  def samples(self):
+    yield self.name, self.labels, self.value
+
+  def summary(self):
+    return self.value
+
+class Gauge(object):
+
+  def __init__(self, name, labels, func):
+    self.name = name
+    self.labels = labels
+    self.func = func
+
+  @property
+  def value(self):
+    try:
+      return self.func()
+    except Exception:
+      log.debug("gauge %s failed", self.name, exc_info=1)
+      return None
+
+  def samples(self):
+    value = self.value
+    if value is not None:
+      yield self.name, self.labels, value
+
+  def summary(self):
+    return self.value
+
+class Histogram(object):
+  """
+  Distribution of durations in seconds, kept as counts per bucket of HISTOGRAM_BUCKETS
+  """
+
+  def __init__(self, name, labels):
+    self.name = name
+    self.labels = labels
+    self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, seconds):
+    self.counts[bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+    self.count += 1
+    self.sum += seconds
+
+  def time(self):
+    """
+    :return: a context manager observing the time spent in its block
+    """
+    return _Timer(self)
+
+  def quantile(self, q):
+    """
+    :return: upper bound of the bucket holding the q-quantile, None if nothing was observed
+    """
+    if not self.count:
+      return None
+    rank = q * self.count
+    seen = 0
+    for bound, count in zip(HISTOGRAM_BUCKETS, self.counts):
+      seen += count
+      if seen >= rank:
+        return bound
+    return float("inf")
+
+  def samples(self):
+    seen = 0
+    for bound, count in zip(HISTOGRAM_BUCKETS, self.counts):
+      seen += count
+      yield self.name + "_bucket", self.labels + (("le", "%g" % bound),), seen
+    yield self.name + "_bucket", self.labels + (("le", "+Inf"),), self.count
+    yield self.name + "_sum", self.labels, self.sum
+    yield self.name + "_count", self.labels, self.count
+
+  def summary(self):
+    return {"count": self.count, "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+
+class _Timer(object):
+
+  def __init__(self, histogram):
+    self.histogram = histogram
+
+  def __enter__(self):
+    self.start = time.time()
+
+  def __exit__(self, *exc_info):
+    self.histogram.observe(time.time() - self.start)
+
+class Registry(object):
+  """
+  All metrics of the process, by name and labels. Asking for an existing metric returns it.
+  """
+
+  def __init__(self):
+    self._metrics = {}
+
+  def _get(self, cls, name, labels, *args):
+    key = (name, tuple(sorted(labels.iteritems())))
+    metric = self._metrics.get(key)
+    if metric is None:
+      metric = self._metrics[key] = cls(name, key[1], *args)
+    return metric
+
+  def counter(self, name, **labels):
+    return self._get(Counter, name, labels)
+
+  def histogram(self, name, **labels):
+    return self._get(Histogram, name, labels)
+
+  def gauge(self, name, func, **labels):
+    """
+    :param func: callable returning the current value, it replaces the one of an existing gauge
+    """
+    gauge = self._get(Gauge, name, labels, func)
+    gauge.func = func
+    return gauge
+
+  def get(self, name, **labels):
+    """
+    :return: the metric with this name and labels, or None
+    """
+    return self._metrics.get((name, tuple(sorted(labels.iteritems()))))
+
+  def remove(self, **labels):
+    """
+    Forgets every metric that has all of the given labels, e.g. those of a stopped engine
+    """
+    items = set(labels.iteritems())
+    for key in [key for key in self._metrics if items <= set(key[1])]:
+      del self._metrics[key]
+
+  def metrics(self):
+    return [self._metrics[key] for key in sorted(self._metrics)]
+
+  def render(self):
+    """
+    :return: every metric in the Prometheus text format
+    """
+    lines = []
+    for metric in self.metrics():
+      for name, labels, value in metric.samples():
+        lines.append("%s%s %s" % (name, _label_text(labels), value))
+    return "\n".join(lines) + "\n"
+
+  def summary(self):
+    """
+    :return: a JSON serializable dict of every metric, histograms reduced to count, p50 and p99
+    """
+    return dict((metric.name + _label_text(metric.labels), metric.summary()) for metric in self.metrics())
+
+registry = Registry()
+
+class MetricsServer(object):
+  """
+  Serves the registry as text on http://<host>:<port>/metrics
+  """
+
+  def __init__(self, port, host="127.0.0.1", registry=registry):
+    from gevent.pywsgi import WSGIServer
+    self.registry = registry
+    self.server = WSGIServer((host, port), self.application, log=None)
+
+  def application(self, environ, start_response):
+    if environ.get("PATH_INFO") not in ("/", "/metrics"):
+      start_response("404 Not Found", [("Content-Type", "text/plain")])
+      return ["not found\n"]
+    body = self.registry.render()
+    start_response("200 OK", [("Content-Type", "text/plain; version=0.0.4"), ("Content-Length", str(len(body)))])
+    return [body]
+
+  def start(self):
+    self.server.start()
+
+  def stop(self):
+    self.server.stop()
+
+class MetricsLogger(object):
+  """
+  Logs a JSON summary of the registry every `interval` seconds
+  """
+
+  def __init__(self, interval=DEFAULT_LOG_INTERVAL, registry=registry):
+    self.interval = interval
+    self.registry = registry
+    self._greenlet = None
+
+  def log(self):
+    log.info("metrics %s", json.dumps(self.registry.summary(), sort_keys=True))
+
+  def _run(self):
+    while True:
+      gevent.sleep(self.interval)
+      self.log()
+
+  def start(self):
+    self._greenlet = gevent.spawn(self._run)
+
+  def stop(self):
+    if self._greenlet is not None:
+      self._greenlet.kill()
+      self._greenlet = None
+
+def start(config):
+  """
+  Starts what the optional `metrics` section of the config asks for, e.g. {"port": 9411, "log_interval": 60}.
+  Neither is started by default.
+  :return: the started MetricsServer and MetricsLogger, None for those not configured
+  """
+  config = config or {}
+  server = logger = None
+  if config.get("port"):
+    server = MetricsServer(int(config["port"]), config.get("host", "127.0.0.1"))
+    server.start()
+  if config.get("log_interval"):
+    logger = MetricsLogger(float(config["log_interval"]))
+    logger.start()
+  return server, logger
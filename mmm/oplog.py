@@ -0,0 +1,78 @@
+"""
+OplogOp: one oplog entry, handed to every callback as the same immutable object.
+
+Triggers used to call each callback with the entry's fields as keyword arguments, building a new dict per
+callback. Callbacks with an apply_op() method now receive the OplogOp itself, other callables still get
+keyword arguments.
+"""
+
+# fields of an oplog entry kept by OplogOp, others are dropped
+OPLOG_OP_FIELDS = ("ts", "h", "op", "ns", "o", "o2", "b", "v")
+
+class OplogOp(object):
+  """
+  An immutable oplog entry. Fields are read as attributes (op.ns) or, as from the oplog document, by
+  key (op["ns"], op.get("o2")); a missing field reads as None.
+  """
+  __slots__ = OPLOG_OP_FIELDS
+
+  def __init__(self, ts=None, h=None, op=None, ns=None, o=None, o2=None, b=None, v=None):
+    assign = object.__setattr__
+    assign(self, "ts", ts)
+    assign(self, "h", h)
+    assign(self, "op", op)
+    assign(self, "ns", ns)
+    assign(self, "o", o)
+    assign(self, "o2", o2)
+    assign(self, "b", b)
+    assign(self, "v", v)
+
+  @classmethod
+  def from_document(cls, document):
+    """
+    :param document: an oplog entry as read from the oplog
+    """
+    get = document.get
+    return cls(get("ts"), get("h"), get("op"), get("ns"), get("o"), get("o2"), get("b"), get("v"))
+
+  def __setattr__(self, name, value):
+    raise AttributeError("OplogOp is immutable, use replace()")
+
+  def __getitem__(self, name):
+    if name not in OPLOG_OP_FIELDS:
+      raise KeyError(name)
+    return getattr(self, name)
+
+  def get(self, name, default=None):
+    value = getattr(self, name) if name in OPLOG_OP_FIELDS else None
+    return default if value is None else value
+
+  def replace(self, **fields):
+    """
+    :return: a copy with the given fields replaced
+    """
+    values = dict((name, fields.get(name, getattr(self, name))) for name in OPLOG_OP_FIELDS)
+    return OplogOp(**values)
+
+  def document(self):
+    """
+    :return: the entry as a new dict of its present fields, e.g. keyword arguments for a callback
+    """
+    document = {}
+    for name in OPLOG_OP_FIELDS:
+      value = getattr(self, name)
+      if value is not None:
+        document[name] = value
+    return document
+
+  def __repr__(self):
+    return "OplogOp(ts=%r, op=%r, ns=%r)" % (self.ts, self.op, self.ns)
+
+def dispatch(callback, op):
+  """
+  Hands an oplog entry to a callback: the OplogOp itself if its class defines apply_op(), keyword
+  arguments otherwise (plain functions, and mocks that answer to any attribute)
+  """
+  if getattr(type(callback), "apply_op", None) is not None:
+    return callback.apply_op(op)
+  return callback(**op.document())
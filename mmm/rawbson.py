@@ -0,0 +1,183 @@
+"""
+Raw BSON passthrough: encoding a replicated document once, however many copies of it are written.
+
+A local insert or replacement is written back to the source and to every destination, each copy with
+metadata of its own. With passthrough the document is encoded once, without its metadata, and every
+copy is a RawDocument: those bytes with the metadata element appended, the only part encoded per write.
+
+pymongo 2.x only encodes dicts, so raw documents are sent in wire protocol messages built here, laid
+out as pymongo.message builds them, over the connection's own _send_message().
+"""
+import bson
+from bson.son import SON
+from pymongo import helpers, message
+import struct
+
+# wire protocol opcodes
+OP_UPDATE = 2001
+OP_INSERT = 2002
+OP_QUERY = 2004
+
+def encode_element(name, value):
+  """
+  :return: the BSON element of one field
+  """
+  return bson.BSON.encode({name: value})[4:-1]
+
+def is_raw(document):
+  return isinstance(document, RawDocument)
+
+def encoded_size(document):
+  """
+  :return: BSON size of a document, raw documents are not encoded again
+  """
+  return len(document.raw) if is_raw(document) else len(bson.BSON.encode(document))
+
+class RawDocument(object):
+  """
+  An encoded document with one more top-level field, kept decoded and appended whenever the document is
+  encoded, or none if its name is None. `_id`, if given, and the appended field are read without decoding
+  the rest.
+  """
+  __slots__ = ("body", "name", "value", "_id", "_raw")
+
+  def __init__(self, body, name, value, _id=None):
+    """
+    :param body: the encoded elements of the document, without its length and terminating null
+    """
+    self.body = body
+    self.name = name
+    self.value = value
+    self._id = _id
+    self._raw = None
+
+  @classmethod
+  def encode(cls, document, name=None, value=None):
+    """
+    :return: document with its `name` field set to value, everything else encoded once
+    """
+    fields = SON((k, v) for k, v in document.iteritems() if k != name)
+    return cls(bson.BSON.encode(fields)[4:-1], name, value, document.get("_id"))
+
+  def replace(self, value):
+    """
+    :return: the same document with another value of the appended field, sharing the encoded rest
+    """
+    return RawDocument(self.body, self.name, value, self._id)
+
+  @property
+  def raw(self):
+    if self._raw is None:
+      element = encode_element(self.name, self.value) if self.name is not None else ""
+      self._raw = struct.pack("<i", len(self.body) + len(element) + 5) + self.body + element + "\x00"
+    return self._raw
+
+  def decode(self):
+    return bson.BSON(self.raw).decode()
+
+  def __getitem__(self, key):
+    if key == self.name:
+      return self.value
+    if key == "_id" and self._id is not None:
+      return self._id
+    return self.decode()[key]
+
+  def __contains__(self, key):
+    return key == self.name or (key == "_id" and self._id is not None) or key in self.decode()
+
+  def get(self, key, default=None):
+    return self[key] if key in self else default
+
+  def __repr__(self):
+    return "RawDocument(%r, %s=%r)" % (self._id, self.name, self.value)
+
+def _contains_raw(value):
+  if is_raw(value):
+    return True
+  if isinstance(value, dict):
+    return any(_contains_raw(v) for v in value.itervalues())
+  if isinstance(value, list):
+    return any(_contains_raw(v) for v in value)
+  return False
+
+def encode(document):
+  """
+  :param document: a dict whose values, or the documents among them, may be RawDocuments
+  :return: its BSON, the fields holding raw documents last
+  """
+  if is_raw(document):
+    return document.raw
+  fields, elements = SON(), []
+  for name, value in document.iteritems():
+    if not _contains_raw(value):
+      fields[name] = value
+    elif isinstance(value, list):
+      elements.append("\x04" + bson._make_c_string(name) + encode(SON((str(i), v) for i, v in enumerate(value))))
+    else:
+      elements.append("\x03" + bson._make_c_string(name) + encode(value))
+  body = bson.BSON.encode(fields)[4:-1] + "".join(elements)
+  return struct.pack("<i", len(body) + 5) + body + "\x00"
+
+def _message(operation, data, full_name, w, max_bson_size):
+  request_id, data = message.__pack_message(operation, data)
+  if w:
+    # followed by getLastError, as pymongo does for acknowledged writes
+    request_id, error_message, _ = message.__last_error(full_name, {"w": w})
+    data += error_message
+  return request_id, data, max_bson_size
+
+def insert_message(full_name, documents, continue_on_error=False, w=None):
+  """
+  :param documents: list of RawDocuments
+  :return: an insert message, as pymongo.message.insert() returns it
+  """
+  encoded = [document.raw for document in documents]
+  data = struct.pack("<i", 1 if continue_on_error else 0) + bson._make_c_string(full_name) + "".join(encoded)
+  return _message(OP_INSERT, data, full_name, w, max(len(e) for e in encoded))
+
+def update_message(full_name, spec, document, upsert=False, w=None):
+  """
+  :param document: RawDocument replacing the document matching spec
+  :return: an update message, as pymongo.message.update() returns it
+  """
+  data = "\x00\x00\x00\x00" + bson._make_c_string(full_name) + struct.pack("<i", 1 if upsert else 0)
+  data += bson.BSON.encode(spec) + document.raw
+  return _message(OP_UPDATE, data, full_name, w, len(document.raw))
+
+def command_message(database_name, command):
+  """
+  :param command: SON of the command, see encode() for its raw documents
+  :return: a command message, as pymongo.message.query() returns it for database.command()
+  """
+  encoded = encode(command)
+  data = "\x00\x00\x00\x00" + bson._make_c_string(database_name + ".$cmd") + struct.pack("<ii", 0, -1) + encoded
+  request_id, data = message.__pack_message(OP_QUERY, data)
+  return request_id, data, len(encoded)
+
+def insert(collection, documents, continue_on_error=False, w=None):
+  """
+  Inserts RawDocuments, like collection.insert()
+  :param w: write concern, an acknowledged insert raises OperationFailure like pymongo's
+  :return: the getLastError response of an acknowledged insert, None otherwise
+  """
+  return collection.database.connection._send_message(
+    insert_message(collection.full_name, documents, continue_on_error, w), bool(w))
+
+def update(collection, spec, document, upsert=False, w=None):
+  """
+  Replaces the document matching spec with a RawDocument, like collection.update()
+  :return: the getLastError response of an acknowledged update, None otherwise
+  """
+  return collection.database.connection._send_message(
+    update_message(collection.full_name, spec, document, upsert, w), bool(w))
+
+def command(database, command):
+  """
+  Runs a command holding RawDocuments, like database.command()
+  :return: the command's response
+  """
+  connection = database.connection
+  response = connection._send_message_with_response(command_message(database.name, command), _must_use_master=True)
+  result = helpers._unpack_response(response)["data"][0]
+  helpers._check_command_response(result, connection.disconnect)
+  return result
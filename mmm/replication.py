@@ -1,44 +1,345 @@
-from bson.json_util import dumps
+from bson.son import SON
 from collections import defaultdict
-from flatdict import FlatDict
+import copy
 from functools import wraps
 import gevent
-import hashlib
-import json
+try:
+  from gevent.lock import Semaphore
+except ImportError: # gevent < 1.0
+  from gevent.coros import Semaphore
 import logging
-from pymongo import Connection
-from pymongo.errors import AutoReconnect, OperationFailure
-import sys
+import os
 import time
 
+from mmm import metrics, rawbson
+from mmm.batching import BulkWriteError, BulkWriter, WriteOp, supports_write_commands
+from mmm.catchup import CatchUpPolicy
+from mmm.checkpoint import (CheckpointPolicy, CheckpointStore, DEFAULT_CHECKPOINT_NAMESPACE, earliest, latest,
+  previous_timestamp, timestamp_key)
+from mmm.coalesce import CoalescingWindow
+from mmm.conflicts import policy_from_config
+from mmm.connections import default_manager
+from mmm.fanout import DestinationQueue
+from mmm.hashing import DocumentDigest, HASH_ALGORITHMS, HASH_LEGACY, hash_document
+from mmm.lanes import ApplyLanes, DEFAULT_LANE_QUEUE_SIZE
+from mmm.members import OplogSource
+from mmm.metadata import MMM_HASH, MMM_METADATA, MMM_SKIP_OP, MMM_TIMESTAMP, MMM_WHOLE
+from mmm.retry import RetryPolicy
+from mmm.scheduling import DestinationScheduler, PRIORITY_NORMAL
+from mmm.spill import DEFAULT_SPILL_SEGMENT_BYTES, SpillLog, SpillQueue
+from mmm.transforms import DocumentTransform
 from mmm.triggers import Triggers
 
 log = logging.getLogger(__name__)
 
-RECONNECT_SLEEP_TIME = 60
-
 class ReplicationEngine(object):
 
-  def __init__(self, source_id, source_uri, destinations, *connection_args, **connection_kwargs):
-    self._connection = Connection(source_uri, *connection_args, **connection_kwargs)
-    self._collection = self._connection.local.mmm
+  def __init__(self, source_id, source_uri, destinations, options=None, connections=None, *connection_args, **connection_kwargs):
+    """
+    :param source_id: unique identifier of the master being replicated
+    :param source_uri: mongo URI of the master being replicated
+    :param destinations: list of replication destinations, the `replications` section of the config
+    :param options: optional engine settings, the `master` section of the config (e.g. `checkpoint`)
+    :param connections: ConnectionManager shared by every component, mmm.connections.default_manager by default
+    """
+    options = options or {}
+    self.source_id = source_id
+    self.source_uri = source_uri
+    self.options = options
+    self.connections = connections or default_manager
+    checkpoint = options.get("checkpoint") or {}
+    checkpoint_uri = checkpoint.get("uri", source_uri)
+    checkpoint_database, checkpoint_collection = checkpoint.get("namespace", DEFAULT_CHECKPOINT_NAMESPACE).split(".", 1)
+    if checkpoint_uri == source_uri:
+      self._connection, _ = self.connections.connect(source_uri, None, *connection_args, **connection_kwargs)
+    else:
+      self._connection, _ = self.connections.connect(checkpoint_uri)
+    self._collection = self._connection[checkpoint_database][checkpoint_collection]
     self.triggers = Triggers(source_id, source_uri, *connection_args, **connection_kwargs)
-
-    aggregate_replicators = {}
-    for db_collection in ReplicationEngine.get_replicated_collections(destinations):
-      namespace = ".".join(db_collection)
-      aggregate_replicator = AggregateReplicator(source_id, source_uri, db_collection[0], db_collection[1])
-      aggregate_replicators[namespace] = aggregate_replicator
-      self.triggers.register(namespace, "iud", aggregate_replicator)
-
+    self.triggers.connections = self.connections
+    self.triggers.checkpoint_uri = checkpoint_uri
+    self.triggers.checkpoint_namespace = "%s.%s" % (checkpoint_database, checkpoint_collection)
+    self.triggers.oplog_source = OplogSource.from_config(source_id, source_uri, self.connections,
+      options.get("oplog_source"))
+    self.triggers.checkpoint_policy = CheckpointPolicy.from_config(options.get("checkpoint"))
+    self.triggers.oplog_fields = OPLOG_FIELDS
+    self.triggers.catch_up = CatchUpPolicy.from_config(options.get("catch_up"))
+    self.retry_policy = RetryPolicy.from_config(options.get("retry"))
+    self.triggers.retry_policy = self.retry_policy
+    self.checkpoints = CheckpointStore(self._collection, source_id)
+    metadata_mode = options.get("metadata", METADATA_INLINE)
+    if metadata_mode not in METADATA_MODES:
+      raise ValueError("metadata must be one of %s, got %r" % (", ".join(METADATA_MODES), metadata_mode))
+    hash_algorithm = options.get("hash", HASH_LEGACY)
+    if hash_algorithm not in HASH_ALGORITHMS:
+      raise ValueError("hash must be one of %s, got %r" % (", ".join(HASH_ALGORITHMS), hash_algorithm))
+    self.hash_algorithm = hash_algorithm
+    self.metadata_mode = metadata_mode
+    self.raw_bson = bool(options.get("raw_bson", False))
+    self.conflict_policy = policy_from_config(options.get("conflicts"))
+    if self.conflict_policy is not None and metadata_mode != METADATA_INLINE:
+      log.warn("conflicts are only resolved against local writes with metadata: '%s'", METADATA_INLINE)
+    parallel_apply = options.get("parallel_apply") or {}
+    self.lane_count = int(parallel_apply.get("lanes", 1))
+    if self.lane_count < 1:
+      raise ValueError("parallel_apply lanes must be at least 1, got %r" % self.lane_count)
+    self.lane_queue_size = int(parallel_apply.get("queue_size", DEFAULT_LANE_QUEUE_SIZE))
+    # source namespace to what replicates it, see _build_namespace()
+    self._namespaces = {}
+    # destination id to the DestinationScheduler of a destination with a `scheduler` section
+    self._schedulers = {}
+    for source, entries in sorted(self._namespace_configs(destinations).iteritems()):
+      self._namespaces[source] = self._build_namespace(source, entries)
+      self.triggers.register(source, "iud", self._namespaces[source]["callback"])
+
+  def _namespace_configs(self, destinations):
+    """
+    :param destinations: the `replications` config
+    :return: dict of source namespace to the (destination, namespace) entries replicating it, the
+    destinations without their other namespaces
+    """
+    configs = defaultdict(list)
     for dest in destinations:
+      settings = copy.deepcopy(dict((k, v) for k, v in dest.iteritems() if k != "namespaces"))
       for namespace in dest["namespaces"]:
-        source = namespace["source"]
-        replicator = Replicator(source_id, dest["id"], dest["uri"], *namespace["dest"].split(".", 1))
-        aggregate_replicators[source].register(replicator, namespace["source"], dest.get("operations", "iud"))
+        configs[namespace["source"]].append((settings, copy.deepcopy(namespace)))
+    for section in ("coalesce", "transforms"):
+      for namespace in self.options.get(section) or {}:
+        if namespace not in configs:
+          raise ValueError("%s configured for %s, which is not replicated" % (section, namespace))
+    return dict(configs)
+
+  def _build_namespace(self, source, entries):
+    """
+    Builds the replicators applying one source namespace, on every apply lane
+    :param entries: list of (destination, namespace) replicating it
+    :return: dict of the callback to register for it ("callback"), the (destination, namespace, [one
+    Replicator per apply lane]) it writes to ("replicators"), the workers to close with it ("workers")
+    and the entries it was built from ("entries")
+    """
+    database, collection = source.split(".", 1)
+    replicators = [(dest, namespace, []) for dest, namespace in entries]
+    workers = []
+    lanes = []
+    spill = self.options.get("spill")
+    coalesce = self.options.get("coalesce") or {}
+    transform = self._transform(source)
+    for lane in xrange(self.lane_count):
+      aggregate_replicator = AggregateReplicator(self.source_id, self.source_uri, database, collection,
+        self.connections)
+      aggregate_replicator.metadata_mode = self.metadata_mode
+      aggregate_replicator.hash_algorithm = self.hash_algorithm
+      aggregate_replicator.raw_bson = self.raw_bson
+      aggregate_replicator.retry_policy = self.retry_policy
+      aggregate_replicator.conflict_policy = self.conflict_policy
+      aggregate_replicator.transform = transform
+      for dest, namespace, lane_replicators in replicators:
+        dest_database, dest_collection = namespace["dest"].split(".", 1)
+        replicator = Replicator(self.source_id, dest["id"], dest["uri"], dest_database, dest_collection,
+          self.connections)
+        replicator.writer = BulkWriter.from_config(dest)
+        replicator.retry_policy = self.retry_policy
+        replicator.conflict_policy = self.conflict_policy
+        replicator.checkpoints = self.checkpoints
+        replicator.position = self.checkpoints.load(dest["id"], namespace["dest"])
+        replicator.replay_until = self.checkpoints.replay_until(dest["id"], namespace["dest"])
+        lane_replicators.append(replicator)
+        if spill:
+          directory = os.path.join(spill["path"], self.source_id, dest["id"], namespace["dest"], str(lane))
+          replicator = SpillQueue(replicator, SpillLog(directory, int(spill.get("segment_bytes",
+            DEFAULT_SPILL_SEGMENT_BYTES))))
+          workers.append(replicator)
+        elif "scheduler" in dest:
+          replicator = self._scheduler(dest).handle(replicator, namespace.get("priority", PRIORITY_NORMAL))
+          workers.append(replicator)
+        elif dest.get("queue_size"):
+          replicator = DestinationQueue(replicator, int(dest["queue_size"]))
+          workers.append(replicator)
+        aggregate_replicator.register(replicator, source, dest.get("operations", "iud"))
+      callback = aggregate_replicator
+      if source in coalesce:
+        callback = CoalescingWindow.from_config(aggregate_replicator, self.source_id, source, MMM_METADATA,
+          coalesce[source] or {})
+        workers.append(callback)
+      lanes.append(callback)
+    if self.lane_count > 1:
+      callback = ApplyLanes(self.source_id, source, lanes, self.lane_queue_size)
+      workers.append(callback)
+    return {"callback": callback, "replicators": replicators, "workers": workers, "entries": entries}
+
+  def _transform(self, source):
+    """
+    :return: the DocumentTransform of a source namespace, None if it is replicated as it is
+    """
+    transforms = self.options.get("transforms") or {}
+    return DocumentTransform.from_config(transforms[source]) if source in transforms else None
+
+  def _scheduler(self, dest):
+    """
+    :return: the DestinationScheduler shared by the namespaces replicated to dest, a new one if its
+    settings changed
+    """
+    scheduler = self._schedulers.get(dest["id"])
+    if scheduler is None or scheduler.config != dest["scheduler"]:
+      if scheduler is not None:
+        scheduler.close()
+      scheduler = self._schedulers[dest["id"]] = DestinationScheduler.from_config(self.source_id, dest["id"],
+        dest["scheduler"])
+    return scheduler
+
+  def reconfigure(self, destinations):
+    """
+    Applies a changed `replications` config without restarting the oplog tailer. Between two ops, the
+    namespaces no longer replicated are flushed and dropped, those whose destinations changed are
+    flushed and rebuilt, and new ones are added. Other namespaces keep their replicators. The tailer
+    does not go back, so the destination queues of a namespace are drained before it is dropped.
+    :return: sorted list of the source namespaces that were added, rebuilt or dropped
+    """
+    configs = self._namespace_configs(destinations)
+    changed = sorted(source for source in set(configs) | set(self._namespaces)
+      if source not in self._namespaces or configs.get(source) != self._namespaces[source]["entries"])
+    with self.triggers.apply_lock:
+      for source in changed:
+        if source in self._namespaces:
+          log.info("Replication of %s from %s changed, flushing it", source, self.source_id)
+          self._drain_namespace(self._namespaces[source])
+          self.triggers.unregister(source, self._namespaces[source]["callback"])
+          self._close_namespace(self._namespaces.pop(source))
+        if source in configs:
+          log.info("Replicating %s from %s to %s", source, self.source_id,
+            ", ".join("%s/%s" % (dest["id"], namespace["dest"]) for dest, namespace in configs[source]))
+          self._namespaces[source] = self._build_namespace(source, configs[source])
+          self.triggers.register(source, "iud", self._namespaces[source]["callback"])
+      for destination_id, scheduler in self._schedulers.items():
+        if not scheduler.handles:
+          scheduler.close()
+          del self._schedulers[destination_id]
+    return changed
+
+  def _drain_namespace(self, replicated):
+    """
+    Hands every op of a namespace to its destinations and waits until they acknowledged them
+    """
+    if hasattr(replicated["callback"], "flush"):
+      replicated["callback"].flush()
+    # apply lanes and coalescing windows hand their ops to the destination queues, drain them first
+    for worker in reversed(replicated["workers"]):
+      if hasattr(worker, "drain"):
+        worker.drain()
+
+  def _close_namespace(self, replicated):
+    for worker in reversed(replicated["workers"]):
+      worker.close()
+
+  def _destination_replicators(self):
+    """
+    :return: (destination, namespace, [one Replicator per apply lane]) of every replicated namespace
+    """
+    for source in sorted(self._namespaces):
+      for entry in self._namespaces[source]["replicators"]:
+        yield entry
 
   def start(self, checkpoint=None):
-    gevent.spawn_link_exception(self.triggers.run)
+    """
+    :param checkpoint: optional oplog timestamp to replicate from, replication never starts after the
+    engine checkpoint or any destination's own position
+    :return: the greenlet replicating
+    """
+    return gevent.spawn_link_exception(self.run, checkpoint)
+
+  def run(self, checkpoint=None):
+    """
+    Replicates in the calling greenlet until stop() is called
+    :param checkpoint: see start()
+    """
+    # spilled ops are replayed from the spill logs, not from the oplog
+    positions = [] if self.options.get("spill") else [replicators[0].position
+      for _, _, replicators in self._destination_replicators()]
+    self.triggers.run(earliest(checkpoint, *positions))
+    # the ops handed over are applied before close() stops the workers
+    self.drain()
+    self.triggers.save_checkpoint()
+
+  def drain(self):
+    """
+    Waits until the destinations acknowledged every op handed to the replicated namespaces so far
+    """
+    with self.triggers.apply_lock:
+      for replicated in self._namespaces.values():
+        self._drain_namespace(replicated)
+
+  def initial_sync(self):
+    """
+    Copies the documents already in the source to every destination namespace that was never replicated
+    to, or whose initial sync was interrupted, before run() tails the oplog from where each copy began
+    :return: number of documents copied
+    """
+    from mmm.initial_sync import DEFAULT_SYNC_BATCH_SIZE, DEFAULT_SYNC_PARTITIONS, InitialSync
+    config = self.options.get("initial_sync") or {}
+    throttle = InitialSync.throttle_from_config(config)
+    copied = 0
+    for dest, namespace, replicators in self._destination_replicators():
+      sync = InitialSync(self.source_id, self.source_uri, dest["id"], dest["uri"], namespace["source"],
+        namespace["dest"], self.checkpoints, self.connections, int(config.get("partitions", DEFAULT_SYNC_PARTITIONS)),
+        int(config.get("batch_size", DEFAULT_SYNC_BATCH_SIZE)), throttle, self.hash_algorithm,
+        self._transform(namespace["source"]))
+      if sync.needed():
+        copied += sync.run()
+        for replicator in replicators:
+          replicator.position = self.checkpoints.load(dest["id"], namespace["dest"])
+          replicator.replay_until = self.checkpoints.replay_until(dest["id"], namespace["dest"])
+    return copied
+
+  def verify(self, repair=False):
+    """
+    Compares every destination namespace with its source, see mmm.verify
+    :param repair: True to apply the repairs to the destinations
+    :return: list of (destination id, destination namespace, repairs)
+    """
+    from mmm.verify import (DEFAULT_VERIFY_FANOUT, DEFAULT_VERIFY_LEAF_SIZE, DEFAULT_VERIFY_PARTITIONS, Verifier,
+      apply_repairs)
+    config = self.options.get("verify") or {}
+    # only inline metadata is stored in the source documents
+    stored_hashes = bool(config.get("stored_hashes", True)) and self.metadata_mode == METADATA_INLINE
+    results = []
+    for dest, namespace, _ in self._destination_replicators():
+      verifier = Verifier(self.source_id, self.source_uri, dest["id"], dest["uri"], namespace["source"],
+        namespace["dest"], self.connections, self.hash_algorithm,
+        int(config.get("partitions", DEFAULT_VERIFY_PARTITIONS)), int(config.get("fanout", DEFAULT_VERIFY_FANOUT)),
+        int(config.get("leaf_size", DEFAULT_VERIFY_LEAF_SIZE)), transform=self._transform(namespace["source"]),
+        stored_hashes=stored_hashes)
+      repairs = verifier.run()
+      if repair and repairs:
+        apply_repairs(self._repair_replicator(dest, namespace), repairs)
+      results.append((dest["id"], namespace["dest"], repairs))
+    return results
+
+  def _repair_replicator(self, dest, namespace):
+    """
+    :return: a Replicator applying verify repairs, without conflict policy so the source always wins
+    """
+    dest_database, dest_collection = namespace["dest"].split(".", 1)
+    replicator = Replicator(self.source_id, dest["id"], dest["uri"], dest_database, dest_collection,
+      self.connections)
+    replicator.writer = BulkWriter.from_config(dest)
+    replicator.retry_policy = self.retry_policy
+    return replicator
+
+  def stop(self):
+    """
+    Asks run() to return once the current oplog batch is applied and the checkpoint saved
+    """
+    self.triggers.stop()
+
+  def close(self):
+    """
+    Stops the workers of the apply lanes, coalescing windows and destination queues, call once run() returned
+    """
+    for replicated in self._namespaces.values():
+      self._close_namespace(replicated)
+    for scheduler in self._schedulers.values():
+      scheduler.close()
+    metrics.registry.remove(source=self.triggers.source_id)
 
   @staticmethod
   def get_replicated_collections(destinations):
@@ -54,147 +355,379 @@ class ReplicationEngine(object):
 
 
 def reconnect_on_error(func):
+  """
+  Retries the decorated method with the component's retry_policy after transient errors, reconnecting
+  before every retry. The method must be safe to call again after a partial failure.
+  """
   @wraps(func)
   def f(self, *args, **kwargs):
-    try:
-      func(self, *args, **kwargs)
-    except (AutoReconnect, OperationFailure):
-      log.warn("Connection to master failed at %s, sleeping for %s seconds before attempting to re-connect and retry...", self.destination_uri, RECONNECT_SLEEP_TIME)
-      gevent.sleep(RECONNECT_SLEEP_TIME)
-      try:
-        self.connect()
-      except Exception:
-        log.error("Unable to reconnect to master at %s, exiting", self.destination_uri, exc_info=1)
-        sys.exit(0)
-      else:
-        func(self, *args, **kwargs)
+    return self.retry_policy.call(lambda: func(self, *args, **kwargs), self.connect,
+      "%s on %s" % (func.__name__, self.uri))
   return f
 
-def ordered(obj):
-  if isinstance(obj, dict):
-    return sorted((k, ordered(v)) for k, v in obj.items())
-  if isinstance(obj, list):
-    return [ordered(x) for x in obj]
-  else:
-    return obj
+# where the origin metadata of a local write is recorded on the source
+METADATA_INLINE = "inline"            # written back into the source document (an extra, replicated write)
+METADATA_DESTINATION = "destination"  # only carried by the destination copies
+METADATA_SIDECAR = "sidecar"          # kept in the unreplicated local.mmm_metadata collection
+METADATA_MODES = (METADATA_INLINE, METADATA_DESTINATION, METADATA_SIDECAR)
+def conditional_query(query, condition):
+  """
+  :param condition: query condition returned by a conflict policy, or None
+  :return: query only matching the documents that also meet the condition
+  """
+  if not condition:
+    return query
+  if any(key in query for key in condition):
+    return {"$and": [query, condition]}
+  query = dict(query)
+  query.update(condition)
+  return query
 
-MMM_METADATA = '__mmm'
-MMM_TIMESTAMP = "source_ts"
-MMM_HASH = "hash"
-MMM_SKIP_OP = "__mmm_skip"
+# oplog entry fields consumed by AggregateReplicator.replicate
+OPLOG_FIELDS = ["ts", "h", "op", "ns", "o", "o2", "b", "v"]
 
 class Replicator(object):
   """
   Replicates insert/update/delete operations occurring locally to a single remote destination db/collection
   """
-  def __init__(self, source_id, destination_id, destination_uri, destination_database, destination_collection):
+  def __init__(self, source_id, destination_id, destination_uri, destination_database, destination_collection, connections=None):
     self.source_id = source_id
     self.destination_id = destination_id
-    self.destination_uri = destination_uri
+    self.destination_uri = self.uri = destination_uri
     self.destination_database = destination_database
     self.destination_collection = destination_collection
+    self.destination_namespace = "%s.%s" % (destination_database, destination_collection)
+    self.writer = BulkWriter()
+    # position up to which this destination acknowledged every op, and where it is persisted
+    self.position = None
+    self.checkpoints = None
+    # inserts up to this timestamp may find their document copied by an initial sync already
+    self.replay_until = None
+    self.retry_policy = RetryPolicy()
+    # see mmm.conflicts, None applies every write as it comes
+    self.conflict_policy = None
+    labels = dict(source=source_id, destination=destination_id, ns=self.destination_namespace)
+    self._write_latency = metrics.registry.histogram("destination_write_seconds", **labels)
+    self._writes = metrics.registry.counter("destination_writes", **labels)
+    self._conflicts = metrics.registry.counter("conflicts", **labels)
+    self._skipped = metrics.registry.counter("destination_writes_skipped", **labels)
+    # timestamp of the last op handed to the writer, so an op replayed by a retry is not buffered twice
+    self._last_buffered = None
+    self._flush_lock = Semaphore()
+    self._linger = None
+    self._linger_error = None
+    self.connections = connections or default_manager
+    self._generation = None
     self.connect()
 
   def connect(self):
-    self._connection = Connection(self.destination_uri)
+    # shared with every other component using the destination, reconnected once however many saw it fail
+    self._connection, self._generation = self.connections.connect(self.destination_uri, self._generation)
     self._collection = self._connection[self.destination_database][self.destination_collection]
+    self._write_commands = None
 
   def __call__(self, *args, **kwargs):
     return self.replicate(*args, **kwargs)
 
-  @reconnect_on_error
-  def replicate(self, op, ns, o, o2=None, b=False):
+  def replicate(self, op, ns, o, o2=None, b=False, ts=None):
+    self._raise_linger_error()
+    if ts is not None:
+      seen = latest(self.position, self._last_buffered)
+      if seen is not None and timestamp_key(ts) <= timestamp_key(seen):
+        log.debug('%s already has %s, skipping', self.destination_id, ts)
+        return
+      self._last_buffered = ts
     log.debug('%s <= %s: %s %s %s', self.destination_id, self.source_id, op, ns, o)
     if op == 'i':
-      self.insert(o)
+      self.insert(o, ts)
     elif op == 'u':
-      self.update(o2, o, b)
+      self.update(o2, o, b, ts)
     elif op == 'd':
-      self.delete(o)
-
-  def insert(self, document):
-    document[MMM_METADATA][self.destination_id] = document[MMM_METADATA][MMM_TIMESTAMP]
-    self._collection.insert(document)
+      self.delete(o, ts)
+
+  def insert(self, document, ts=None):
+    # the document is shared by every destination, copy what is specific to this one
+    document = self._with_own_metadata(document)
+    if self.conflict_policy is not None:
+      # an upsert fails on the _id of a document that won a conflict
+      condition = self.conflict_policy(document[MMM_METADATA])
+      self._buffer(WriteOp('c', conditional_query({"_id": document["_id"]}, condition), document, True, ts))
+    elif ts is not None and self.replay_until is not None and timestamp_key(ts) <= timestamp_key(self.replay_until):
+      self._buffer(WriteOp('u', {"_id": document["_id"]}, document, True, ts))
+    else:
+      self._buffer(WriteOp('i', None, document, False, ts))
 
-  def update(self, query_for_document, updated_document, is_upsert):
-    if any(k.startswith('$') for k in updated_document):
+  def update(self, query_for_document, updated_document, is_upsert, ts=None):
+    metadata = None
+    if not rawbson.is_raw(updated_document) and any(k.startswith('$') for k in updated_document):
       # With modifiers, check & update setters
-      setters = updated_document.setdefault('$set', {})
+      updated_document = dict(updated_document)
+      setters = updated_document['$set'] = dict(updated_document.get('$set', {}))
       if MMM_METADATA in setters:
+        metadata = setters[MMM_METADATA] = dict(setters[MMM_METADATA])
         setters[MMM_METADATA][self.destination_id] = setters[MMM_METADATA][MMM_TIMESTAMP]
     else:
       # Without modifiers, check & update the doc directly
-      updated_document[MMM_METADATA][self.destination_id] = updated_document[MMM_METADATA][MMM_TIMESTAMP]
+      updated_document = self._with_own_metadata(updated_document)
+      metadata = updated_document[MMM_METADATA]
 
-    self._collection.update(query_for_document, updated_document, is_upsert)
+    if self.conflict_policy is not None and metadata is not None:
+      # acknowledgements only set this master's timestamp and carry no metadata, they always apply
+      condition = self.conflict_policy(metadata)
+      self._buffer(WriteOp('c', conditional_query(query_for_document, condition), updated_document, is_upsert, ts))
+    else:
+      self._buffer(WriteOp('u', query_for_document, updated_document, is_upsert, ts))
 
-  def delete(self, document):
-    self._collection.remove(document)
+  def _with_own_metadata(self, document):
+    """
+    :return: a copy of a full document whose metadata records this destination as written
+    """
+    metadata = dict(document[MMM_METADATA])
+    metadata[self.destination_id] = metadata[MMM_TIMESTAMP]
+    if rawbson.is_raw(document):
+      return document.replace(metadata)
+    document = dict(document)
+    document[MMM_METADATA] = metadata
+    return document
+
+  def delete(self, document, ts=None):
+    self._buffer(WriteOp('d', document, document, False, ts))
+
+  def _buffer(self, write_op):
+    if self.writer.add(write_op):
+      self.flush()
+    elif self._linger is None:
+      self._linger = gevent.spawn_later(self.writer.linger_ms / 1000.0, self._flush_lingering)
+
+  def _flush_lingering(self):
+    self._linger = None
+    try:
+      self.flush()
+    except Exception as e:
+      # nothing waits for this greenlet, the next replicate() or flush() raises the error instead
+      log.error("Flushing the lingering writes to %s failed", self.destination_id, exc_info=1)
+      self._linger_error = e
+
+  def _raise_linger_error(self):
+    error, self._linger_error = self._linger_error, None
+    if error is not None:
+      raise error
+
+  def flush(self):
+    """
+    Applies all buffered writes to the destination, returning once they are acknowledged
+    :raise: the error a flush of lingering writes failed with since the last call, if any
+    """
+    self._raise_linger_error()
+    self._flush()
+
+  @reconnect_on_error
+  def _flush(self):
+    with self._flush_lock:
+      if not len(self.writer):
+        return
+      if self._write_commands is None and len(self.writer) > 1:
+        self._write_commands = supports_write_commands(self._connection)
+      buffered = len(self.writer)
+      conflicts = self.writer.conflicts
+      try:
+        with self._write_latency.time():
+          self.writer.write(self._collection, bool(self._write_commands))
+      finally:
+        self._writes.inc(buffered - len(self.writer))
+        self._conflicts.inc(self.writer.conflicts - conflicts)
+
+  def skip_failed(self, error):
+    """
+    Drops the buffered write a fatal error was raised for, so the writes after it can be applied
+    :return: True if a buffered write was dropped, False if error was not raised for one
+    """
+    if not isinstance(error, BulkWriteError):
+      return False
+    with self._flush_lock:
+      if not self.writer.drop(error.write_op):
+        return False
+    self._skipped.inc()
+    return True
+
+  def handle_failure(self, error):
+    """
+    Decides what a worker applying ops to this destination does once replicate() or flush() raised error.
+    The replicator already made its retries, a destination that is down is waited for however long it takes.
+    :return: True if the failed write stays buffered to be retried, False if it was skipped
+    :raise: error, if it is fatal and no buffered write can be skipped for it, the worker must stop
+    """
+    if self.retry_policy.retryable(error, 0):
+      log.error("Replication to %s failed, it will be retried", self.destination_id, exc_info=1)
+      return True
+    if not self.skip_failed(error):
+      log.error("Replication to %s failed with a fatal error, stopping", self.destination_id, exc_info=1)
+      raise error
+    log.error("Replication to %s failed with a fatal error, skipping the write", self.destination_id, exc_info=1)
+    return False
+
+  def oldest_pending(self):
+    """
+    :return: oplog timestamp of the oldest write not yet acknowledged by the destination, or None
+    """
+    return self.writer.oldest_pending()
+
+  def save_positions(self, last_applied):
+    """
+    Persists how far this destination got, given that every op up to last_applied was handed to it
+    """
+    pending = self.oldest_pending()
+    self.save_position(earliest(previous_timestamp(pending), last_applied) if pending is not None else last_applied)
+
+  def save_position(self, position):
+    """
+    Persists position as this destination's resume point, unless it is behind the current one
+    """
+    position = latest(position, self.position)
+    if position is None or position == self.position:
+      return
+    self.position = position
+    if self.checkpoints is not None:
+      self.checkpoints.save(self.destination_id, self.destination_namespace, position)
 
 class AggregateReplicator(object):
   """
   Handles replication of insert/update/delete operations to multiple destinations for a single collection
+
+  metadata_mode decides how a local write is marked as originating here. Loop prevention relies on the
+  metadata carried by the destination copies, whose hash matches what they replicated, so
+  METADATA_DESTINATION and METADATA_SIDECAR avoid rewriting the source document, and the extra oplog entry
+  and acknowledgement that rewrite causes. The sidecar only records the origin of local writes for
+  inspection, loop detection never reads it.
+
+  hash_algorithm is used for the hashes this node stores; stored hashes of any algorithm are recognized.
   """
 
-  def __init__(self, source_id, uri, database, collection):
+  def __init__(self, source_id, uri, database, collection, connections=None):
     log.info("Creating aggregate replicator for %s.%s", database, collection)
     self.source_id = source_id
     self.uri = uri
     self.database = database
     self.collection = collection
+    self.metadata_mode = METADATA_INLINE
+    self.hash_algorithm = HASH_LEGACY
+    # write full documents as a RawDocument encoded once, see mmm.rawbson
+    self.raw_bson = False
+    self.retry_policy = RetryPolicy()
+    # see mmm.conflicts, applied to the metadata written back into source documents
+    self.conflict_policy = None
+    self._conflicts = metrics.registry.counter("conflicts", source=source_id, ns="%s.%s" % (database, collection))
+    # see mmm.transforms, what of each document and update is replicated
+    self.transform = None
     self._replicators = defaultdict(list)
+    self.connections = connections or default_manager
+    self._generation = None
     self.connect()
 
   def connect(self):
-    self._connection = Connection(self.uri)
+    self._connection, self._generation = self.connections.connect(self.uri, self._generation)
     self._collection = self._connection[self.database][self.collection]
+    # the local database is not replicated, so writes to it never show up in the oplog
+    self._sidecar = self._connection.local.mmm_metadata
 
   def __call__(self, *args, **kwargs):
     return self.replicate(*args, **kwargs)
 
-  @reconnect_on_error
+  def apply_op(self, op):
+    """
+    :param op: OplogOp, as handed over by Triggers
+    """
+    return self.replicate(op.ts, op.h, op.op, op.ns, op.o, op.o2, op.get('b', False), op.v)
+
   def replicate(self, ts, h, op, ns, o, o2=None, b=False, v=None):
     log.debug('Aggregate replicator processing: %s: %s %s %s, ts: %s', self.source_id, op, ns, o, ts)
     if o.get(MMM_SKIP_OP, False):
       log.debug("skipping internal operation")
       return
+    # the destinations get the transformed form, loop detection and its hash are based on it too
+    replicated = o
+    if self.transform is not None and op != 'd':
+      replicated = self.transform.apply(o)
+      if replicated is None:
+        log.debug("no replicated field is updated, skipping")
+        return
+    # loop detection may need the document's hash more than once, compute it at most once
+    digest = DocumentDigest(replicated, self.hash_algorithm, MMM_METADATA)
     if op == 'i':
-      if AggregateReplicator.is_local_replication(o):
-        self.ack_replication(o[MMM_METADATA], {"_id": o["_id"]}, ns)
+      if AggregateReplicator.is_local_replication(replicated, digest=digest, legacy=self.metadata_mode == METADATA_INLINE):
+        self.ack_replication(o[MMM_METADATA], {"_id": o["_id"]}, ns, ts)
       else:
-        self.replicate_local_write(o, {"_id": o["_id"]}, op, ns)
+        self.replicate_local_write(o, {"_id": o["_id"]}, op, ns, ts=ts, digest=digest, replicated=replicated)
     elif op == 'u':
-      is_set_query = "$set" in o
+      is_set_query = "$set" in replicated
       if MMM_METADATA in o and type(o[MMM_METADATA]) is not dict:
-        # old record - make sure we overwrite the metadata completely
-        del o[MMM_METADATA]
-      if AggregateReplicator.is_local_replication(o, is_set_query):
-        self.ack_replication((o["$set"][MMM_METADATA] if is_set_query else o[MMM_METADATA]), o2, ns)
-      elif not AggregateReplicator.is_remote_metadata_update(o):
-        self.replicate_local_write(o, o2, op, ns, is_set_query)
+        # old record - make sure we overwrite the metadata completely, without changing the shared oplog entry
+        o = dict((k, v) for k, v in o.iteritems() if k != MMM_METADATA)
+        replicated = dict((k, v) for k, v in replicated.iteritems() if k != MMM_METADATA)
+      if AggregateReplicator.is_local_replication(replicated, is_set_query, digest, self.metadata_mode == METADATA_INLINE):
+        self.ack_replication((o["$set"][MMM_METADATA] if is_set_query else o[MMM_METADATA]), o2, ns, ts)
+      elif not AggregateReplicator.is_remote_metadata_update(replicated):
+        self.replicate_local_write(o, o2, op, ns, is_set_query, ts, digest, replicated)
     elif op == 'd':
-      self.replicate_all(op, ns, o, o2, b)
+      self.replicate_all(op, ns, o, o2, b, ts)
 
-  def replicate_all(self, op, ns, o, o2, b=False):
+  def replicate_all(self, op, ns, o, o2, b=False, ts=None):
     for replicator in self._replicators.get((ns, op), []):
-      replicator.replicate(op, ns, o, o2, b)
+      replicator.replicate(op, ns, o, o2, b, ts)
 
   def register(self, replicator, namespace, operations):
     for op in operations:
       self._replicators[(namespace, op)].append(replicator)
 
-  def ack_replication(self, metadata, object_id, ns):
+  def replicates_deletes(self, namespace):
+    """
+    :return: True if every destination that gets the inserts and updates of namespace gets its deletes too
+    """
+    deleting = self._replicators.get((namespace, 'd'), [])
+    return all(any(replicator is other for other in deleting)
+      for op in ('i', 'u') for replicator in self._replicators.get((namespace, op), []))
+
+  def _unique_replicators(self):
+    seen = set()
+    for replicators in self._replicators.values():
+      for replicator in replicators:
+        if id(replicator) not in seen:
+          seen.add(id(replicator))
+          yield replicator
+
+  def flush(self):
+    """
+    Flushes the buffered writes of every destination
+    """
+    for replicator in self._unique_replicators():
+      replicator.flush()
+
+  def oldest_pending(self):
+    """
+    :return: oplog timestamp of the oldest op some destination has not acknowledged yet, or None
+    """
+    return earliest(*[replicator.oldest_pending() for replicator in self._unique_replicators()])
+
+  def save_positions(self, last_applied):
+    """
+    Persists the position of every destination, given that every op up to last_applied was handed over
+    """
+    for replicator in self._unique_replicators():
+      replicator.save_positions(last_applied)
+
+  def ack_replication(self, metadata, object_id, ns, ts=None):
     """
     Sends an acknowledgement of successful replication to all destinations
     :param metadata: dict representation of the MMM metadata field for the modified object
     :param object_id: ID of the modified object
     :param ns: namespace
+    :param ts: oplog timestamp of the replicated operation
     """
     if self.source_id in metadata:
       timestamp = metadata[MMM_TIMESTAMP]
-      self.replicate_all("u", ns, {"$set": {MMM_METADATA + "." + self.source_id: timestamp}}, object_id)
+      self.replicate_all("u", ns, {"$set": {MMM_METADATA + "." + self.source_id: timestamp}}, object_id, ts=ts)
 
-  def replicate_local_write(self, o, object_id, op, ns, is_set_query=False):
+  def replicate_local_write(self, o, object_id, op, ns, is_set_query=False, ts=None, digest=None, replicated=None):
     """
     Replicates a local insert or update to all other nodes
     :param o: The object passed to a mongo insert/update query
@@ -202,20 +735,75 @@ class AggregateReplicator(object):
     :param op: The operation ("i" or "u")
     :param ns: namespace
     :param is_set_query: True if this query used the $set operator
+    :param ts: oplog timestamp of the operation
+    :param digest: DocumentDigest of replicated, if it was already created
+    :param replicated: what of o the destinations get, see mmm.transforms, o itself by default
     """
+    replicated = o if replicated is None else replicated
+    digest = digest or DocumentDigest(replicated, self.hash_algorithm, MMM_METADATA)
     timestamp = AggregateReplicator.timestamp()
     metadata = {
         "source": self.source_id,
          MMM_TIMESTAMP: timestamp,
          self.source_id: timestamp,
-         MMM_HASH: AggregateReplicator.hash(o)
+         MMM_HASH: digest.hexdigest()
       }
-    if is_set_query:
+    if not any(k.startswith('$') for k in replicated):
+      metadata[MMM_WHOLE] = True
+    written = self._with_metadata(o, metadata)
+    replicated = written if replicated is o else self._with_metadata(replicated, metadata)
+    if self.metadata_mode == METADATA_INLINE:
+      # the source keeps the whole document, with the hash of what the destinations get
+      if self.conflict_policy is None:
+        self._write_back(object_id, written)
+      else:
+        # a replicated write applied since may have won, destinations then drop this write as well. Only
+        # an acknowledged update tells whether it matched.
+        result = self._write_back(conditional_query(object_id, self.conflict_policy(metadata)), written, w=1)
+        if isinstance(result, dict) and not result.get("n"):
+          self._conflicts.inc()
+    elif self.metadata_mode == METADATA_SIDECAR:
+      self.record_metadata(ns, object_id, metadata)
+    self.replicate_all(op, ns, replicated, object_id, ts=ts)
+
+  @reconnect_on_error
+  def _write_back(self, query, document, **kwargs):
+    """
+    Writes a local write's metadata back into the source document. Only the source writes are retried here,
+    destination writes are retried by each Replicator's flush().
+    """
+    if rawbson.is_raw(document):
+      return rawbson.update(self._collection, query, document, **kwargs)
+    return self._collection.update(query, document, **kwargs)
+
+  def _with_metadata(self, o, metadata):
+    """
+    :return: a copy of o carrying the metadata, in its $set if o is an update with modifiers
+    """
+    # leave the oplog document untouched, replicate() is retried with it after a failure
+    if any(k.startswith('$') for k in o):
+      o = dict(o)
+      o["$set"] = dict(o.get("$set") or {})
       o["$set"][MMM_METADATA] = metadata
+    elif self.raw_bson:
+      # encoded once for the source and every destination, which only encode their own metadata
+      o = rawbson.RawDocument.encode(o, MMM_METADATA, metadata)
     else:
+      o = dict(o)
       o[MMM_METADATA] = metadata
-    self._collection.update(object_id, o)
-    self.replicate_all(op, ns, o, object_id)
+    return o
+
+  @reconnect_on_error
+  def record_metadata(self, ns, object_id, metadata):
+    """
+    Records the origin of a local write in the sidecar collection instead of the source document
+    :param ns: namespace
+    :param object_id: ID of the modified object
+    :param metadata: the MMM metadata sent to the destinations
+    """
+    self._sidecar.update({"_id": SON([("ns", ns), ("_id", object_id["_id"])])},
+      {"$set": {"source": metadata["source"], MMM_TIMESTAMP: metadata[MMM_TIMESTAMP], MMM_HASH: metadata[MMM_HASH]}},
+      upsert=True)
 
   @staticmethod
   def timestamp():
@@ -233,10 +821,14 @@ class AggregateReplicator(object):
     return "$set" in o and any(k.startswith(MMM_METADATA + ".") for k in o["$set"])
 
   @staticmethod
-  def is_local_replication(o, is_set_query=False):
+  def is_local_replication(o, is_set_query=False, digest=None, legacy=True):
     """
     :param o: The object passed to a mongo insert/update query
     :param is_set_query: True if the query uses the $set operation
+    :param digest: DocumentDigest of o, if it was already created
+    :param legacy: True if a document whose metadata has no hash is a replication by a release before
+    hashes. Without the write-back, source documents only carry the acknowledgements of the destinations,
+    which application writes copy along, so only a matching hash tells a replication.
     :return: True if a query is a local replication of an update originating at another master node
     """
     metadata_in_doc = MMM_METADATA in o
@@ -244,17 +836,15 @@ class AggregateReplicator(object):
       # The hash is used to discriminate between application based updates
       # that have MMM metadata present, and replications by this process.
       # Application-based updates won't have hashes that match the updated document
-      return AggregateReplicator.hash(o) == o[MMM_METADATA][MMM_HASH]
-    return metadata_in_doc or (is_set_query and MMM_METADATA in o["$set"])
+      digest = digest or DocumentDigest(o, exclude=MMM_METADATA)
+      return digest.matches(o[MMM_METADATA][MMM_HASH])
+    return (metadata_in_doc and legacy) or (is_set_query and MMM_METADATA in o["$set"])
 
   @staticmethod
-  def hash(to_hash):
+  def hash(to_hash, algorithm=HASH_LEGACY):
     """
     :param to_hash: dictionary to generate a hash code for
+    :param algorithm: one of mmm.hashing.HASH_ALGORITHMS
     :return: a hash code for the dictionary, excluding the MMM_METADATA field
     """
-    # Don't include the MMM_METADATA field in the hash, copy to avoid deleting it in the
-    # original dict
-    without_mmm = dict([(k, v) for k, v in to_hash.iteritems()
-      if k != MMM_METADATA])
-    return hashlib.md5(dumps(ordered(without_mmm))).hexdigest()
\ No newline at end of file
+    return hash_document(to_hash, algorithm, MMM_METADATA)
\ No newline at end of file
@@ -0,0 +1,119 @@
+import gevent
+import logging
+from pymongo.errors import ConnectionFailure, OperationFailure
+import random
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RETRY_INITIAL_MS = 50
+DEFAULT_RETRY_MAX_MS = 30000
+DEFAULT_RETRY_MULTIPLIER = 2.0
+DEFAULT_RETRY_JITTER = 0.5
+DEFAULT_RETRY_ATTEMPTS = 20
+# server error codes raised while a replica set fails over, a node shuts down or a write concern times out
+TRANSIENT_ERROR_CODES = frozenset([
+  6,      # HostUnreachable
+  7,      # HostNotFound
+  64,     # WriteConcernFailed
+  89,     # NetworkTimeout
+  91,     # ShutdownInProgress
+  189,    # PrimarySteppedDown
+  9001,   # SocketException
+  10107,  # NotMaster
+  11600,  # InterruptedAtShutdown
+  11602,  # InterruptedDueToReplStateChange
+  13435,  # NotMasterNoSlaveOk
+  13436,  # NotMasterOrSecondary
+])
+
+def is_transient(error):
+  """
+  :param error: an exception raised by pymongo
+  :return: True if retrying the operation may succeed, e.g. once an election is over
+  """
+  if isinstance(error, ConnectionFailure):
+    return True
+  if isinstance(error, OperationFailure):
+    if error.code is not None:
+      return error.code in TRANSIENT_ERROR_CODES
+    return "not master" in str(error)
+  return False
+
+class RetryPolicy(object):
+  """
+  Jittered exponential backoff for operations that failed with a transient error.
+
+  The n-th retry waits between (1 - jitter) and 1 times min(initial_ms * multiplier ** n, max_ms), so
+  an election is ridden out within milliseconds to seconds and many failing components don't
+  reconnect in lockstep. Fatal errors, and transient ones once `attempts` retries were made, are raised.
+  """
+
+  def __init__(self, initial_ms=DEFAULT_RETRY_INITIAL_MS, max_ms=DEFAULT_RETRY_MAX_MS,
+      multiplier=DEFAULT_RETRY_MULTIPLIER, jitter=DEFAULT_RETRY_JITTER, attempts=DEFAULT_RETRY_ATTEMPTS,
+      sleep=gevent.sleep, random=random.random):
+    if initial_ms <= 0 or max_ms < initial_ms:
+      raise ValueError("retry needs 0 < initial_ms <= max_ms, got %r and %r" % (initial_ms, max_ms))
+    if multiplier < 1:
+      raise ValueError("retry multiplier must be at least 1, got %r" % multiplier)
+    if not 0 <= jitter <= 1:
+      raise ValueError("retry jitter must be between 0 and 1, got %r" % jitter)
+    self.initial_ms = initial_ms
+    self.max_ms = max_ms
+    self.multiplier = multiplier
+    self.jitter = jitter
+    self.attempts = attempts
+    self._sleep = sleep
+    self._random = random
+
+  @classmethod
+  def from_config(cls, config):
+    """
+    :param config: the optional `retry` section of the master config, e.g. {"initial_ms": 10, "attempts": 5}
+    :return: a RetryPolicy, using defaults for missing settings
+    """
+    config = config or {}
+    return cls(int(config.get("initial_ms", DEFAULT_RETRY_INITIAL_MS)),
+        int(config.get("max_ms", DEFAULT_RETRY_MAX_MS)),
+        float(config.get("multiplier", DEFAULT_RETRY_MULTIPLIER)),
+        float(config.get("jitter", DEFAULT_RETRY_JITTER)),
+        int(config.get("attempts", DEFAULT_RETRY_ATTEMPTS)))
+
+  def delay(self, attempt):
+    """
+    :param attempt: number of retries made so far
+    :return: seconds to wait before the next retry
+    """
+    ceiling = min(self.initial_ms * self.multiplier ** attempt, self.max_ms)
+    return ceiling * (1 - self.jitter * self._random()) / 1000.0
+
+  def retryable(self, error, attempt):
+    """
+    :return: True if the operation that raised error should be retried after attempt retries
+    """
+    return attempt < self.attempts and is_transient(error)
+
+  def wait(self, error, attempt, description):
+    """
+    Sleeps before retry number attempt + 1
+    """
+    delay = self.delay(attempt)
+    log.warn("%s failed (%s), retrying in %.3f seconds", description, error, delay)
+    self._sleep(delay)
+
+  def call(self, func, recover=None, description="operation"):
+    """
+    Calls func until it succeeds, calling recover (e.g. a reconnect) before every retry
+    :return: what func returned
+    :raise: the last error, if it is fatal or the attempts are exhausted
+    """
+    attempt = 0
+    while True:
+      try:
+        if attempt and recover is not None:
+          recover()
+        return func()
+      except Exception as e:
+        if not self.retryable(e, attempt):
+          raise
+        self.wait(e, attempt, description)
+        attempt += 1
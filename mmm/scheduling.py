@@ -0,0 +1,242 @@
+"""
+Priority scheduling and rate limiting of the writes to one destination.
+
+A destination with a `scheduler` section gets one DestinationScheduler shared by every namespace (and
+apply lane) replicated to it. Each namespace replicator hands its ops to the scheduler through a
+ScheduledReplicator, which queues them in the priority class of the namespace (`priority` on its
+`namespaces` entry: 'high', 'normal' or 'low'). A single greenlet drains the queues, always from the
+highest class that has ops, and passes them on within the destination's `ops_per_second` and
+`bytes_per_second` token buckets. So a backfill of a low priority collection neither delays the ops of
+high priority collections behind it nor saturates the link to the destination.
+
+Each class queues at most `queue_size` ops before the replicator handing it more waits, which applies
+backpressure to Triggers. The ops of one namespace replicator stay in order, and the checkpoint never
+advances past the oldest op still queued. The time ops of each class wait is observed in the
+`scheduler_wait_seconds` histogram. Failed writes are handled as by a DestinationQueue: an error
+Replicator.handle_failure() cannot skip stops the ScheduledReplicator, and is raised by its next replicate(),
+flush() or drain().
+"""
+from collections import deque
+import gevent
+import gevent.event
+try:
+  from gevent.lock import Semaphore
+except ImportError: # gevent < 1.0
+  from gevent.coros import Semaphore
+import logging
+import time
+
+from mmm import metrics
+from mmm.checkpoint import earliest, previous_timestamp
+from mmm.rawbson import encoded_size
+from mmm.throttle import TokenBucket
+
+log = logging.getLogger(__name__)
+
+PRIORITY_HIGH = "high"
+PRIORITY_NORMAL = "normal"
+PRIORITY_LOW = "low"
+# drained in this order
+PRIORITY_CLASSES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+DEFAULT_SCHEDULER_QUEUE_SIZE = 10000
+RETRY_SLEEP_TIME = 1
+DRAIN_SLEEP_TIME = 0.01
+
+def op_bytes(o, o2=None):
+  """
+  :return: BSON size of an op's document and query, what writing it sends to the destination
+  """
+  size = 0
+  for document in (o, o2):
+    if document is not None:
+      size += encoded_size(document)
+  return size
+
+class DestinationScheduler(object):
+  """
+  Passes the ops of every namespace replicated to one destination on by priority class, within its
+  rate limits, see the module documentation
+  """
+
+  def __init__(self, source_id, destination_id, maxsize=DEFAULT_SCHEDULER_QUEUE_SIZE, ops_per_second=None,
+      bytes_per_second=None):
+    """
+    :param maxsize: ops queued per priority class before handing over more blocks
+    """
+    self.source_id = source_id
+    self.destination_id = destination_id
+    # the settings it was built from, see from_config()
+    self.config = None
+    # optional TokenBuckets, units are ops and bytes
+    self.ops_limit = TokenBucket(ops_per_second) if ops_per_second else None
+    self.bytes_limit = TokenBucket(bytes_per_second) if bytes_per_second else None
+    # (ScheduledReplicator, replicate() arguments, enqueue time) per class
+    self._queues = dict((priority, deque()) for priority in PRIORITY_CLASSES)
+    self._capacity = dict((priority, Semaphore(maxsize)) for priority in PRIORITY_CLASSES)
+    self._ready = gevent.event.Event()
+    self._worker = None
+    self.handles = []
+    self._wait = {}
+    for priority in PRIORITY_CLASSES:
+      labels = dict(source=source_id, destination=destination_id, priority=priority)
+      self._wait[priority] = metrics.registry.histogram("scheduler_wait_seconds", **labels)
+      metrics.registry.gauge("scheduler_depth", self._queues[priority].__len__, **labels)
+
+  @classmethod
+  def from_config(cls, source_id, destination_id, config):
+    """
+    :param config: the `scheduler` section of a `replications` entry
+    """
+    settings = config or {}
+    scheduler = cls(source_id, destination_id, int(settings.get("queue_size", DEFAULT_SCHEDULER_QUEUE_SIZE)),
+      settings.get("ops_per_second"), settings.get("bytes_per_second"))
+    scheduler.config = config
+    return scheduler
+
+  def handle(self, replicator, priority=PRIORITY_NORMAL):
+    """
+    :return: a ScheduledReplicator queueing the ops of replicator in the priority class
+    """
+    if priority not in PRIORITY_CLASSES:
+      raise ValueError("priority must be one of %s, got %r" % (", ".join(PRIORITY_CLASSES), priority))
+    handle = ScheduledReplicator(self, replicator, priority)
+    self.handles.append(handle)
+    return handle
+
+  def put(self, handle, args):
+    if self._worker is None:
+      self._worker = gevent.spawn(self._run)
+    capacity = self._capacity[handle.priority]
+    if capacity.locked():
+      log.debug("%s queue for %s is full, waiting for it to drain", handle.priority, self.destination_id)
+    capacity.acquire()
+    self._queues[handle.priority].append((handle, args, time.time()))
+    self._ready.set()
+
+  def _next(self):
+    for priority in PRIORITY_CLASSES:
+      if self._queues[priority]:
+        self._capacity[priority].release()
+        return self._queues[priority].popleft()
+    return None
+
+  def _run(self):
+    while True:
+      self._ready.wait()
+      entry = self._next()
+      if entry is None:
+        self._ready.clear()
+        continue
+      handle, args, queued_at = entry
+      if self.ops_limit is not None:
+        self.ops_limit.acquire()
+      if self.bytes_limit is not None:
+        self.bytes_limit.acquire(op_bytes(args[2], args[3]))
+      self._wait[handle.priority].observe(time.time() - queued_at)
+      handle.deliver(args)
+
+  def remove(self, handle):
+    """
+    Drops the queued ops of a closed handle
+    """
+    if handle in self.handles:
+      self.handles.remove(handle)
+    queue = self._queues[handle.priority]
+    kept = [entry for entry in queue if entry[0] is not handle]
+    for _ in xrange(len(queue) - len(kept)):
+      self._capacity[handle.priority].release()
+    queue.clear()
+    queue.extend(kept)
+
+  def close(self):
+    if self._worker is not None:
+      self._worker.kill()
+      self._worker = None
+
+class ScheduledReplicator(object):
+  """
+  Hands the ops of one Replicator to its destination's DestinationScheduler, the counterpart of
+  DestinationQueue for scheduled destinations
+  """
+
+  def __init__(self, scheduler, replicator, priority):
+    self.scheduler = scheduler
+    self.replicator = replicator
+    self.priority = priority
+    self.destination_id = replicator.destination_id
+    # oplog timestamps of the ops queued but not yet passed to the replicator
+    self._pending = deque()
+    # the error that stopped passing ops on
+    self._error = None
+
+  def __call__(self, *args, **kwargs):
+    return self.replicate(*args, **kwargs)
+
+  def replicate(self, op, ns, o, o2=None, b=False, ts=None):
+    self._raise_error()
+    self._pending.append(ts)
+    self.scheduler.put(self, (op, ns, o, o2, b, ts))
+
+  def deliver(self, args):
+    """
+    Passes a scheduled op to the replicator, flushing it once none of its ops are queued
+    """
+    if self._error is not None:
+      # stopped, the op stays pending
+      return
+    try:
+      try:
+        self.replicator.replicate(*args)
+        if len(self._pending) == 1:
+          self.replicator.flush()
+      except Exception as e:
+        self.replicator.handle_failure(e)
+      # applied, buffered in the replicator or skipped
+      self._pending.popleft()
+      # a failed write stays buffered in the replicator, retry it before passing on anything newer
+      while self.replicator.oldest_pending() is not None and not self._pending:
+        gevent.sleep(RETRY_SLEEP_TIME)
+        try:
+          self.replicator.flush()
+        except Exception as e:
+          self.replicator.handle_failure(e)
+    except Exception as e:
+      self._error = e
+
+  def _raise_error(self):
+    if self._error is not None:
+      raise self._error
+
+  def flush(self):
+    """
+    Does not wait for the destination, the scheduler flushes whenever no op of this replicator is queued.
+    Triggers learns how far this destination got through oldest_pending(). Raises the error that stopped
+    passing ops on.
+    """
+    self._raise_error()
+
+  def drain(self):
+    """
+    Waits until the destination acknowledged every op handed over, before the handle is closed
+    """
+    while self.oldest_pending() is not None:
+      self._raise_error()
+      gevent.sleep(DRAIN_SLEEP_TIME)
+
+  def oldest_pending(self):
+    """
+    :return: oplog timestamp of the oldest op this destination has not acknowledged, or None
+    """
+    return earliest(self.replicator.oldest_pending(), self._pending[0] if self._pending else None)
+
+  def save_positions(self, last_applied):
+    """
+    Persists how far this destination got, given that every op up to last_applied was queued for it
+    """
+    pending = self.oldest_pending()
+    self.replicator.save_position(earliest(previous_timestamp(pending), last_applied) if pending is not None
+      else last_applied)
+
+  def close(self):
+    self.scheduler.remove(self)
+    self._pending.clear()
@@ -0,0 +1,296 @@
+"""
+Durable spill log between the oplog reader and a destination.
+
+A SpillLog is an append-only log of BSON records in memory-mapped segment files. Segments are
+preallocated to `segment_bytes` and filled with records back to back; the first zero length marks the end
+of a segment. The single reader keeps its position in a cursor file, and once it moved past a segment
+that segment is deleted, which is all the compaction an append-only log with one reader needs.
+
+A SpillQueue appends every op for its Replicator to a SpillLog and applies them from there in its own
+greenlet. Triggers only waits for the log to be synced to disk, so the source checkpoint advances while the
+destination is down, however long the outage: replication resumes from the log, not from the source oplog.
+Failed records are retried or skipped by Replicator.handle_failure(); an error it cannot skip stops the
+SpillQueue and is raised by its next replicate() or flush().
+"""
+import bson
+import errno
+import gevent
+import gevent.event
+import json
+import logging
+import mmap
+import os
+import struct
+
+from mmm import metrics, rawbson
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SPILL_SEGMENT_BYTES = 64 * 1024 * 1024
+SEGMENT_SUFFIX = ".spill"
+CURSOR_FILE = "cursor"
+RETRY_SLEEP_TIME = 1
+
+def _segment_name(number):
+  return "%016d%s" % (number, SEGMENT_SUFFIX)
+
+class SpillLog(object):
+  """
+  Append-only record log in a directory of memory-mapped segments, see the module documentation.
+  Positions are (segment number, offset) tuples.
+  """
+
+  def __init__(self, directory, segment_bytes=DEFAULT_SPILL_SEGMENT_BYTES):
+    self.directory = directory
+    self.segment_bytes = segment_bytes
+    try:
+      os.makedirs(directory)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+    self._maps = {}
+    self._dirty = set()
+    # a new segment file is only durable once the directory entry is
+    self._created = False
+    numbers = self._segments()
+    self.cursor = self._load_cursor() or ((numbers[0] if numbers else 0), 0)
+    if numbers:
+      self.end = (numbers[-1], self._recover(numbers[-1]))
+    else:
+      self._create(self.cursor[0], segment_bytes)
+      self.end = (self.cursor[0], 0)
+
+  def _segments(self):
+    return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+
+  def _path(self, name):
+    return os.path.join(self.directory, name)
+
+  def _create(self, number, size):
+    with open(self._path(_segment_name(number)), "w+b") as segment:
+      segment.truncate(size)
+    self._created = True
+    return self._map(number)
+
+  def _map(self, number):
+    if number not in self._maps:
+      with open(self._path(_segment_name(number)), "r+b") as segment:
+        self._maps[number] = mmap.mmap(segment.fileno(), 0)
+    return self._maps[number]
+
+  def _record_at(self, segment, offset):
+    """
+    :return: the BSON record at offset, None at the end of the segment or at a torn write
+    """
+    if offset + 4 > len(segment):
+      return None
+    length = struct.unpack("<i", segment[offset:offset + 4])[0]
+    if length < 5 or offset + length > len(segment) or segment[offset + length - 1] != "\x00":
+      return None
+    return segment[offset:offset + length]
+
+  def _recover(self, number):
+    """
+    :return: offset of the end of the last segment, after the last complete record
+    """
+    segment = self._map(number)
+    offset = 0
+    while True:
+      record = self._record_at(segment, offset)
+      if record is None:
+        break
+      try:
+        bson.BSON(record).decode()
+      except Exception:
+        break
+      offset += len(record)
+    if offset < len(segment) and segment[offset:offset + 4] != "\x00" * 4:
+      log.warn("Discarding a partially written record at %s of %s", offset, _segment_name(number))
+      segment[offset:offset + 4] = "\x00" * 4
+    return offset
+
+  def _load_cursor(self):
+    try:
+      with open(self._path(CURSOR_FILE)) as cursor:
+        return tuple(json.load(cursor))
+    except IOError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      return None
+
+  def append(self, document):
+    """
+    Appends a record, durable once sync() returns
+    :return: position after the record
+    """
+    record = rawbson.encode(document)
+    number, offset = self.end
+    segment = self._maps[number]
+    if offset + len(record) + 4 > len(segment):
+      number, offset = number + 1, 0
+      segment = self._create(number, max(self.segment_bytes, len(record) + 4))
+    segment[offset:offset + len(record)] = record
+    self._dirty.add(number)
+    self.end = (number, offset + len(record))
+    return self.end
+
+  def read(self, position):
+    """
+    :return: (record, position after it), or None if position is the end of the log
+    """
+    while position != self.end:
+      number, offset = position
+      record = self._record_at(self._map(number), offset)
+      if record is not None:
+        return bson.BSON(record).decode(), (number, offset + len(record))
+      position = (number + 1, 0)
+    return None
+
+  def sync(self):
+    """
+    Writes every appended record to disk
+    """
+    for number in sorted(self._dirty):
+      if number in self._maps:
+        self._maps[number].flush()
+    self._dirty.clear()
+    if self._created:
+      directory = os.open(self.directory, os.O_RDONLY)
+      try:
+        os.fsync(directory)
+      finally:
+        os.close(directory)
+      self._created = False
+
+  def commit(self, position):
+    """
+    Persists the reader's position and deletes the segments before it
+    """
+    temporary = self._path(CURSOR_FILE + ".tmp")
+    with open(temporary, "w") as cursor:
+      json.dump(list(position), cursor)
+      cursor.flush()
+      os.fsync(cursor.fileno())
+    os.rename(temporary, self._path(CURSOR_FILE))
+    self.cursor = position
+    for number in self._segments():
+      if number < position[0]:
+        if number in self._maps:
+          self._maps.pop(number).close()
+        self._dirty.discard(number)
+        os.remove(self._path(_segment_name(number)))
+
+  def size(self):
+    """
+    :return: bytes of records not read yet, counting whole segments between the cursor and the end
+    """
+    (first, offset), (last, end) = self.cursor, self.end
+    if first == last:
+      return end - offset
+    return len(self._map(first)) - offset + (last - first - 1) * self.segment_bytes + end
+
+  def close(self):
+    for segment in self._maps.values():
+      segment.close()
+    self._maps.clear()
+
+class SpillQueue(object):
+  """
+  Decouples a single Replicator from the oplog tailer with a SpillLog drained by its own greenlet, see
+  the module documentation. Like a DestinationQueue, except that the ops waiting for the destination are
+  on disk, and that neither a full queue nor an unavailable destination holds up the tailer.
+  """
+
+  def __init__(self, replicator, spill_log):
+    self.replicator = replicator
+    self.destination_id = replicator.destination_id
+    self.log = spill_log
+    self._read_position = spill_log.cursor
+    # timestamp of the first op appended since the last sync
+    self._unsynced = None
+    # timestamp of the last op the destination acknowledged, and the log position after it
+    self._acknowledged = None
+    self._acknowledged_position = spill_log.cursor
+    self._appended = gevent.event.Event()
+    self._worker = None
+    # the error that stopped the worker
+    self._error = None
+    labels = dict(source=replicator.source_id, destination=self.destination_id, ns=replicator.destination_namespace)
+    metrics.registry.gauge("spill_bytes", self.log.size, **labels)
+    if spill_log.read(self._read_position) is not None:
+      # left over from the last run, drain it whether or not new ops arrive
+      self._worker = gevent.spawn(self._run)
+
+  def __call__(self, *args, **kwargs):
+    return self.replicate(*args, **kwargs)
+
+  def replicate(self, op, ns, o, o2=None, b=False, ts=None):
+    self._raise_error()
+    if self._worker is None:
+      self._worker = gevent.spawn(self._run)
+    record = {"op": op, "ns": ns, "o": o, "b": b, "ts": ts}
+    if o2 is not None:
+      record["o2"] = o2
+    self.log.append(record)
+    if self._unsynced is None:
+      self._unsynced = ts
+    self._appended.set()
+
+  def _run(self):
+    try:
+      while True:
+        entry = self.log.read(self._read_position)
+        if entry is None:
+          self._appended.clear()
+          self._appended.wait()
+          continue
+        record, position = entry
+        try:
+          self.replicator.replicate(record["op"], record["ns"], record["o"], record.get("o2"), record["b"],
+            record["ts"])
+          if position == self.log.end:
+            self.replicator.flush()
+        except Exception as e:
+          if self.replicator.handle_failure(e):
+            gevent.sleep(RETRY_SLEEP_TIME)
+          # the record is applied again, the replicator skips what it already buffered or dropped
+          continue
+        self._read_position = position
+        if self.replicator.oldest_pending() is None:
+          self._acknowledged, self._acknowledged_position = record["ts"], position
+    except Exception as e:
+      # the record stays unread, so the log is not committed past it
+      self._error = e
+
+  def _raise_error(self):
+    if self._error is not None:
+      raise self._error
+
+  def flush(self):
+    """
+    Syncs the log, the destination is not waited for. Raises the error that stopped the worker.
+    """
+    self._raise_error()
+    self.log.sync()
+    self._unsynced = None
+
+  def oldest_pending(self):
+    """
+    :return: oplog timestamp of the oldest op not on disk yet, or None
+    """
+    return self._unsynced
+
+  def save_positions(self, last_applied):
+    """
+    Persists how far the destination got in the log, the source checkpoint does not depend on it
+    """
+    if self._acknowledged is not None:
+      self.replicator.save_position(self._acknowledged)
+    if self._acknowledged_position != self.log.cursor:
+      self.log.commit(self._acknowledged_position)
+
+  def close(self):
+    if self._worker is not None:
+      self._worker.kill()
+      self._worker = None
+    self.log.close()
@@ -0,0 +1,205 @@
+import copy
+import gevent
+import logging
+import os
+
+from mmm.connections import default_manager
+from mmm.replication import ReplicationEngine
+
+log = logging.getLogger(__name__)
+
+DEFAULT_STOP_TIMEOUT = 30
+DEFAULT_WATCH_INTERVAL = 5
+
+def topology(config):
+  """
+  :param config: the parsed YAML config, either a single `master` with its `replications`, or a `masters`
+  list whose entries each carry their own `replications`
+  :return: dict of source id to a (master options, replications) tuple
+  """
+  if "masters" in config:
+    masters = [(master, master["replications"]) for master in config["masters"]]
+  else:
+    masters = [(config["master"], config["replications"])]
+  sources = {}
+  for master, replications in masters:
+    if master["id"] in sources:
+      raise ValueError("master id %r is configured more than once" % master["id"])
+    sources[master["id"]] = (master, replications)
+  return sources
+
+def _options(source):
+  """
+  :param source: (master options, replications) of a master
+  :return: the master options, without the replications a `masters` entry carries
+  """
+  return dict((k, v) for k, v in source[0].iteritems() if k != "replications")
+
+class Supervisor(object):
+  """
+  Runs one ReplicationEngine per configured master in this process, all sharing one ConnectionManager.
+
+  apply() compares a new config with the running one: engines of removed or changed masters are stopped,
+  engines of new or changed masters are started, and the others keep replicating undisturbed. When only
+  the replications of a running master changed, its engine is reconfigured in place instead, without
+  restarting its oplog tailer. An engine that fails is reported by health() and started again by the
+  next apply().
+  """
+
+  def __init__(self, connections=None, stop_timeout=DEFAULT_STOP_TIMEOUT, initial_sync=False):
+    """
+    :param initial_sync: True to seed new destination namespaces with ReplicationEngine.initial_sync()
+    before an engine starts tailing
+    """
+    self.connections = connections or default_manager
+    self.stop_timeout = stop_timeout
+    self.initial_sync = initial_sync
+    self.engines = {}
+    self._configs = {}
+    self._greenlets = {}
+    self._errors = {}
+
+  def apply(self, config):
+    """
+    Starts, stops and restarts engines so that exactly the masters in config are replicated
+    :param config: the parsed YAML config
+    """
+    sources = topology(config)
+    for source_id in list(self.engines):
+      if sources.get(source_id) == self._configs[source_id]:
+        continue
+      if source_id in sources and self.running(source_id) and _options(sources[source_id]) == _options(
+          self._configs[source_id]):
+        self.reconfigure(source_id, *sources[source_id])
+      else:
+        self.stop(source_id)
+    for source_id, source in sorted(sources.iteritems()):
+      if source_id not in self.engines or not self.running(source_id):
+        self.start(source_id, *source)
+
+  def start(self, source_id, master, replications):
+    """
+    Builds and starts the engine replicating one master, replacing a stopped or failed one
+    """
+    if source_id in self.engines:
+      self.stop(source_id)
+    log.info("Starting replication from %s", source_id)
+    engine = ReplicationEngine(source_id, master["uri"], replications, master, self.connections)
+    self.engines[source_id] = engine
+    # keep a copy, a reloaded config is compared with what the engine was built from
+    self._configs[source_id] = copy.deepcopy((master, replications))
+    self._errors.pop(source_id, None)
+    greenlet = gevent.spawn(self._run, engine)
+    greenlet.link_exception(lambda g: self._failed(source_id, g))
+    self._greenlets[source_id] = greenlet
+
+  def reconfigure(self, source_id, master, replications):
+    """
+    Applies changed replications of a running master to its engine
+    """
+    changed = self.engines[source_id].reconfigure(replications)
+    self._configs[source_id] = copy.deepcopy((master, replications))
+    log.info("Reconfigured replication from %s, changed namespaces: %s", source_id, ", ".join(changed))
+
+  def _run(self, engine):
+    if self.initial_sync:
+      engine.initial_sync()
+    engine.run()
+
+  def _failed(self, source_id, greenlet):
+    if self._greenlets.get(source_id) is greenlet:
+      log.error("Replication from %s stopped: %r", source_id, greenlet.exception)
+      self._errors[source_id] = greenlet.exception
+
+  def stop(self, source_id):
+    """
+    Stops the engine replicating one master, waiting up to stop_timeout seconds for it to save its checkpoint
+    """
+    engine = self.engines.pop(source_id)
+    greenlet = self._greenlets.pop(source_id)
+    del self._configs[source_id]
+    self._errors.pop(source_id, None)
+    log.info("Stopping replication from %s", source_id)
+    engine.stop()
+    greenlet.join(self.stop_timeout)
+    if not greenlet.ready():
+      log.warn("Replication from %s did not stop within %s seconds, killing it", source_id, self.stop_timeout)
+      greenlet.kill()
+    engine.close()
+
+  def stop_all(self):
+    for source_id in list(self.engines):
+      self.stop(source_id)
+
+  def running(self, source_id):
+    greenlet = self._greenlets.get(source_id)
+    return greenlet is not None and not greenlet.ready()
+
+  def health(self):
+    """
+    :return: dict of source id to its state: whether its engine runs, whether its source answers,
+    and the error that stopped it, if any
+    """
+    states = {}
+    for source_id, (master, _) in self._configs.iteritems():
+      error = self._errors.get(source_id)
+      states[source_id] = {
+        "running": self.running(source_id),
+        "connected": self.connections.healthy(master["uri"]),
+        "error": repr(error) if error is not None else None
+      }
+    return states
+
+  def healthy(self):
+    """
+    :return: True if every engine is running and connected to its source
+    """
+    return all(state["running"] and state["connected"] for state in self.health().values())
+
+class ConfigWatcher(object):
+  """
+  Polls a config file every `interval` seconds and calls on_change with its path whenever its
+  modification time or size changed since the last check
+  """
+
+  def __init__(self, path, on_change, interval=DEFAULT_WATCH_INTERVAL):
+    self.path = path
+    self.on_change = on_change
+    self.interval = interval
+    self._stat = self._current()
+    self._greenlet = None
+
+  def _current(self):
+    try:
+      stat = os.stat(self.path)
+    except OSError:
+      # being replaced, checked again next time
+      return None
+    return stat.st_mtime, stat.st_size
+
+  def check(self):
+    """
+    :return: True if the file changed and on_change was called
+    """
+    stat = self._current()
+    if stat is None or stat == self._stat:
+      return False
+    self._stat = stat
+    self.on_change(self.path)
+    return True
+
+  def _run(self):
+    while True:
+      gevent.sleep(self.interval)
+      try:
+        self.check()
+      except Exception:
+        log.error("Applying %s failed, keeping the running topology", self.path, exc_info=1)
+
+  def start(self):
+    self._greenlet = gevent.spawn(self._run)
+
+  def stop(self):
+    if self._greenlet is not None:
+      self._greenlet.kill()
+      self._greenlet = None
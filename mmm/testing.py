@@ -0,0 +1,648 @@
+"""
+In-memory stand-ins for the parts of pymongo that MMM uses, for tests and benchmarks.
+
+Only the query and update operators MMM itself issues are supported.
+"""
+from collections import defaultdict
+import copy
+import itertools
+import struct
+import time
+
+import bson
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from mmm.rawbson import OP_INSERT
+
+try:
+  from collections import OrderedDict
+except ImportError: # python 2.6
+  OrderedDict = dict
+
+def _lookup(document, key):
+  for part in key.split("."):
+    if not isinstance(document, dict) or part not in document:
+      return None, False
+    document = document[part]
+  return document, True
+
+def _comparable(value):
+  # bson.Timestamp does not define an ordering in older pymongo releases
+  if isinstance(value, bson.Timestamp):
+    return (value.time, value.inc)
+  return value
+
+def _is_operator(condition):
+  return isinstance(condition, dict) and bool(condition) and all(k.startswith("$") for k in condition)
+
+def _hashable(value):
+  if isinstance(value, dict):
+    return tuple((k, _hashable(v)) for k, v in value.iteritems())
+  if isinstance(value, list):
+    return tuple(_hashable(v) for v in value)
+  return value
+
+def _matches_condition(value, found, condition):
+  if _is_operator(condition):
+    value = _comparable(value)
+    for operator, operand in condition.iteritems():
+      operand = _comparable(operand)
+      if operator == "$gt" and not (found and value > operand):
+        return False
+      elif operator == "$gte" and not (found and value >= operand):
+        return False
+      elif operator == "$lt" and not (found and value < operand):
+        return False
+      elif operator == "$lte" and not (found and value <= operand):
+        return False
+      elif operator == "$in" and not (found and value in operand):
+        return False
+      elif operator == "$nin" and found and value in operand:
+        return False
+      elif operator == "$ne" and found and value == operand:
+        return False
+      elif operator == "$exists" and bool(operand) != found:
+        return False
+    return True
+  return found and value == condition
+
+def matches(document, spec):
+  """
+  :param document: document to test
+  :param spec: a mongo query, supporting equality on (dotted) keys, $or, $and and the comparison operators
+  :return: True if the document satisfies the query
+  """
+  for key, condition in (spec or {}).iteritems():
+    if key == "$or":
+      if not any(matches(document, clause) for clause in condition):
+        return False
+      continue
+    if key == "$and":
+      if not all(matches(document, clause) for clause in condition):
+        return False
+      continue
+    value, found = _lookup(document, key)
+    if not _matches_condition(value, found, condition):
+      return False
+  return True
+
+def _set_path(document, key, value):
+  parts = key.split(".")
+  for part in parts[:-1]:
+    document = document.setdefault(part, {})
+  document[parts[-1]] = value
+
+def _unset_path(document, key):
+  parts = key.split(".")
+  for part in parts[:-1]:
+    document = document.get(part, {})
+  document.pop(parts[-1], None)
+
+def apply_update(document, update):
+  """
+  Applies a mongo update document ($set/$unset/$inc or a full replacement) to document in place
+  """
+  if any(k.startswith("$") for k in update):
+    for key, value in update.get("$set", {}).iteritems():
+      _set_path(document, key, copy.deepcopy(value))
+    for key in update.get("$unset", {}):
+      _unset_path(document, key)
+    for key, value in update.get("$inc", {}).iteritems():
+      current, _ = _lookup(document, key)
+      _set_path(document, key, (current or 0) + value)
+  else:
+    _id = document.get("_id")
+    document.clear()
+    document.update(copy.deepcopy(update))
+    if _id is not None:
+      document["_id"] = _id
+
+def project(document, fields):
+  if not fields:
+    return document
+  if isinstance(fields, dict):
+    fields = [k for k, v in fields.iteritems() if v]
+  projected = {}
+  for key in itertools.chain(["_id"], fields):
+    value, found = _lookup(document, key)
+    if found:
+      _set_path(projected, key, value)
+  return projected
+
+def _sort(documents, sort):
+  for key, direction in reversed(sort or []):
+    if key == "$natural":
+      documents = documents[::-1] if direction < 0 else documents
+    else:
+      documents = sorted(documents, key=lambda d: _comparable(_lookup(d, key)[0]), reverse=direction < 0)
+  return documents
+
+class FakeCursor(object):
+  """
+  Iterates over a snapshot of matching documents. Like a tailable cursor, running dry does not kill it.
+  """
+
+  def __init__(self, documents, fields=None):
+    self._snapshot = documents
+    self._fields = fields
+    self._skip = 0
+    self._limit = 0
+    self._documents = None
+    self.alive = True
+
+  def sort(self, key_or_list, direction=1):
+    if not isinstance(key_or_list, list):
+      key_or_list = [(key_or_list, direction)]
+    self._snapshot = _sort(self._snapshot, key_or_list)
+    return self
+
+  def skip(self, skip):
+    self._skip = skip
+    return self
+
+  def limit(self, limit):
+    self._limit = limit
+    return self
+
+  def batch_size(self, size):
+    return self
+
+  def add_option(self, mask):
+    return self
+
+  def count(self):
+    return len(self._snapshot)
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    if self._documents is None:
+      documents = self._snapshot[self._skip:]
+      if self._limit:
+        documents = documents[:self._limit]
+      self._documents = iter(documents)
+    return project(copy.deepcopy(next(self._documents)), self._fields)
+
+  def close(self):
+    self.alive = False
+
+class FakeTailableCursor(FakeCursor):
+  """
+  A tailable cursor over a FakeOplog: the first read after it ran dry picks up the entries logged since.
+  """
+
+  def __init__(self, oplog, spec, fields=None):
+    FakeCursor.__init__(self, oplog._matching(spec), fields)
+    self._oplog = oplog
+    self._spec = spec or {}
+    self._last = None
+    self._dry = False
+
+  def next(self):
+    if self._dry:
+      self._dry = False
+      spec = dict(self._spec, ts={"$gt": self._last}) if self._last is not None else self._spec
+      self._documents = iter(self._oplog._matching(spec))
+    try:
+      document = FakeCursor.next(self)
+    except StopIteration:
+      self._dry = self.alive
+      raise
+    self._last = document.get("ts", self._last)
+    return document
+
+class FakeCollection(object):
+  """
+  A dict-backed stand-in for a pymongo collection, kept in insertion ($natural) order.
+
+  Every call sleeps for `latency` seconds (cooperatively, once gevent has monkey patched `time`)
+  and is counted in `calls` by method name. fail() makes upcoming calls raise, to exercise retries.
+  """
+
+  def __init__(self, documents=(), latency=0, oplog=None, ns=None, server=None):
+    self.latency = latency
+    self.oplog = oplog
+    self.ns = ns
+    self.name = ns.split(".", 1)[1] if ns else None
+    self._server = server
+    self.calls = defaultdict(int)
+    self._failures = []
+    self._documents = OrderedDict()
+    self._next_key = itertools.count()
+    for document in documents:
+      self._store(copy.deepcopy(document))
+
+  def _call(self, name):
+    self.calls[name] += 1
+    if self.latency:
+      time.sleep(self.latency)
+    for i, (method, error) in enumerate(self._failures):
+      if method is None or method == name:
+        del self._failures[i]
+        raise error
+
+  def fail(self, error, method=None, times=1):
+    """
+    Makes the next `times` calls raise error before they have any effect
+    :param method: name of the method to fail, e.g. "insert", any method by default
+    """
+    self._failures.extend([(method, error)] * times)
+
+  def __getattr__(self, name):
+    # sub-collections, e.g. local.oplog.rs
+    if name.startswith("_") or self.__dict__.get("_server") is None:
+      raise AttributeError(name)
+    return self._server.collection(self.ns + "." + name)
+
+  @property
+  def database(self):
+    return FakeDatabase(self._server, self.ns.split(".", 1)[0])
+
+  @property
+  def full_name(self):
+    return self.ns
+
+  def _log(self, op, o, o2=None):
+    if self.oplog is not None:
+      self.oplog.log(op, self.ns, o, o2)
+
+  def _key(self, document):
+    return _hashable(document["_id"]) if "_id" in document else ("$natural", next(self._next_key))
+
+  def _store(self, document):
+    self._documents[self._key(document)] = document
+
+  def _matching_items(self, spec):
+    if spec is not None and not isinstance(spec, dict):
+      spec = {"_id": spec}
+    if spec and "_id" in spec and not _is_operator(spec["_id"]):
+      key = _hashable(spec["_id"])
+      document = self._documents.get(key)
+      return [(key, document)] if document is not None and matches(document, spec) else []
+    return [(k, d) for k, d in self._documents.iteritems() if matches(d, spec)]
+
+  def _matching(self, spec):
+    return [d for _, d in self._matching_items(spec)]
+
+  @property
+  def documents(self):
+    return self._documents.values()
+
+  def count(self):
+    return len(self._documents)
+
+  def find(self, spec=None, fields=None, **kwargs):
+    self._call("find")
+    return FakeCursor(self._matching(spec), fields)
+
+  def find_one(self, spec=None, fields=None, sort=None, **kwargs):
+    self._call("find_one")
+    found = _sort(self._matching(spec), sort)
+    return project(copy.deepcopy(found[0]), fields) if found else None
+
+  def insert(self, doc_or_docs, manipulate=True, safe=None, check_keys=True, continue_on_error=False, **kwargs):
+    self._call("insert")
+    documents = doc_or_docs if isinstance(doc_or_docs, list) else [doc_or_docs]
+    duplicate = None
+    for document in documents:
+      if "_id" in document and _hashable(document["_id"]) in self._documents:
+        duplicate = DuplicateKeyError("E11000 duplicate key error index: %s.$_id_ dup key: { : %r }"
+          % (self.ns, document["_id"]), 11000)
+        if not continue_on_error:
+          raise duplicate
+        continue
+      self._store(copy.deepcopy(document))
+      self._log("i", document)
+    if duplicate is not None:
+      raise duplicate
+    return doc_or_docs
+
+  def save(self, document, *args, **kwargs):
+    self._call("save")
+    existed = "_id" in document and _hashable(document["_id"]) in self._documents
+    self._store(copy.deepcopy(document))
+    self._log("u" if existed else "i", document, {"_id": document["_id"]} if existed else None)
+
+  def update(self, spec, document, upsert=False, manipulate=False, safe=None, multi=False, **kwargs):
+    self._call("update")
+    found = self._matching(spec)
+    if not found:
+      if upsert:
+        new_document = dict((k, v) for k, v in spec.iteritems()
+          if not k.startswith("$") and "." not in k and not _is_operator(v))
+        apply_update(new_document, document)
+        if "_id" in new_document and _hashable(new_document["_id"]) in self._documents:
+          # the query didn't match the document with that _id
+          raise DuplicateKeyError("E11000 duplicate key error index: %s.$_id_ dup key: { : %r }"
+            % (self.ns, new_document["_id"]), 11000)
+        self._store(new_document)
+        self._log("i", new_document)
+        return {"n": 1, "updatedExisting": False, "upserted": new_document.get("_id")}
+      return {"n": 0, "updatedExisting": False}
+    for existing in (found if multi else found[:1]):
+      apply_update(existing, document)
+      self._log("u", document, {"_id": existing.get("_id")})
+    return {"n": len(found) if multi else 1, "updatedExisting": True}
+
+  def remove(self, spec_or_id=None, *args, **kwargs):
+    self._call("remove")
+    for key, document in self._matching_items(spec_or_id):
+      del self._documents[key]
+      self._log("d", {"_id": document.get("_id")})
+
+class UnacknowledgedCollection(FakeCollection):
+  """
+  A FakeCollection whose writes behave like those of a pymongo 2 Connection, which does not wait for
+  acknowledgement by default: unless a write passes a write concern (w or safe), it returns None and
+  its errors are lost.
+  """
+
+  def _write(self, method, args, kwargs):
+    if kwargs.get("w") or kwargs.get("safe"):
+      return method(self, *args, **kwargs)
+    try:
+      method(self, *args, **kwargs)
+    except OperationFailure:
+      pass
+    return None
+
+  def insert(self, *args, **kwargs):
+    return self._write(FakeCollection.insert, args, kwargs)
+
+  def update(self, *args, **kwargs):
+    return self._write(FakeCollection.update, args, kwargs)
+
+  def remove(self, *args, **kwargs):
+    return self._write(FakeCollection.remove, args, kwargs)
+
+class FakeOplog(FakeCollection):
+  """
+  A stand-in for local.oplog.rs. FakeCollections created with it log their writes here, in the
+  form mongod does: full documents for inserts and replacements, the modifiers for other updates.
+  """
+
+  def __init__(self, latency=0):
+    FakeCollection.__init__(self, latency=latency)
+    self._inc = itertools.count(1)
+
+  def find(self, spec=None, fields=None, tailable=False, **kwargs):
+    if not tailable:
+      return FakeCollection.find(self, spec, fields, **kwargs)
+    self._call("find")
+    return FakeTailableCursor(self, spec, fields)
+
+  def log(self, op, ns, o, o2=None):
+    entry = {"ts": bson.Timestamp(int(time.time()), next(self._inc)), "h": 0, "v": 2, "op": op, "ns": ns,
+      "o": copy.deepcopy(o)}
+    if o2 is not None:
+      entry["o2"] = copy.deepcopy(o2)
+    self._store(entry)
+
+  def extend(self, entries):
+    """
+    Appends recorded oplog entries, e.g. read from a dump of local.oplog.rs, as they are
+    """
+    for entry in entries:
+      self._store(copy.deepcopy(entry))
+
+class FakeDatabase(object):
+
+  def __init__(self, server, name):
+    self._server = server
+    self.name = name
+
+  @property
+  def connection(self):
+    return self._server
+
+  def __getitem__(self, name):
+    return self._server.collection(self.name + "." + name)
+
+  def __getattr__(self, name):
+    if name.startswith("_"):
+      raise AttributeError(name)
+    return self[name]
+
+  def command(self, command, *args, **kwargs):
+    # a pre write command server, so batches take the one write per op path
+    return {"ok": 1, "ismaster": True, "maxWireVersion": 0}
+
+def _parse_message(data):
+  """
+  :return: opcode, first int32, namespace and the rest of the first wire protocol message in data
+  """
+  length, _, _, operation, first = struct.unpack("<iiiii", data[:20])
+  ns_end = data.index("\x00", 20)
+  return operation, first, data[20:ns_end], data[ns_end + 1:length]
+
+class FakeServer(object):
+  """
+  An in-memory mongod: collections are created on first use, and writes to any database but
+  `local` are logged to its local.oplog.rs. Insert and update messages sent by mmm.rawbson are
+  applied like the same calls to a collection.
+  """
+
+  def __init__(self, latency=0):
+    self.latency = latency
+    self.oplog = FakeOplog(latency=latency)
+    self._collections = {}
+
+  def collection(self, ns):
+    if ns == "local.oplog.rs":
+      return self.oplog
+    if ns not in self._collections:
+      oplog = None if ns.startswith("local.") else self.oplog
+      self._collections[ns] = FakeCollection(latency=self.latency, oplog=oplog, ns=ns, server=self)
+    return self._collections[ns]
+
+  def __getitem__(self, database):
+    return FakeDatabase(self, database)
+
+  def _send_message(self, message, with_last_error=False, check_primary=True):
+    operation, flags, ns, rest = _parse_message(message[1])
+    collection = self.collection(ns)
+    try:
+      if operation == OP_INSERT:
+        collection.insert(bson.decode_all(rest), continue_on_error=bool(flags & 1))
+        result = {"n": 0}
+      else:
+        spec, document = bson.decode_all(rest[4:])
+        options = struct.unpack("<i", rest[:4])[0]
+        result = collection.update(spec, document, upsert=bool(options & 1), multi=bool(options & 2))
+    except OperationFailure:
+      if with_last_error:
+        raise
+      return None
+    return dict(result, ok=1, err=None) if with_last_error else None
+
+  def __getattr__(self, database):
+    if database.startswith("_"):
+      raise AttributeError(database)
+    return self[database]
+
+class FakeConnection(object):
+  """
+  Stands in for pymongo.Connection, connecting to the FakeServer registered for the URI
+  """
+
+  def __init__(self, servers, uri, *args, **kwargs):
+    if uri not in servers:
+      servers[uri] = FakeServer()
+    self.server = servers[uri]
+    self.disconnects = 0
+
+  def __getitem__(self, database):
+    return self.server[database]
+
+  def __getattr__(self, database):
+    if database.startswith("_"):
+      raise AttributeError(database)
+    return self.server[database]
+
+  def alive(self):
+    return True
+
+  def disconnect(self):
+    self.disconnects += 1
+
+def fake_connections(servers):
+  """
+  :param servers: dict of URI to FakeServer, servers for unknown URIs are added to it
+  :return: a ConnectionManager connecting to the in-memory servers
+  """
+  from mmm.connections import ConnectionManager
+  return ConnectionManager(lambda uri, *args, **kwargs: FakeConnection(servers, uri, *args, **kwargs))
+
+class FakeMesh(object):
+  """
+  Fully connected masters on in-memory servers, each replicating the given namespaces to all others
+  through a real ReplicationEngine. pump() tails every oplog the way Triggers.run does, but in turn
+  and without sleeping, until replication settles.
+  """
+
+  def __init__(self, node_ids, namespaces, options=None, destination_options=None, latency=0):
+    from mmm.replication import ReplicationEngine
+    self.node_ids = list(node_ids)
+    self.servers = dict((self.uri(node_id), FakeServer(latency)) for node_id in self.node_ids)
+    self.engines = {}
+    self._positions = {}
+    self.connections = fake_connections(self.servers)
+    for node_id in self.node_ids:
+      destinations = [dict(destination_options or {}, id=other, uri=self.uri(other),
+        namespaces=[{"source": ns, "dest": ns} for ns in namespaces]) for other in self.node_ids if other != node_id]
+      engine = ReplicationEngine(node_id, self.uri(node_id), destinations, options, self.connections)
+      engine.triggers.connect()
+      self.engines[node_id] = engine
+      self._positions[node_id] = bson.Timestamp(0, 0)
+
+  @staticmethod
+  def uri(node_id):
+    return "mongodb://%s" % node_id
+
+  def server(self, node_id):
+    return self.servers[self.uri(node_id)]
+
+  def collection(self, node_id, ns):
+    return self.server(node_id).collection(ns)
+
+  def pump(self, max_rounds=100):
+    """
+    Applies oplog entries on every node until none produce new ones
+    :return: number of oplog entries applied
+    """
+    applied = 0
+    for _ in xrange(max_rounds):
+      progressed = False
+      for node_id in self.node_ids:
+        triggers = self.engines[node_id].triggers
+        position = triggers._tail_oplog(self._positions[node_id])
+        if position != self._positions[node_id]:
+          progressed = True
+          applied += triggers.checkpoint_policy.pending
+          self.engines[node_id].drain()
+          triggers.save_checkpoint()
+          self._positions[node_id] = position
+      if not progressed:
+        return applied
+    raise RuntimeError("replication did not settle after %s rounds" % max_rounds)
+
+# share of each kind of write in a SyntheticWorkload
+DEFAULT_WORKLOAD_MIX = {"insert": 0.25, "set": 0.45, "replace": 0.2, "delete": 0.1}
+
+class SyntheticWorkload(object):
+  """
+  A reproducible stream of application writes for tests and benchmarks: inserts, $set updates, full
+  document updates and deletes of up to `documents` _ids per namespace, spread evenly over the namespaces.
+  Inserted and replaced documents carry a payload so that they are about doc_bytes of BSON.
+
+  An insert of a namespace without free _ids becomes a $set update, an update or delete of a namespace
+  without documents becomes an insert, so every write changes a document and shows up in the oplog.
+  """
+
+  def __init__(self, namespaces, documents=1000, doc_bytes=256, mix=None, seed=0):
+    """
+    :param mix: dict of "insert", "set", "replace" and "delete" to their share of the writes
+    """
+    import random
+    self.namespaces = list(namespaces)
+    self.documents = documents
+    self.doc_bytes = doc_bytes
+    mix = mix or DEFAULT_WORKLOAD_MIX
+    self._kinds = sorted(mix)
+    self._weights = [float(mix[kind]) for kind in self._kinds]
+    self._random = random.Random(seed)
+    self._live = dict((ns, OrderedDict()) for ns in self.namespaces)
+    self._written = 0
+
+  def document(self, _id):
+    document = {"_id": _id, "n": self._written}
+    document["payload"] = "x" * max(self.doc_bytes - len(bson.BSON.encode(document)) - 16, 0)
+    return document
+
+  def _kind(self):
+    point = self._random.random() * sum(self._weights)
+    for kind, weight in zip(self._kinds, self._weights):
+      point -= weight
+      if point < 0:
+        return kind
+    return self._kinds[-1]
+
+  def writes(self, count):
+    """
+    :return: iterator of `count` (namespace, method, args) tuples, method being a FakeCollection method name
+    """
+    for _ in xrange(count):
+      ns = self.namespaces[self._written % len(self.namespaces)]
+      live = self._live[ns]
+      kind = self._kind()
+      if kind == "insert" and len(live) >= self.documents:
+        kind = "set"
+      elif kind != "insert" and not live:
+        kind = "insert"
+      if kind == "insert":
+        _id = self._random.randrange(self.documents)
+        while _id in live:
+          _id = self._random.randrange(self.documents)
+        live[_id] = None
+        write = (ns, "insert", (self.document(_id),))
+      else:
+        # live _ids are kept in insertion order, so the choice only depends on the seed
+        _id = next(itertools.islice(live, self._random.randrange(len(live)), None))
+        if kind == "set":
+          write = (ns, "update", ({"_id": _id}, {"$set": {"n": self._written, "f%d" % (self._written % 8): _id}}))
+        elif kind == "replace":
+          write = (ns, "update", ({"_id": _id}, self.document(_id)))
+        else:
+          del live[_id]
+          write = (ns, "remove", ({"_id": _id},))
+      self._written += 1
+      yield write
+
+  def run(self, server, count):
+    """
+    Applies `count` writes to the collections of a FakeServer, which logs them to its oplog
+    """
+    for ns, method, args in self.writes(count):
+      getattr(server.collection(ns), method)(*args)
+
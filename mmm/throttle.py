@@ -0,0 +1,57 @@
+import gevent
+import time
+
+class TokenBucket(object):
+  """
+  Limits a rate to `rate` units per second, allowing bursts of up to `burst` units.
+
+  acquire() takes units from the bucket, which refills continuously, and sleeps cooperatively while
+  there are not enough. A request larger than the burst is let through once the bucket is full, so
+  batches bigger than the burst still make progress at the configured rate.
+  """
+
+  def __init__(self, rate, burst=None, clock=time.time, sleep=gevent.sleep):
+    if rate <= 0:
+      raise ValueError("rate must be positive, got %r" % rate)
+    self.rate = float(rate)
+    self.burst = float(burst if burst is not None else rate)
+    self._clock = clock
+    self._sleep = sleep
+    self._tokens = self.burst
+    self._updated = clock()
+
+  def _refill(self):
+    now = self._clock()
+    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+    self._updated = now
+
+  def wait_time(self, units=1):
+    """
+    :return: seconds until `units` could be acquired
+    """
+    self._refill()
+    needed = min(units, self.burst) - self._tokens
+    return max(needed / self.rate, 0)
+
+  def try_acquire(self, units=1):
+    """
+    :return: True if the units were taken, False if the caller would have to wait
+    """
+    if self.wait_time(units) > 0:
+      return False
+    self._tokens -= units
+    return True
+
+  def acquire(self, units=1):
+    """
+    Takes units from the bucket, sleeping until they are available
+    :return: seconds spent waiting
+    """
+    waited = 0
+    delay = self.wait_time(units)
+    while delay > 0:
+      self._sleep(delay)
+      waited += delay
+      delay = self.wait_time(units)
+    self._tokens -= units
+    return waited
@@ -0,0 +1,150 @@
+"""
+Field projections and renames applied to the documents of a source namespace before they are replicated.
+
+A namespace listed under `transforms` replicates only the fields listed in `include`, or every field but
+those in `exclude`, with top-level fields renamed as `rename` says. Fields may be dotted paths into
+subdocuments. `_id` and the MMM metadata are always replicated as they are.
+
+AggregateReplicator transforms every inserted document, replacement and update once, before fanning it
+out to the destinations: updates keep the `$set`, `$unset`, `$inc`... of replicated fields only, with
+values that are subdocuments projected in turn, and are skipped when nothing is left. The loop detection
+hash is computed on the transformed form, which is what destinations store, while the metadata written
+back to the source keeps the full document there. Transforming a transformed document changes nothing
+more, so a destination that transforms the namespace the same way recognizes the copies as replicated.
+Renamed fields are best replicated one way, unless the other direction renames them back. Initial sync
+copies, and verify compares and repairs, the transformed documents as well.
+"""
+from mmm.metadata import MMM_METADATA
+
+PROTECTED_FIELDS = ("_id", MMM_METADATA)
+
+def _tree(paths):
+  """
+  :return: nested dicts of the dotted paths, True where a path ends
+  """
+  tree = {}
+  for path in paths:
+    node = tree
+    parts = path.split(".")
+    for part in parts[:-1]:
+      child = node.setdefault(part, {})
+      if child is True:
+        break
+      node = child
+    else:
+      node[parts[-1]] = True
+  return tree
+
+class DocumentTransform(object):
+  """
+  Projects and renames the fields of one namespace's documents and updates, see the module documentation
+  """
+
+  def __init__(self, include=None, exclude=None, rename=None):
+    """
+    :param include: fields to replicate, None for all of them
+    :param exclude: fields not to replicate, only without include
+    :param rename: dict of top-level field to the name it is replicated as
+    """
+    if include is not None and exclude is not None:
+      raise ValueError("a transform either includes or excludes fields, not both")
+    for field in list(include or []) + list(exclude or []) + list(rename or {}) + list((rename or {}).values()):
+      if field.split(".")[0] in PROTECTED_FIELDS:
+        raise ValueError("%s is always replicated as it is, it can't be transformed" % field)
+    self.include = _tree(include) if include is not None else None
+    self.exclude = _tree(exclude or [])
+    self.rename = dict(rename or {})
+
+  @classmethod
+  def from_config(cls, config):
+    """
+    :param config: the entry of a namespace under `transforms` in the master config
+    """
+    config = config or {}
+    return cls(config.get("include"), config.get("exclude"), config.get("rename"))
+
+  def apply(self, o):
+    """
+    :param o: an inserted or replacing document, or an update with modifiers
+    :return: the transformed copy of o, None for an update that changes no replicated field
+    """
+    if any(key.startswith("$") for key in o):
+      update = {}
+      for modifier, fields in o.iteritems():
+        if not isinstance(fields, dict):
+          update[modifier] = fields
+          continue
+        transformed = {}
+        for path, value in fields.iteritems():
+          kept, value = self._path(path.split("."), value)
+          if kept:
+            transformed[self._renamed(path)] = value
+        if transformed:
+          update[modifier] = transformed
+      return update or None
+    projected = self._document(o)
+    if not self.rename:
+      return projected
+    return type(projected)((self.rename.get(key, key), value) for key, value in projected.iteritems())
+
+  def _renamed(self, path):
+    top, dot, rest = path.partition(".")
+    return self.rename.get(top, top) + dot + rest
+
+  def _document(self, document, include=None, exclude=None, top=True):
+    include = self.include if top else include
+    exclude = self.exclude if top else exclude
+    projected = type(document)()
+    for key, value in document.iteritems():
+      if top and key in PROTECTED_FIELDS:
+        projected[key] = value
+        continue
+      kept, value = self._field(value, include.get(key) if include is not None else True,
+        exclude.get(key) if exclude else None)
+      if kept:
+        projected[key] = value
+    return projected
+
+  def _field(self, value, include, exclude):
+    """
+    :param include: True to keep the whole value, nested paths to keep of it, None to drop it
+    :param exclude: True to drop the whole value, nested paths to drop of it, None to keep it
+    :return: (kept, projected value)
+    """
+    if include is None or exclude is True:
+      return False, None
+    include = None if include is True else include
+    if include is None and not exclude:
+      return True, value
+    if isinstance(value, dict):
+      return True, self._document(value, include, exclude, top=False)
+    if isinstance(value, list):
+      return True, [self._document(v, include, exclude, top=False) if isinstance(v, dict) else v for v in value]
+    # a scalar where subdocuments were expected holds none of the included fields
+    return include is None, value
+
+  def _path(self, parts, value):
+    """
+    :param parts: the dotted path of an update, split
+    :return: (kept, projected value) of the update of that path
+    """
+    if parts[0] in PROTECTED_FIELDS:
+      return True, value
+    include, exclude = self.include, self.exclude
+    for part in parts:
+      if include is not None and include is not True:
+        include = include.get(part)
+        if include is None:
+          return False, None
+      if exclude and exclude is not True:
+        exclude = exclude.get(part)
+      if exclude is True:
+        return False, None
+    if include is None or include is True:
+      include = True
+    if include is True and not exclude:
+      return True, value
+    if isinstance(value, (dict, list)):
+      return self._field(value, include, exclude)
+    # e.g. $unset of a parent of included fields
+    return True, value
@@ -2,16 +2,27 @@ import bson
 from collections import defaultdict
 from functools import wraps
 import gevent
+import gevent.queue
+try:
+  from gevent.lock import Semaphore
+except ImportError: # gevent < 1.0
+  from gevent.coros import Semaphore
 import logging
-from pymongo import Connection
-from pymongo.errors import AutoReconnect, OperationFailure
-import sys
 import time
 
+from mmm import metrics
+from mmm.catchup import op_key, superseded
+from mmm.checkpoint import CheckpointPolicy, DEFAULT_CHECKPOINT_NAMESPACE, earliest, previous_timestamp, timestamp_key
+from mmm.connections import default_manager
+from mmm.members import OplogSource
+from mmm.oplog import OplogOp, dispatch
+from mmm.retry import RetryPolicy
+
 log = logging.getLogger(__name__)
 
-RECONNECT_SLEEP_TIME = 60
 IDLE_SLEEP_TIME = 1
+# query flag that lets mongod seek to the ts of an oplog query instead of scanning up to it
+OPLOG_REPLAY = 8
 LOG_COUNT = 1000
 
 def log_counts(func):
@@ -40,55 +51,340 @@ class Triggers(object):
     self.connection_args = connection_args
     self.connection_kwargs = connection_kwargs
     self._callbacks = defaultdict(list)
+    # held while an op is handed to the callbacks and while the checkpoint is saved, registrations
+    # changed under it take effect between two ops
+    self.apply_lock = Semaphore()
     self.query_id = {"_id": self.source_id}
     self.stop_event = gevent.event.Event()
     self._oplog = None
     self._checkpoint = None
+    self.checkpoint_policy = CheckpointPolicy()
+    # retries failures to read the source oplog, callbacks retry their own writes
+    self.retry_policy = RetryPolicy()
+    # the last error a callback raised, run() raises it without retrying
+    self._callback_error = None
+    self._last_applied = None
+    self._persisted = None
+    # optional list of oplog fields to fetch, None fetches whole entries
+    self.oplog_fields = None
+    self._oplog_filter = {}
+    self.connections = default_manager
+    self._generation = None
+    self._read_latency = metrics.registry.histogram("oplog_read_seconds", source=source_id)
+    self._apply_latency = metrics.registry.histogram("oplog_apply_seconds", source=source_id)
+    self._op_counters = {}
+    self._coalesced = metrics.registry.counter("oplog_coalesced", source=source_id)
+    # optional CatchUpPolicy, None always tails entry by entry
+    self.catch_up = None
+    # optional OplogSource choosing a secondary to tail, None tails the member source_uri connects to
+    self.oplog_source = None
+    # where the checkpoint is kept, the source by default
+    self.checkpoint_uri = None
+    self.checkpoint_namespace = DEFAULT_CHECKPOINT_NAMESPACE
+    self._tailed_uri = None
+    # the tailable cursor, kept open across idle periods, with the filter and position it continues from
+    self._cursor = None
+    self._op_docs = None
+    self._cursor_filter = None
+    self._cursor_position = None
+    # newest oplog timestamp read or looked up, the lag gauges measure against it without querying
+    self._newest_seen = None
+    metrics.registry.gauge("oplog_lag_seconds", lambda: self._lag(self._last_applied), source=source_id)
+    metrics.registry.gauge("checkpoint_lag_seconds", lambda: self._lag(self._persisted), source=source_id)
 
   def stop(self):
     self.stop_event.set()
 
   def connect(self):
-    connection = Connection(self.source_uri, *self.connection_args, **self.connection_kwargs)
+    self._close_cursor()
+    uri, kwargs = self.source_uri, self.connection_kwargs
+    if self.oplog_source is not None:
+      # the member tailed so far failed or fell behind, it is only chosen again if no other one qualifies
+      host = self.oplog_source.select(exclude=[self.oplog_source.host])
+      if host is not None:
+        uri, kwargs = OplogSource.uri(host), dict(kwargs, slave_okay=True)
+    if uri != self._tailed_uri:
+      self._tailed_uri, self._generation = uri, None
+    connection, self._generation = self.connections.connect(uri, self._generation, *self.connection_args, **kwargs)
     self._oplog = connection.local.oplog.rs
-    self._checkpoint = connection.local.mmm
+    checkpoint_uri = self.checkpoint_uri or self.source_uri
+    if checkpoint_uri != uri:
+      # secondaries can't be written to
+      args, kwargs = (self.connection_args, self.connection_kwargs) if checkpoint_uri == self.source_uri else ((), {})
+      connection, _ = self.connections.connect(checkpoint_uri, None, *args, **kwargs)
+    database, collection = self.checkpoint_namespace.split(".", 1)
+    self._checkpoint = connection[database][collection]
 
-  def run(self):
+  def run(self, checkpoint=None):
+    """
+    :param checkpoint: optional oplog timestamp to start from if it is before the persisted checkpoint
+    """
     self.connect()
-    last_op_message_read_at = self._set_and_get_checkpoint()
-    log.debug("Reading oplog messages after %s", last_op_message_read_at)
+    checkpoint = earliest(checkpoint, self._set_and_get_checkpoint())
+    log.debug("Reading oplog messages after %s", checkpoint)
+    failures = 0
     while not self.stop_event.isSet():
       try:
-        self._tail_oplog(last_op_message_read_at)
-      except (AutoReconnect, OperationFailure):
-        log.warn("Connection to master failed at %s, sleeping for %s seconds before attempting to re-connect...", (self.source_uri, RECONNECT_SLEEP_TIME))
-        gevent.sleep(RECONNECT_SLEEP_TIME)
-        try:
+        if failures:
           self.connect()
-        except Exception:
-          log.error("Unable to reconnect to master at %s, exiting", self.source_uri, exc_info=1)
-          sys.exit(0)
+          self.save_checkpoint()
+          # resume after the last op every callback finished with, not the last one handed over
+          checkpoint = self._persisted or checkpoint
+        previous = checkpoint
+        checkpoint = self._tail_oplog(checkpoint)
+        failures = 0
+        if self.oplog_source is not None and self.oplog_source.due() and self.oplog_source.check():
+          self.connect()
+        if self.checkpoint_policy.due() or self._persisted != self._last_applied:
+          self.save_checkpoint()
+        if checkpoint == previous:
+          # nothing new, the tailer only stopped early to switch modes or filters otherwise
+          gevent.sleep(IDLE_SLEEP_TIME)
+      except Exception as e:
+        # callbacks made their own retries, retrying the op here would multiply them
+        if e is self._callback_error or not self.retry_policy.retryable(e, failures):
+          log.error("Replication from %s failed, exiting", self.source_uri, exc_info=1)
+          raise
+        self.retry_policy.wait(e, failures, "Tailing the oplog at %s" % self.source_uri)
+        failures += 1
+    self._close_cursor()
+    self.save_checkpoint()
 
   def _tail_oplog(self, checkpoint):
-    spec = {"ts": {'$gt': checkpoint}}
-    cursor = self._oplog.find(spec, tailable=True, await_data=True)
+    """
+    Applies every oplog message after checkpoint that is currently available. The tailable cursor is left
+    open when it runs dry, the next call continues from it if nothing changed in between.
+    :param checkpoint: timestamp of the last applied oplog message
+    :return: timestamp of the last applied oplog message once the cursor runs dry
+    """
+    if self.catch_up is not None and self.catch_up.behind(checkpoint, self._newest()):
+      self._close_cursor()
+      return self._catch_up(checkpoint)
+    oplog_filter = self._oplog_filter
+    op_docs = self._tailing_cursor(checkpoint, oplog_filter)
     try:
-      while cursor.alive:
+      while True:
+        read_at = time.time()
         try:
-          op_doc = cursor.next()
-          self._exec_callbacks(op_doc)
-          checkpoint = op_doc['ts']
-          self._checkpoint.update(self.query_id, {'$set': {'checkpoint': checkpoint}})
-          log.debug("advancing checkpoint to %s", checkpoint)
+          op_doc = next(op_docs)
         except StopIteration:
-          gevent.sleep(IDLE_SLEEP_TIME)
+          break
+        self._read_latency.observe(time.time() - read_at)
+        self._saw(op_doc['ts'])
+        checkpoint = self._apply(op_doc)
+        if oplog_filter is not self._oplog_filter:
+          # registrations changed, re-query with the new filter
+          break
+        if self.catch_up is not None and self.catch_up.due() and self.catch_up.behind(checkpoint, self._newest()):
+          break
+        if self.oplog_source is not None and self.oplog_source.due():
+          break
+    except:
+      self._close_cursor()
+      raise
+    self._cursor_position = checkpoint
+    return checkpoint
+
+  def _tailing_cursor(self, checkpoint, oplog_filter):
+    """
+    :return: an iterator over the oplog after checkpoint, the open cursor if it is still positioned there
+    and matches oplog_filter, a new tailable cursor otherwise
+    """
+    if self._cursor is not None and (not self._cursor.alive or self._cursor_filter is not oplog_filter or
+        self._cursor_position != checkpoint):
+      self._close_cursor()
+    if self._cursor is None:
+      spec = dict(oplog_filter, ts={'$gt': checkpoint})
+      self._cursor = self._oplog.find(spec, fields=self.oplog_fields, tailable=True, await_data=True)
+      self._cursor.add_option(OPLOG_REPLAY)
+      self._op_docs = iter(self._cursor.sort('$natural'))
+      self._cursor_filter = oplog_filter
+    return self._op_docs
+
+  def _close_cursor(self):
+    if self._cursor is not None:
+      self._cursor.close()
+    self._cursor = self._op_docs = self._cursor_filter = self._cursor_position = None
+
+  def _catch_up(self, checkpoint):
+    """
+    Applies the oplog after checkpoint in chunks read ahead by another greenlet, see mmm.catchup
+    :return: timestamp of the last applied oplog message once caught up
+    """
+    log.info("%s is %d seconds behind, catching up", self.source_uri, self.catch_up.lag(checkpoint, self._newest()))
+    oplog_filter = self._oplog_filter
+    spec = dict(oplog_filter, ts={'$gt': checkpoint})
+    cursor = self._oplog.find(spec, fields=self.oplog_fields).sort('$natural').batch_size(self.catch_up.batch_size)
+    chunks = gevent.queue.Queue(self.catch_up.read_ahead)
+    reader = gevent.spawn(self._read_chunks, cursor, chunks)
+    try:
+      while True:
+        chunk = chunks.get()
+        if isinstance(chunk, Exception):
+          raise chunk
+        if chunk is None:
+          break
+        redundant = superseded(chunk, self._deletes_replicated)
+        for i, (op_doc, _) in enumerate(chunk):
+          checkpoint = self._apply(op_doc, i in redundant)
+        if oplog_filter is not self._oplog_filter or self.catch_up.caught_up(checkpoint, self._newest()):
+          break
     finally:
+      reader.kill()
       cursor.close()
+    log.info("%s caught up to %s, tailing", self.source_uri, checkpoint)
+    return checkpoint
+
+  def _deletes_replicated(self, namespace):
+    """
+    :return: True if every callback handed the inserts and updates of namespace gets its deletes too,
+    callbacks tell for their destinations through an optional replicates_deletes(namespace)
+    """
+    deleting = self._callbacks.get((namespace, 'd'), [])
+    for op in ('i', 'u'):
+      for callback in self._callbacks.get((namespace, op), []):
+        if not any(callback is other for other in deleting):
+          return False
+        if hasattr(callback, "replicates_deletes") and not callback.replicates_deletes(namespace):
+          return False
+    return True
+
+  def _read_chunks(self, cursor, chunks):
+    chunk_size = self.catch_up.chunk_size
+    chunk = []
+    try:
+      op_docs = iter(cursor)
+      while True:
+        read_at = time.time()
+        try:
+          op_doc = next(op_docs)
+        except StopIteration:
+          break
+        self._read_latency.observe(time.time() - read_at)
+        self._saw(op_doc['ts'])
+        chunk.append((op_doc, op_key(op_doc)))
+        if len(chunk) >= chunk_size:
+          chunks.put(chunk)
+          chunk = []
+      if chunk:
+        chunks.put(chunk)
+      chunks.put(None)
+    except Exception as e:
+      chunks.put(e)
+
+  def _apply(self, op_doc, skip=False):
+    """
+    Hands an oplog message to the registered callbacks, unless skip, and records it as applied
+    :return: its timestamp
+    """
+    if skip:
+      self._coalesced.inc()
+    else:
+      applied_at = time.time()
+      with self.apply_lock:
+        self._exec_callbacks(op_doc)
+      self._apply_latency.observe(time.time() - applied_at)
+    self._count(op_doc['ns'])
+    ts = self._last_applied = op_doc['ts']
+    if self.checkpoint_policy.applied():
+      self.save_checkpoint()
+    return ts
+
+  def _count(self, namespace):
+    counter = self._op_counters.get(namespace)
+    if counter is None:
+      counter = self._op_counters[namespace] = metrics.registry.counter("oplog_ops", source=self.source_id, ns=namespace)
+    counter.inc()
+
+  def _newest(self):
+    """
+    :return: timestamp of the newest oplog entry, None if the oplog is empty
+    """
+    newest = self._oplog.find_one(sort=[('$natural', -1)], fields=['ts'])
+    if newest is None:
+      return None
+    self._saw(newest['ts'])
+    return newest['ts']
+
+  def _saw(self, ts):
+    """
+    Records an oplog timestamp read from the source
+    """
+    if self._newest_seen is None or timestamp_key(ts) > timestamp_key(self._newest_seen):
+      self._newest_seen = ts
+
+  def _lag(self, position):
+    """
+    :return: seconds between the newest oplog entry seen and position, None if either is unknown
+    """
+    if position is None or self._newest_seen is None:
+      return None
+    return max(self._newest_seen.time - position.time, 0)
+
+  def save_checkpoint(self):
+    """
+    Persists the position up to which every oplog message has been applied, if it has not been persisted yet
+    """
+    if self._last_applied is None:
+      return
+    with self.apply_lock:
+      # the position may only advance past ops that destinations have acknowledged
+      self.flush_callbacks()
+      position = self._checkpoint_position()
+      for callback in self._unique_callbacks():
+        if hasattr(callback, "save_positions"):
+          callback.save_positions(self._last_applied)
+    if position != self._persisted:
+      self._checkpoint.update(self.query_id, {'$set': {'checkpoint': position}})
+      self._persisted = position
+      log.debug("advancing checkpoint to %s", position)
+    self.checkpoint_policy.flushed()
+
+  def _checkpoint_position(self):
+    """
+    :return: the last dispatched timestamp, held back to just before the oldest op a callback has not
+    finished with yet (callbacks report it through an optional oldest_pending())
+    """
+    pending = [callback.oldest_pending() for callback in self._unique_callbacks() if hasattr(callback, "oldest_pending")]
+    oldest_pending = earliest(*pending)
+    if oldest_pending is None:
+      return self._last_applied
+    return earliest(previous_timestamp(oldest_pending), self._last_applied)
+
+  def _unique_callbacks(self):
+    seen = set()
+    for callbacks in self._callbacks.values():
+      for callback in callbacks:
+        if id(callback) not in seen:
+          seen.add(id(callback))
+          yield callback
+
+  def flush_callbacks(self):
+    """
+    Calls flush() on every registered callback that buffers its work
+    """
+    try:
+      for callback in self._unique_callbacks():
+        flush = getattr(callback, "flush", None)
+        if flush is not None:
+          flush()
+    except Exception as e:
+      self._callback_error = e
+      raise
 
   @log_counts
   def _exec_callbacks(self, op_doc):
-    for callback in self._callbacks.get((op_doc['ns'], op_doc['op']), []):
-      callback(**op_doc)
+    callbacks = self._callbacks.get((op_doc['ns'], op_doc['op']))
+    if not callbacks:
+      return
+    # one immutable op shared by every callback, instead of a keyword dict per callback
+    op = OplogOp.from_document(op_doc)
+    try:
+      for callback in callbacks:
+        dispatch(callback, op)
+    except Exception as e:
+      self._callback_error = e
+      raise
 
   def _set_and_get_checkpoint(self):
     #is there a command in Mongo to do this in one shot: if the document doesn't exist just create it?
@@ -110,3 +406,34 @@ class Triggers(object):
     """
     for op in operations:
       self._callbacks[(namespace, op)].append(callback_func)
+    self._oplog_filter = self._build_oplog_filter()
+
+  def unregister(self, namespace, callback_func):
+    """
+    Stops handing the ops of namespace to callback_func. It is flushed first and saves the positions of
+    what it was handed, so the checkpoint no longer has to wait for it. Hold apply_lock to unregister
+    between two ops.
+    """
+    if hasattr(callback_func, "flush"):
+      callback_func.flush()
+    if hasattr(callback_func, "save_positions") and self._last_applied is not None:
+      callback_func.save_positions(self._last_applied)
+    for key in [key for key in self._callbacks if key[0] == namespace]:
+      callbacks = [callback for callback in self._callbacks[key] if callback is not callback_func]
+      if callbacks:
+        self._callbacks[key] = callbacks
+      else:
+        del self._callbacks[key]
+    self._oplog_filter = self._build_oplog_filter()
+
+  def _build_oplog_filter(self):
+    """
+    Builds the server side predicate that restricts the oplog cursor to registered namespaces and
+    operations, so entries no callback is interested in are never sent over the wire or decoded.
+    This is a superset of the registered (namespace, operation) pairs; _exec_callbacks does the exact match.
+    """
+    registered = [key for key, callbacks in self._callbacks.iteritems() if callbacks]
+    return {
+      "ns": {"$in": sorted(set(ns for ns, _ in registered))},
+      "op": {"$in": sorted(set(op for _, op in registered))}
+    }
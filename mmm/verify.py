@@ -0,0 +1,218 @@
+"""
+Finds the documents a destination namespace holds differently from its source, and the writes repairing them.
+
+Both sides are compared by range digests: the md5 of the `_id` and document hash of every document in an
+`_id` range, in `_id` order. Documents are hashed as they are read, without their MMM metadata. With
+`stored_hashes` the source's documents are not read where the `__mmm.hash` replication stored covers the
+whole document (`__mmm.whole`, set by inserts and replacements in inline metadata mode): their `_id` and
+metadata are enough. MMM restamps every local write of the source, so its stored hashes follow its documents.
+Destination documents are always hashed: a write to a destination that was never replicated, which is what
+verifying finds, leaves its stored hash behind. A `$set` stores the hash of the update, not marked whole, so
+its document is hashed on either side.
+Ranges compared one by one are hashed on both sides.
+
+The namespace is split into `partitions` ranges of about the same size, compared in parallel. A range whose
+digests differ is split into `fanout` ranges that are compared in turn, down to ranges of at most
+`leaf_size` documents whose hashes are compared one by one. MongoDB cannot digest a range on the server, so
+the first level still reads every document, or its metadata; every level below it only reads the ranges that
+differ.
+
+The source is authoritative. Documents missing or different at the destination are repaired with an upsert
+of the source document, stamped with MMM metadata as if it had been replicated, and documents only the
+destination has are deleted. Repairs are oplog-like records that `apply_repairs` replays through a
+Replicator, one without a conflict policy so the source wins over destination copies written later.
+"""
+import bson
+import gevent
+import hashlib
+import logging
+
+from mmm.connections import default_manager
+from mmm.hashing import DocumentDigest, HASH_LEGACY, algorithm_of
+from mmm.initial_sync import id_bounds, range_query, stamp
+from mmm.metadata import MMM_HASH, MMM_METADATA, MMM_WHOLE
+
+log = logging.getLogger(__name__)
+
+DEFAULT_VERIFY_PARTITIONS = 4
+DEFAULT_VERIFY_FANOUT = 8
+DEFAULT_VERIFY_LEAF_SIZE = 1000
+DEFAULT_VERIFY_BATCH_SIZE = 1000
+
+def _key(_id):
+  # `_id`s may be unhashable documents, their encoding identifies them as well
+  return bson.BSON.encode({"_id": _id})
+
+def apply_repairs(replicator, repairs):
+  """
+  Replays repairs through the Replicator of their destination namespace
+  :return: number of repairs applied
+  """
+  for repair in repairs:
+    replicator.replicate(repair["op"], repair["ns"], repair["o"], repair.get("o2"), repair.get("b", False))
+  replicator.flush()
+  return len(repairs)
+
+class Verifier(object):
+  """
+  Compares one source namespace with one destination namespace, see the module documentation
+  """
+
+  def __init__(self, source_id, source_uri, destination_id, destination_uri, source_namespace, destination_namespace,
+      connections=None, hash_algorithm=HASH_LEGACY, partitions=DEFAULT_VERIFY_PARTITIONS,
+      fanout=DEFAULT_VERIFY_FANOUT, leaf_size=DEFAULT_VERIFY_LEAF_SIZE, batch_size=DEFAULT_VERIFY_BATCH_SIZE,
+      transform=None, stored_hashes=False):
+    """
+    :param hash_algorithm: algorithm the documents are hashed with
+    :param stored_hashes: True to use the hashes stored in the source's inline metadata where they cover whole
+    documents
+    :param transform: optional DocumentTransform of the source namespace, source documents are compared and
+    repaired as it projects them
+    """
+    self.source_id = source_id
+    self.destination_id = destination_id
+    self.source_namespace = source_namespace
+    self.destination_namespace = destination_namespace
+    self.hash_algorithm = hash_algorithm
+    self.partitions = partitions
+    self.fanout = max(fanout, 2)
+    self.leaf_size = leaf_size
+    self.batch_size = batch_size
+    self.transform = transform
+    self.stored_hashes = stored_hashes
+    self.ranges_compared = 0
+    self.documents_hashed = 0
+    connections = connections or default_manager
+    source_connection, _ = connections.connect(source_uri)
+    self._source = source_connection[source_namespace.split(".", 1)[0]][source_namespace.split(".", 1)[1]]
+    destination_connection, _ = connections.connect(destination_uri)
+    self._destination = destination_connection[destination_namespace.split(".", 1)[0]][destination_namespace.split(".", 1)[1]]
+
+  def run(self):
+    """
+    :return: the repairs making the destination match the source, in `_id` order
+    """
+    bounds = id_bounds(self._source, self.partitions)
+    greenlets = [gevent.spawn(self._compare, lower, upper) for lower, upper in zip([None] + bounds, bounds + [None])]
+    try:
+      gevent.joinall(greenlets, raise_error=True)
+    except Exception:
+      gevent.killall(greenlets)
+      raise
+    differing = [_id for greenlet in greenlets for _id in greenlet.value]
+    log.info("Verified %s against %s %s: %s documents differ (%s ranges compared, %s documents hashed)",
+      self.source_namespace, self.destination_id, self.destination_namespace, len(differing), self.ranges_compared,
+      self.documents_hashed)
+    return [self._repair(_id) for _id in differing]
+
+  def _compare(self, lower, upper):
+    """
+    :return: `_id`s of the documents that differ with lower <= _id < upper
+    """
+    self.ranges_compared += 1
+    source = gevent.spawn(self._digest, self._source, lower, upper, self.transform, self.stored_hashes)
+    destination = gevent.spawn(self._digest, self._destination, lower, upper)
+    gevent.joinall([source, destination], raise_error=True)
+    (source_count, source_digest), (destination_count, destination_digest) = source.value, destination.value
+    if source_digest == destination_digest:
+      return []
+    bounds = []
+    if max(source_count, destination_count) > self.leaf_size:
+      # split where the documents are, extra documents may be on either side
+      larger = self._source if source_count >= destination_count else self._destination
+      bounds = id_bounds(larger, self.fanout, lower, upper)
+      # a range that doesn't split any further is compared as it is
+      bounds = [bound for bound in bounds if bound != lower]
+    if not bounds:
+      return self._diff(lower, upper)
+    differing = []
+    for sub_lower, sub_upper in zip([lower] + bounds, bounds + [upper]):
+      differing.extend(self._compare(sub_lower, sub_upper))
+    return differing
+
+  def _digest(self, collection, lower, upper, transform=None, stored=False):
+    """
+    :return: (number of documents, digest) of the range
+    """
+    digest = hashlib.md5()
+    count = 0
+    for _id, document_hash in self._hashes(collection, lower, upper, transform, stored):
+      digest.update(_key(_id))
+      digest.update(document_hash)
+      count += 1
+    return count, digest.hexdigest()
+
+  def _diff(self, lower, upper):
+    source = list(self._hashes(self._source, lower, upper, self.transform))
+    destination = dict((_key(_id), document_hash) for _id, document_hash in
+      self._hashes(self._destination, lower, upper))
+    differing = []
+    for _id, document_hash in source:
+      if destination.pop(_key(_id), None) != document_hash:
+        differing.append(_id)
+    # left are the documents only the destination has
+    differing.extend(bson.BSON(key).decode()["_id"] for key in destination)
+    return differing
+
+  def _hashes(self, collection, lower, upper, transform=None, stored=False):
+    """
+    :param transform: optional DocumentTransform the documents are hashed after
+    :param stored: True to take the stored hash of the documents it covers whole
+    :return: iterator of (_id, document hash) in `_id` order
+    """
+    query = range_query(lower, upper)
+    if not stored:
+      for document in self._find(collection, query):
+        yield document["_id"], self._hash(document, transform)
+      return
+    batch = []
+    for document in self._find(collection, query, ["_id", MMM_METADATA]):
+      batch.append(document)
+      if len(batch) >= self.batch_size:
+        for item in self._stored_hashes(collection, batch, transform):
+          yield item
+        batch = []
+    for item in self._stored_hashes(collection, batch, transform):
+      yield item
+
+  def _stored_hashes(self, collection, documents, transform):
+    """
+    :param documents: `_id` and metadata of consecutive documents
+    :return: list of (_id, document hash) of those still there, the ones without a stored hash read and hashed
+    """
+    hashes = dict((_key(document["_id"]), self._stored_hash(document)) for document in documents)
+    unhashed = [document["_id"] for document in documents if hashes[_key(document["_id"])] is None]
+    if unhashed:
+      for document in self._find(collection, {"_id": {"$in": unhashed}}):
+        hashes[_key(document["_id"])] = self._hash(document, transform)
+    return [(document["_id"], hashes[_key(document["_id"])]) for document in documents
+      if hashes[_key(document["_id"])] is not None]
+
+  def _stored_hash(self, document):
+    """
+    :return: the stored hash of the whole document, None if it has none or one of another algorithm
+    """
+    metadata = document.get(MMM_METADATA)
+    if not isinstance(metadata, dict) or not metadata.get(MMM_WHOLE) or MMM_HASH not in metadata:
+      return None
+    if algorithm_of(metadata[MMM_HASH]) != self.hash_algorithm:
+      return None
+    return metadata[MMM_HASH]
+
+  def _find(self, collection, query, fields=None):
+    return collection.find(query, fields).sort("_id", 1).batch_size(self.batch_size)
+
+  def _hash(self, document, transform=None):
+    self.documents_hashed += 1
+    if transform is not None:
+      document = transform.apply(document)
+    return DocumentDigest(document, self.hash_algorithm, MMM_METADATA).hexdigest()
+
+  def _repair(self, _id):
+    document = self._source.find_one({"_id": _id})
+    if document is None:
+      return {"op": "d", "ns": self.destination_namespace, "o": {"_id": _id}}
+    if self.transform is not None:
+      document = self.transform.apply(document)
+    stamp(document, self.source_id, self.destination_id, self.hash_algorithm)
+    return {"op": "u", "ns": self.destination_namespace, "o": document, "o2": {"_id": _id}, "b": True}
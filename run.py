@@ -4,12 +4,16 @@ import gevent.monkey
 gevent.monkey.patch_all()
 
 import argparse
+import bson
 from logging import config
 import logging
+import signal
 import sys
 import yaml
 
+from mmm import metrics
 from mmm.replication import ReplicationEngine
+from mmm.supervisor import ConfigWatcher, DEFAULT_STOP_TIMEOUT, Supervisor, topology
 
 def logging_config(level, filename):
   return {
@@ -47,16 +51,98 @@ master:
   name: 'my master'
   uri: 'localhost:27017'
   id: 'my-server-mongo'
+  metadata: 'inline'     # optional, 'inline', 'destination' or 'sidecar', see README
+  hash: 'legacy'         # optional, 'legacy', 'md5' or 'fast', hash stored for loop detection
+  raw_bson: false        # optional, encode each replicated document once for all its copies, see README
+  conflicts:             # optional, which of two masters' writes of a document is kept
+    policy: 'lww'        # 'lww' (later source_ts), 'fww' (earlier within window_ms) or 'module.function'
+    window_ms: 1000      # 'fww' only, writes further apart are sequential and the later one is kept
+  checkpoint:            # optional, persist the oplog position every N ops or T ms
+    ops: 1000
+    interval_ms: 1000
+    uri: 'localhost:27017' # optional, where positions are kept, the master by default
+    namespace: 'local.mmm'
+  oplog_source:          # optional, tail a secondary instead of the primary
+    read_from: 'secondary' # 'primary' (default) or 'secondary'
+    tags: {dc: 'east'}   # optional, tags the secondary must carry
+    max_lag_seconds: 30  # secondaries further behind their primary are not tailed
+    check_interval: 10   # seconds between checks of the tailed member's lag
+  initial_sync:          # optional, settings of the 'initial-sync' command
+    partitions: 4        # _id ranges copied in parallel per namespace
+    batch_size: 1000
+    docs_per_second: 5000  # optional, limits the documents read from this master
+  verify:                # optional, settings of the 'verify' command
+    partitions: 4        # _id ranges compared in parallel per namespace
+    fanout: 8            # ranges a differing range is split into
+    leaf_size: 1000      # documents of a range compared one by one
+    stored_hashes: true  # skip reading source documents whose inline metadata hashes them whole
+  retry:                 # optional, jittered exponential backoff after elections and network errors
+    initial_ms: 50
+    max_ms: 30000
+    attempts: 20         # retries of one failure before giving up and exiting
+  catch_up:              # optional, read the oplog in large pipelined batches while far behind
+    lag_seconds: 60      # start when this far behind the newest oplog entry, back to tailing within half of it
+    check_interval: 1    # seconds between two lookups of the newest oplog entry while tailing
+    batch_size: 5000     # oplog entries per cursor batch
+    chunk_size: 1000     # entries applied per chunk
+    read_ahead: 4        # chunks read while the previous ones are applied
+  parallel_apply:        # optional, apply ops on several lanes, each with its own destination writers
+    lanes: 4             # ops on one document always go to the same lane, in order
+    queue_size: 1000     # ops queued per lane before the oplog reader waits
+  coalesce:              # optional, merge consecutive updates of a hot document before replicating them
+    mydb.mycol:
+      window_ms: 50      # longest an op is held back
+      max_ops: 1000      # ops held before the window is flushed early
+  transforms:            # optional, what of a namespace's documents and updates is replicated
+    mydb.mycol:
+      include: ['name', 'address.city']  # or exclude: [...], _id and metadata are always replicated
+      rename: {name: 'title'}            # optional, top-level fields replicated under another name
+  spill:                 # optional, queue the ops of every destination in an on-disk log
+    path: '/var/lib/mmm/spill'
+    segment_bytes: 67108864
 replications:
   - name: 'another server'
     id: 'my-other-server-mongo'
     uri: 'localhost:27019'
     operations: 'iud'
+    batch_size: 500        # optional, writes per batch to this destination (default 1, no batching)
+    batch_bytes: 4194304   # optional, flush once the batch holds this many bytes
+    batch_linger_ms: 50    # optional, longest a buffered write waits before it is flushed
+    queue_size: 10000      # optional, replicate to this destination from its own queue and greenlet
+    scheduler:             # optional, queue by namespace priority and limit the rate to this destination
+      ops_per_second: 2000
+      bytes_per_second: 1048576
+      queue_size: 10000    # ops queued per priority class
     namespaces:
       - source: 'mydb.mycol'
         dest: 'otherdb.othercol'
+        priority: 'high'   # optional with a scheduler, 'high', 'normal' (default) or 'low'
       - source: 'mydb.anothercol'
         dest: 'otherdb.anothercol'
+metrics:                 # optional
+  port: 9411             # serve counters, gauges and histograms as text on http://127.0.0.1:9411/metrics
+  log_interval: 60       # log a JSON summary every N seconds, not logged unless set
+watch_interval: 5        # optional, re-read this file whenever it changed, checked every N seconds
+
+Sending the process a SIGHUP re-reads the file as well. Changed `replications` are applied without
+restarting the oplog tailer: only the source namespaces whose destinations changed are flushed and
+rebuilt. Other changes to a single `master` need a restart.
+
+To replicate several masters from one process, list them under `masters` instead, each with its own
+`replications`. They share connections, and a reload starts, stops or restarts only the masters whose
+configuration changed, or reconfigures those whose `replications` alone changed:
+
+masters:
+  - name: 'my master'
+    uri: 'localhost:27017'
+    id: 'my-server-mongo'
+    replications:
+      - ...
+  - name: 'another master'
+    uri: 'localhost:27019'
+    id: 'my-other-server-mongo'
+    replications:
+      - ...
 """
 
 if __name__ == '__main__':
@@ -65,6 +151,12 @@ if __name__ == '__main__':
         default="INFO", help="logging level string (e.g. DEBUG), defaults to INFO")
     parser.add_argument("-f", "--filename", default="./mmm.log", help="filename to log to, defaults to ./mmm.log")
     parser.add_argument('-c', '--config', default='test.yml', help='Topology config file', required=True)
+    parser.add_argument('command', nargs='?', choices=['run', 'initial-sync', 'verify'], default='run',
+        help="'initial-sync' first copies existing documents to destination namespaces that were never "
+        "replicated to, then runs as usual. 'verify' lists the documents every destination namespace "
+        "holds differently from its source and exits")
+    parser.add_argument('--repair', action='store_true', help="with 'verify', make the destinations match")
+    parser.add_argument('--repair-file', help="with 'verify', write the repairs to this file as BSON")
 
     args = parser.parse_args()
     config.dictConfig(logging_config(args.level, args.filename))
@@ -72,15 +164,64 @@ if __name__ == '__main__':
     log = logging.getLogger('mmm')
 
     config = yaml.load(open(args.config))
-    master = config["master"]
-    engine = ReplicationEngine(master["id"], master["uri"], config["replications"])
+    if args.command == 'verify':
+        repair_file = open(args.repair_file, 'wb') if args.repair_file else None
+        for source_id, (master, replications) in sorted(topology(config).items()):
+            engine = ReplicationEngine(master["id"], master["uri"], replications, master)
+            for destination_id, namespace, repairs in engine.verify(repair=args.repair):
+                print "%s => %s/%s: %s documents differ" % (source_id, destination_id, namespace, len(repairs))
+                for repair in repairs if repair_file else []:
+                    repair = dict(repair, source=source_id, destination=destination_id)
+                    repair_file.write(bson.BSON.encode(repair))
+            engine.close()
+        if repair_file:
+            repair_file.close()
+        sys.exit(0)
+    metrics.start(config.get("metrics"))
+    if "masters" in config:
+        supervisor = Supervisor(initial_sync=args.command == 'initial-sync')
+        supervisor.apply(config)
+        apply_config = supervisor.apply
+    else:
+        supervisor = None
+        master = config["master"]
+        engine = ReplicationEngine(master["id"], master["uri"], config["replications"], master)
+        if args.command == 'initial-sync':
+            engine.initial_sync()
+        greenlet = engine.start()
+
+        def apply_config(new_config):
+            (new_master, replications), = topology(new_config).values()
+            if new_master != master:
+                log.warn("The master section of %s changed, restart to apply it", args.config)
+            engine.reconfigure(replications)
+
+    def reload_config(path=args.config):
+        log.info("Reloading %s", path)
+        try:
+            apply_config(yaml.load(open(path)))
+        except Exception:
+            log.error("Unable to apply %s, keeping the running topology", path, exc_info=1)
 
-    engine.start()
+    gevent.signal(signal.SIGHUP, lambda: gevent.spawn(reload_config))
+    if config.get("watch_interval"):
+        ConfigWatcher(args.config, reload_config, float(config["watch_interval"])).start()
 
     while True:
         try:
             gevent.sleep(5)
             log.debug("Main thread sleeping")
+            if supervisor is not None:
+                for source_id, state in sorted(supervisor.health().iteritems()):
+                    if not (state["running"] and state["connected"]):
+                        log.warn("Replication from %s is unhealthy: %s", source_id, state)
         except KeyboardInterrupt:
             log.info("Exiting due to KeyboardInterrupt")
+            if supervisor is not None:
+                supervisor.stop_all()
+            else:
+                # run() saves the checkpoint as it returns
+                engine.stop()
+                greenlet.join(DEFAULT_STOP_TIMEOUT)
+                engine.close()
             sys.exit(0)
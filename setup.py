@@ -24,7 +24,7 @@ setup(name='MongoMultiMaster',
       author_email='rick@arborian.com',
       url='https://github.com/rick446/mmm',
       license='Apache License, Version 2.0',
-      packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
+      packages=find_packages(exclude=['ez_setup', 'examples', 'tests', 'bench']),
       include_package_data=True,
       zip_safe=False,
       install_requires=[
@@ -0,0 +1,214 @@
+from unittest import TestCase
+import bson
+import gevent
+from mock import MagicMock
+from pymongo.errors import DuplicateKeyError
+import struct
+from mmm.batching import BulkWriter, BulkWriteError, WriteOp
+from mmm.checkpoint import CheckpointStore
+from mmm.rawbson import RawDocument
+from mmm.connections import ConnectionManager
+from mmm.replication import Replicator
+from bson.son import SON
+from mmm.testing import FakeCollection, UnacknowledgedCollection
+
+class BulkWriterTest(TestCase):
+
+  def setUp(self):
+    self.writer = BulkWriter(size=3, max_bytes=1024, linger_ms=0)
+    self.collection = MagicMock()
+    self.collection.name = "barcol"
+    self.collection.database.command.return_value = {"ok": 1}
+    self.collection.database.name = "foodb"
+    self._reply({"ok": 1})
+
+  def _reply(self, *responses):
+    # buffered documents were encoded to be counted, write commands send those bytes
+    self.collection.database.connection._send_message_with_response.side_effect = [
+      struct.pack("<iqii", 0, 0, 0, 1) + bson.BSON.encode(response) for response in responses]
+
+  def _commands(self):
+    sent = self.collection.database.connection._send_message_with_response.call_args_list
+    return [bson.BSON(c[0][0][1][c[0][0][1].index("$cmd\x00") + 13:]).decode(SON) for c in sent]
+
+  def test_full_by_size(self):
+    self.assertFalse(self.writer.add(WriteOp('i', None, {"_id": 1}, False, None)))
+    self.assertFalse(self.writer.add(WriteOp('i', None, {"_id": 2}, False, None)))
+    self.assertTrue(self.writer.add(WriteOp('i', None, {"_id": 3}, False, None)))
+
+  def test_full_by_bytes(self):
+    self.assertTrue(self.writer.add(WriteOp('i', None, {"_id": 1, "big": "x" * 2048}, False, None)))
+
+  def test_expired_after_linger(self):
+    self.assertFalse(self.writer.expired())
+    self.writer.add(WriteOp('i', None, {"_id": 1}, False, None))
+    self.assertTrue(self.writer.expired())
+
+  def test_raw_documents_sent_as_they_are(self):
+    raw = RawDocument.encode({"_id": 1, "a": "x"}, "__mmm", {"source": "a"})
+    self._reply({"ok": 1, "n": 2})
+    self.writer.add(WriteOp('i', None, raw, False, None))
+    self.writer.add(WriteOp('i', None, raw.replace({"source": "b"}), False, None))
+
+    self.writer.write(self.collection, write_commands=True)
+
+    self.assertFalse(self.collection.database.command.called)
+    self.assertEquals(1, self.collection.database.connection._send_message_with_response.call_count)
+    self.assertEquals(0, len(self.writer))
+
+  def test_consecutive_ops_sent_as_ordered_commands(self):
+    self.writer.add(WriteOp('i', None, {"_id": 1}, False, None))
+    self.writer.add(WriteOp('i', None, {"_id": 2}, False, None))
+    self.writer.add(WriteOp('u', {"_id": 1}, {"$set": {"a": 1}}, False, None))
+
+    self.writer.write(self.collection, write_commands=True)
+
+    commands = self._commands()
+    self.assertEquals(1, len(commands))
+    # the command name first, encoded documents last
+    self.assertEquals([("insert", "barcol"), ("ordered", True), ("documents", [{"_id": 1}, {"_id": 2}])], commands[0].items())
+    self.collection.update.assert_called_with({"_id": 1}, {"$set": {"a": 1}}, False, w=1)
+    self.assertEquals(0, len(self.writer))
+
+  def test_command_error_maps_to_op(self):
+    self._reply({"ok": 1, "n": 1, "writeErrors": [{"index": 1, "code": 11000, "errmsg": "duplicate key"}]})
+    failing = WriteOp('i', None, {"_id": 2}, False, None)
+    self.writer.add(WriteOp('i', None, {"_id": 1}, False, None))
+    self.writer.add(failing)
+    self.writer.add(WriteOp('i', None, {"_id": 3}, False, None))
+
+    try:
+      self.writer.write(self.collection, write_commands=True)
+      self.fail("expected a BulkWriteError")
+    except BulkWriteError as e:
+      self.assertEquals(failing, e.write_op)
+      self.assertEquals(11000, e.code)
+    # the failed write and everything after it stay buffered
+    self.assertEquals(2, len(self.writer))
+
+  def test_legacy_error_maps_to_op(self):
+    collection = FakeCollection()
+    collection.insert = MagicMock(side_effect=[None, DuplicateKeyError("duplicate key", 11000)])
+    failing = WriteOp('i', None, {"_id": 2}, False, None)
+    self.writer.add(WriteOp('i', None, {"_id": 1}, False, None))
+    self.writer.add(failing)
+
+    try:
+      self.writer.write(collection)
+      self.fail("expected a BulkWriteError")
+    except BulkWriteError as e:
+      self.assertEquals(failing, e.write_op)
+    self.assertEquals(1, len(self.writer))
+
+  def test_bytes_recounted_after_a_failure(self):
+    collection = FakeCollection()
+    collection.insert = MagicMock(side_effect=[None, DuplicateKeyError("duplicate key", 11000)])
+    failing = WriteOp('i', None, {"_id": 2, "big": "x" * 600}, False, None)
+    self.writer.add(WriteOp('i', None, {"_id": 1, "big": "x" * 600}, False, None))
+    self.assertTrue(self.writer.add(failing))
+    self.assertRaises(BulkWriteError, self.writer.write, collection)
+
+    # only the failed write is counted
+    self.assertFalse(self.writer.add(WriteOp('i', None, {"_id": 3, "big": "x" * 300}, False, None)))
+    self.assertTrue(self.writer.drop(failing))
+    self.assertFalse(self.writer.add(WriteOp('i', None, {"_id": 4, "big": "x" * 600}, False, None)))
+
+  def test_legacy_writes_are_acknowledged(self):
+    # a Connection without a write concern returns None and never raises
+    collection = UnacknowledgedCollection([{"_id": 1}])
+    failing = WriteOp('i', None, {"_id": 1}, False, None)
+    self.writer.add(failing)
+
+    try:
+      self.writer.write(collection)
+      self.fail("expected a BulkWriteError")
+    except BulkWriteError as e:
+      self.assertEquals(failing, e.write_op)
+    # still buffered, so the checkpoint stays before it
+    self.assertEquals(1, len(self.writer))
+
+  def test_legacy_writes_keep_order(self):
+    collection = FakeCollection()
+    self.writer.add(WriteOp('i', None, {"_id": 1, "a": 0}, False, None))
+    self.writer.add(WriteOp('u', {"_id": 1}, {"$set": {"a": 1}}, False, None))
+    self.writer.add(WriteOp('d', {"_id": 1}, {"_id": 1}, False, None))
+    self.writer.add(WriteOp('i', None, {"_id": 1, "a": 2}, False, None))
+
+    self.writer.write(collection)
+
+    self.assertEquals([{"_id": 1, "a": 2}], collection.documents)
+
+  def test_conditional_writes_that_lost_are_counted(self):
+    self._reply({"ok": 1, "n": 1, "writeErrors": [{"index": 2, "code": 11000, "errmsg": "duplicate key"}]},
+      {"ok": 1, "n": 2})
+    for i in range(5):
+      self.writer.add(WriteOp('c', {"_id": i, "__mmm.source_ts": {"$lt": 5}}, {"_id": i}, True, None))
+
+    self.writer.write(self.collection, write_commands=True)
+
+    # one write matched nothing, the upsert at index 2 hit an existing _id, the last two were sent again
+    self.assertEquals(2, self.writer.conflicts)
+    self.assertEquals(0, len(self.writer))
+    self.assertEquals(2, len(self._commands()))
+
+  def test_from_config(self):
+    writer = BulkWriter.from_config({"batch_size": 100, "batch_linger_ms": 5})
+    self.assertEquals(100, writer.size)
+    self.assertEquals(5, writer.linger_ms)
+
+class ReplicatorBufferTest(TestCase):
+
+  def setUp(self):
+    connections = ConnectionManager(MagicMock())
+    self.replicators = [Replicator("source", dest, "uri", "foodb", "barcol", connections) for dest in ("a", "b")]
+    for replicator in self.replicators:
+      replicator._collection = FakeCollection()
+      replicator.writer = BulkWriter(size=10, linger_ms=60000)
+
+  def test_buffered_documents_are_not_shared_between_destinations(self):
+    o = {"_id": 1, "__mmm": {"source": "source", "source_ts": 5}}
+    for replicator in self.replicators:
+      replicator.replicate("i", "foodb.barcol", o)
+    for replicator in self.replicators:
+      replicator._write_commands = False
+      replicator.flush()
+
+    self.assertEquals({"source": "source", "source_ts": 5, "a": 5}, self.replicators[0]._collection.documents[0]["__mmm"])
+    self.assertEquals({"source": "source", "source_ts": 5, "b": 5}, self.replicators[1]._collection.documents[0]["__mmm"])
+    self.assertEquals({"source": "source", "source_ts": 5}, o["__mmm"])
+
+  def test_lingering_flush_failure_raised_by_the_next_call(self):
+    replicator = self.replicators[0]
+    replicator.writer.linger_ms = 1
+    replicator._write_commands = False
+    replicator._collection.fail(DuplicateKeyError("duplicate key", 11000), "insert")
+    replicator.replicate("i", "foodb.barcol", {"_id": 1, "__mmm": {"source": "source", "source_ts": 5}})
+    gevent.sleep(0.05)
+
+    self.assertRaises(BulkWriteError, replicator.replicate, "d", "foodb.barcol", {"_id": 2})
+    # raised once, the write stays buffered for the owner to retry or skip
+    self.assertEquals(1, len(replicator.writer))
+    replicator.flush()
+    self.assertEquals(1, len(replicator._collection.documents))
+
+  def test_skips_ops_the_destination_already_acknowledged(self):
+    replicator = self.replicators[0]
+    replicator.position = bson.Timestamp(100, 2)
+    replicator._write_commands = False
+    for i in range(1, 5):
+      replicator.replicate("d", "foodb.barcol", {"_id": i}, ts=bson.Timestamp(100, i))
+
+    self.assertEquals([bson.Timestamp(100, 3), bson.Timestamp(100, 4)], [w.ts for w in replicator.writer._ops])
+
+  def test_save_positions(self):
+    replicator = self.replicators[0]
+    replicator.checkpoints = CheckpointStore(FakeCollection(), "source")
+    replicator.replicate("d", "foodb.barcol", {"_id": 1}, ts=bson.Timestamp(100, 3))
+
+    replicator.save_positions(bson.Timestamp(100, 5))
+    self.assertEquals(bson.Timestamp(100, 2), replicator.checkpoints.load("a", "foodb.barcol"))
+
+    replicator._write_commands = False
+    replicator.flush()
+    replicator.save_positions(bson.Timestamp(100, 5))
+    self.assertEquals(bson.Timestamp(100, 5), replicator.checkpoints.load("a", "foodb.barcol"))
@@ -0,0 +1,114 @@
+from unittest import TestCase
+import bson
+from mock import MagicMock
+from mmm.catchup import CatchUpPolicy, op_key, superseded
+from mmm.testing import FakeMesh, FakeOplog
+from mmm.triggers import Triggers
+
+NS = "foodb.barcol"
+
+def entry(ts, op, _id, **fields):
+  op_doc = {"ts": bson.Timestamp(ts, 1), "h": 0, "v": 2, "op": op, "ns": NS}
+  if op == "u":
+    op_doc.update(o2={"_id": _id}, o=fields or {"$set": {"x": 1}})
+  else:
+    op_doc.update(o=dict(fields, _id=_id))
+  return op_doc
+
+class CoalescingTest(TestCase):
+
+  def test_op_key(self):
+    self.assertEquals((NS, 1), op_key(entry(1, "u", 1)))
+    self.assertEquals((NS, 1), op_key(entry(1, "d", 1)))
+    self.assertEquals(None, op_key(entry(1, "i", {"a": 1})))
+
+  def test_ops_before_a_delete_are_superseded(self):
+    ops = [entry(1, "i", 1), entry(2, "u", 1), entry(3, "u", 2), entry(4, "d", 1), entry(5, "i", 1), entry(6, "u", 2)]
+    self.assertEquals(set([0, 1]), superseded([(op, op_key(op)) for op in ops]))
+
+  def test_only_replicated_deletes_supersede(self):
+    ops = [entry(1, "i", 1), entry(2, "d", 1)]
+    self.assertEquals(set(), superseded([(op, op_key(op)) for op in ops], lambda namespace: False))
+
+  def test_from_config(self):
+    self.assertEquals(None, CatchUpPolicy.from_config(None))
+    self.assertEquals(30, CatchUpPolicy.from_config({"lag_seconds": 30}).lag_seconds)
+
+class CatchUpTest(TestCase):
+
+  def setUp(self):
+    self.oplog = FakeOplog()
+    self.trigger = Triggers("my-source-id", "my-uri")
+    self.trigger._oplog = self.oplog
+    self.trigger._checkpoint = MagicMock()
+    self.trigger.catch_up = CatchUpPolicy(lag_seconds=100, chunk_size=3, read_ahead=1, check_interval=0)
+    self.callback = MagicMock()
+    self.callback.oldest_pending.return_value = None
+    self.trigger.register(NS, "iud", self.callback)
+
+  def _applied(self):
+    return [(c[1]["op"], c[1]["ts"].time) for c in self.callback.call_args_list]
+
+  def test_catches_up_in_chunks_skipping_superseded_ops(self):
+    for op in [entry(1, "i", 1), entry(2, "u", 1), entry(3, "d", 1), entry(4, "i", 2), entry(5, "u", 2)]:
+      self.oplog._store(op)
+    self.trigger.catch_up.lag_seconds = 1
+
+    checkpoint = self.trigger._tail_oplog(bson.Timestamp(0, 0))
+
+    self.assertEquals([("d", 3), ("i", 4), ("u", 5)], self._applied())
+    self.assertEquals(bson.Timestamp(5, 1), checkpoint)
+    self.assertEquals(bson.Timestamp(5, 1), self.trigger._last_applied)
+    self.assertEquals(0, self.oplog.calls["find"] - 1)
+
+  def test_ops_are_kept_for_destinations_not_getting_deletes(self):
+    for op in [entry(1, "i", 1), entry(2, "u", 1), entry(3, "d", 1)]:
+      self.oplog._store(op)
+    self.trigger.catch_up.lag_seconds = 1
+    self.callback.replicates_deletes.return_value = False
+
+    self.trigger._tail_oplog(bson.Timestamp(0, 0))
+    self.assertEquals([("i", 1), ("u", 2), ("d", 3)], self._applied())
+    self.callback.replicates_deletes.assert_called_with(NS)
+
+  def test_destinations_tell_whether_they_get_deletes(self):
+    for operations, replicated in (("iud", True), ("iu", False)):
+      mesh = FakeMesh(["a", "b"], [NS], destination_options={"operations": operations})
+      self.assertEquals(replicated, mesh.engines["a"].triggers._deletes_replicated(NS))
+
+  def test_returns_to_tailing_once_caught_up(self):
+    for ts in range(1, 10):
+      self.oplog._store(entry(ts * 100, "u", ts))
+    self.trigger.catch_up.lag_seconds = 600
+
+    # 600 is within half the lag threshold of 900, catch-up mode ends after the chunk holding it
+    checkpoint = self.trigger._tail_oplog(bson.Timestamp(0, 0))
+    self.assertEquals(bson.Timestamp(600, 1), checkpoint)
+    self.assertEquals(6, self.callback.call_count)
+
+    checkpoint = self.trigger._tail_oplog(checkpoint)
+    self.assertEquals(bson.Timestamp(900, 1), checkpoint)
+    self.assertEquals(9, self.callback.call_count)
+
+  def test_tailing_switches_to_catch_up_when_falling_behind(self):
+    for ts in (960, 970, 980):
+      self.oplog._store(entry(ts, "u", ts))
+    def busy_source(**op_doc):
+      # the source keeps writing while the first op is applied
+      if op_doc["ts"].time == 960:
+        self.oplog._store(entry(1200, "u", 1200))
+    self.callback.side_effect = busy_source
+
+    checkpoint = self.trigger._tail_oplog(bson.Timestamp(950, 0))
+    self.assertEquals(bson.Timestamp(960, 1), checkpoint)
+    self.assertEquals(1, self.callback.call_count)
+
+    checkpoint = self.trigger._tail_oplog(checkpoint)
+    self.assertEquals(bson.Timestamp(1200, 1), checkpoint)
+    self.assertEquals(4, self.callback.call_count)
+
+  def test_idle_source_is_not_behind(self):
+    # however long ago the newest op was written
+    self.oplog._store(entry(1000, "u", 1))
+    self.assertFalse(self.trigger.catch_up.behind(bson.Timestamp(1000, 1), self.trigger._newest()))
+    self.assertTrue(self.trigger.catch_up.behind(bson.Timestamp(800, 1), self.trigger._newest()))
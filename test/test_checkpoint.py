@@ -0,0 +1,85 @@
+from unittest import TestCase
+import bson
+from mmm.checkpoint import CheckpointPolicy, CheckpointStore, earliest, latest, previous_timestamp
+from mmm.testing import FakeCollection
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+class CheckpointPolicyTest(TestCase):
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.policy = CheckpointPolicy(ops=3, interval_ms=500, clock=self.clock)
+
+  def test_not_due_without_pending_ops(self):
+    self.clock.now += 10
+    self.assertFalse(self.policy.due())
+
+  def test_due_after_op_count(self):
+    self.assertFalse(self.policy.applied())
+    self.assertFalse(self.policy.applied())
+    self.assertTrue(self.policy.applied())
+
+  def test_due_after_interval(self):
+    self.assertFalse(self.policy.applied())
+    self.clock.now += 0.5
+    self.assertTrue(self.policy.due())
+
+  def test_flushed_resets_window(self):
+    self.policy.applied()
+    self.policy.applied()
+    self.policy.applied()
+    self.policy.flushed()
+    self.assertEquals(0, self.policy.pending)
+    self.assertFalse(self.policy.applied())
+
+  def test_from_config_defaults(self):
+    policy = CheckpointPolicy.from_config(None)
+    self.assertEquals(1000, policy.ops)
+    self.assertEquals(1000, policy.interval_ms)
+
+  def test_from_config(self):
+    policy = CheckpointPolicy.from_config({"ops": 50, "interval_ms": 20})
+    self.assertEquals(50, policy.ops)
+    self.assertEquals(20, policy.interval_ms)
+
+  def test_rejects_invalid_ops(self):
+    self.assertRaises(ValueError, CheckpointPolicy, 0)
+
+class CheckpointStoreTest(TestCase):
+
+  def setUp(self):
+    self.collection = FakeCollection()
+    self.store = CheckpointStore(self.collection, "source")
+
+  def test_missing_position(self):
+    self.assertEquals(None, self.store.load("dest", "foodb.barcol"))
+
+  def test_positions_are_per_destination_and_namespace(self):
+    self.store.save("dest", "foodb.barcol", bson.Timestamp(10, 1))
+    self.store.save("dest", "foodb.bazcol", bson.Timestamp(20, 1))
+    self.store.save("other", "foodb.barcol", bson.Timestamp(30, 1))
+    self.store.save("dest", "foodb.barcol", bson.Timestamp(40, 1))
+
+    self.assertEquals(bson.Timestamp(40, 1), self.store.load("dest", "foodb.barcol"))
+    self.assertEquals(bson.Timestamp(20, 1), self.store.load("dest", "foodb.bazcol"))
+    self.assertEquals(bson.Timestamp(30, 1), self.store.load("other", "foodb.barcol"))
+    self.assertEquals(3, self.collection.count())
+
+class TimestampTest(TestCase):
+
+  def test_previous_timestamp(self):
+    self.assertEquals(bson.Timestamp(10, 4), previous_timestamp(bson.Timestamp(10, 5)))
+    self.assertEquals(bson.Timestamp(9, 2 ** 32 - 1), previous_timestamp(bson.Timestamp(10, 0)))
+
+  def test_earliest_and_latest(self):
+    timestamps = [bson.Timestamp(10, 5), None, bson.Timestamp(9, 7), bson.Timestamp(10, 0)]
+    self.assertEquals(bson.Timestamp(9, 7), earliest(*timestamps))
+    self.assertEquals(bson.Timestamp(10, 5), latest(*timestamps))
+    self.assertEquals(None, earliest(None))
@@ -0,0 +1,129 @@
+from unittest import TestCase
+import bson
+import gevent
+from mmm import metrics
+from mmm.coalesce import CoalescingWindow, merge_updates
+from mmm.testing import FakeMesh
+
+NS = "foodb.barcol"
+
+def update(i, _id, o):
+  return {"ts": bson.Timestamp(1000, i), "h": i, "op": "u", "ns": NS, "o": o, "o2": {"_id": _id}}
+
+class MergeUpdatesTest(TestCase):
+
+  def test_set_fields_merge(self):
+    self.assertEquals({"$set": {"a": 3, "b": 2}}, merge_updates({"$set": {"a": 1, "b": 2}}, {"$set": {"a": 3}}))
+
+  def test_increments_add_up(self):
+    self.assertEquals({"$inc": {"n": 3}}, merge_updates({"$inc": {"n": 1}}, {"$inc": {"n": 2}}))
+    self.assertEquals({"$set": {"n": 6}}, merge_updates({"$set": {"n": 5}}, {"$inc": {"n": 1}}))
+    self.assertEquals({"$set": {"n": 1}}, merge_updates({"$unset": {"n": 1}}, {"$inc": {"n": 1}}))
+    self.assertEquals({"$unset": {"n": 1}}, merge_updates({"$inc": {"n": 1}}, {"$unset": {"n": 1}}))
+
+  def test_replacement_supersedes(self):
+    self.assertEquals({"a": 1}, merge_updates({"$set": {"b": 2}}, {"a": 1}))
+    self.assertEquals(None, merge_updates({"a": 1}, {"$set": {"b": 2}}))
+
+  def test_unmergeable_updates(self):
+    self.assertEquals(None, merge_updates({"$set": {"a": 1}}, {"$set": {"a.b": 2}}))
+    self.assertEquals(None, merge_updates({"$push": {"l": 1}}, {"$set": {"a": 1}}))
+    self.assertEquals(None, merge_updates({"$inc": {"n": 0.1}}, {"$inc": {"n": 0.2}}))
+    self.assertEquals(None, merge_updates({"$set": {"n": "x"}}, {"$inc": {"n": 1}}))
+
+class StubAggregate(object):
+
+  def __init__(self):
+    self.replicated = []
+    self.fail = False
+
+  def __call__(self, **op_doc):
+    if self.fail:
+      self.fail = False
+      raise RuntimeError("source down")
+    self.replicated.append(op_doc)
+
+class CoalescingWindowTest(TestCase):
+
+  def setUp(self):
+    self.aggregate = StubAggregate()
+    self.window = CoalescingWindow(self.aggregate, "source", NS, "__mmm", window_ms=10, max_ops=100)
+
+  def tearDown(self):
+    self.window.close()
+    metrics.registry.remove(source="source")
+
+  def test_consecutive_updates_become_one_write(self):
+    self.window(**update(0, 1, {"$set": {"a": 1}}))
+    self.window(**update(1, 2, {"$set": {"a": 1}}))
+    self.window(**update(2, 1, {"$inc": {"n": 1}}))
+    self.window(**update(3, 1, {"$set": {"a": 2}}))
+    self.assertEquals(bson.Timestamp(1000, 0), self.window.oldest_pending())
+    self.window.flush()
+
+    self.assertEquals([(2, {"$set": {"a": 1}}), (1, {"$set": {"a": 2}, "$inc": {"n": 1}})],
+      [(op_doc["o2"]["_id"], op_doc["o"]) for op_doc in self.aggregate.replicated])
+    # oplog order is kept, the merged update carries its last timestamp
+    self.assertEquals([bson.Timestamp(1000, 1), bson.Timestamp(1000, 3)], [op_doc["ts"] for op_doc in self.aggregate.replicated])
+    self.assertEquals(2, metrics.registry.get("updates_coalesced", source="source", ns=NS).value)
+    self.assertEquals(None, self.window.oldest_pending())
+
+  def test_unmerged_entries_keep_their_place(self):
+    self.window(**update(0, 1, {"$set": {"a": 1}}))
+    self.window(**{"ts": bson.Timestamp(1000, 1), "h": 1, "op": "i", "ns": NS, "o": {"_id": 2}})
+    self.window(**update(2, 1, {"$push": {"l": 1}}))
+    self.window(**update(3, 1, {"$set": {"__mmm.b": 5}}))
+    self.window.flush()
+
+    self.assertEquals(range(4), [op_doc["h"] for op_doc in self.aggregate.replicated])
+    self.assertEquals(0, metrics.registry.get("updates_coalesced", source="source", ns=NS).value)
+
+  def test_window_is_flushed_within_window_ms(self):
+    self.window(**update(0, 1, {"$set": {"a": 1}}))
+    self.window(**update(1, 1, {"$set": {"a": 2}}))
+    self.assertEquals([], self.aggregate.replicated)
+    gevent.sleep(0.05)
+
+    self.assertEquals([{"$set": {"a": 2}}], [op_doc["o"] for op_doc in self.aggregate.replicated])
+
+  def test_full_window_is_flushed(self):
+    self.window.max_ops = 3
+    for i in range(3):
+      self.window(**update(i, i, {"$set": {"a": i}}))
+
+    self.assertEquals(3, len(self.aggregate.replicated))
+
+  def test_failed_flush_holds_the_checkpoint(self):
+    self.window(**update(0, 1, {"$set": {"a": 1}}))
+    self.window(**update(1, 2, {"$set": {"a": 1}}))
+    self.aggregate.fail = True
+    self.assertRaises(RuntimeError, self.window.flush)
+
+    self.assertEquals(bson.Timestamp(1000, 0), self.window.oldest_pending())
+    self.window.flush()
+    self.assertEquals(bson.Timestamp(1000, 0), self.window.oldest_pending())
+    # Triggers replays from its checkpoint
+    self.window(**update(0, 1, {"$set": {"a": 1}}))
+    self.window.flush()
+    self.assertEquals(None, self.window.oldest_pending())
+
+class CoalescedReplicationTest(TestCase):
+
+  def test_hot_document_converges_with_fewer_writes(self):
+    mesh = FakeMesh(["a", "b"], [NS], {"coalesce": {NS: {"window_ms": 1000}}})
+    a, b = mesh.collection("a", NS), mesh.collection("b", NS)
+    a.insert({"_id": 1, "n": 0})
+    mesh.pump()
+    for i in range(10):
+      a.update({"_id": 1}, {"$set": {"n": i + 1}})
+    a.update({"_id": 1}, {"$set": {"x": 1}})
+    mesh.pump()
+
+    content = lambda collection: [dict((k, v) for k, v in d.iteritems() if k != "__mmm") for d in collection.documents]
+    self.assertEquals([{"_id": 1, "n": 10, "x": 1}], content(a))
+    self.assertEquals(content(a), content(b))
+    self.assertEquals(10, metrics.registry.get("updates_coalesced", source="a", ns=NS).value)
+    # the insert, one merged update and the acknowledgement of each write-back, instead of 24 writes
+    self.assertEquals(4, metrics.registry.get("destination_writes", source="a", destination="b", ns=NS).value)
+    for engine in mesh.engines.values():
+      engine.close()
@@ -0,0 +1,89 @@
+from unittest import TestCase
+from mock import patch
+from mmm import metrics
+from mmm.batching import BulkWriter, WriteOp
+from mmm.conflicts import FirstWriterWins, last_writer_wins, policy_from_config
+from mmm.replication import AggregateReplicator
+from mmm.testing import FakeMesh, UnacknowledgedCollection, fake_connections
+
+NS = "foodb.barcol"
+
+class ConflictPolicyTest(TestCase):
+
+  def setUp(self):
+    self._registry = metrics.registry
+    metrics.registry = metrics.Registry()
+
+  def tearDown(self):
+    metrics.registry = self._registry
+
+  def _mesh(self, conflicts):
+    mesh = FakeMesh(["a", "b"], [NS], {"conflicts": conflicts})
+    mesh.collection("a", NS).insert({"_id": 1, "x": "initial"})
+    mesh.pump()
+    return mesh
+
+  def _write_concurrently(self, mesh, timestamps):
+    """
+    Both masters update the document before either sees the other's write
+    :param timestamps: dict of node to the source_ts its write is stamped with
+    """
+    for node in ("a", "b"):
+      mesh.collection(node, NS).update({"_id": 1}, {"$set": {"x": node}})
+    # a's oplog is tailed first in every round, then b's
+    with patch.object(AggregateReplicator, "timestamp", side_effect=[timestamps["a"], timestamps["b"]]):
+      mesh.pump()
+    return [mesh.collection(node, NS).find_one({"_id": 1})["x"] for node in ("a", "b")]
+
+  def _conflicts(self):
+    return sum(metric.value for metric in metrics.registry.metrics() if metric.name == "conflicts")
+
+  def test_last_writer_wins(self):
+    self.assertEquals(["b", "b"], self._write_concurrently(self._mesh({"policy": "lww"}), {"a": 1000, "b": 2000}))
+    self.assertEquals(0, self._conflicts())
+    # b's write lost against a's, which b applied before writing its own metadata back
+    self.assertEquals(["a", "a"], self._write_concurrently(self._mesh({"policy": "lww"}), {"a": 2000, "b": 1000}))
+    self.assertTrue(self._conflicts() > 0)
+
+  def test_ties_go_to_the_higher_source_id(self):
+    self.assertEquals(["b", "b"], self._write_concurrently(self._mesh({"policy": "lww"}), {"a": 1000, "b": 1000}))
+
+  def test_first_writer_wins_within_the_window(self):
+    mesh = self._mesh({"policy": "fww", "window_ms": 5000})
+    self.assertEquals(["a", "a"], self._write_concurrently(mesh, {"a": 1000, "b": 2000}))
+    # further apart than the window, the later write wins
+    self.assertEquals(["b", "b"], self._write_concurrently(mesh, {"a": 3000, "b": 9000}))
+
+  def test_custom_policy(self):
+    calls = []
+    def policy(metadata):
+      # a always wins, b only overwrites its own writes
+      calls.append(metadata["source"])
+      return None if metadata["source"] == "a" else {"__mmm.source": "b"}
+    mesh = self._mesh({"policy": policy})
+    self.assertEquals(["a", "a"], self._write_concurrently(mesh, {"a": 1000, "b": 2000}))
+    self.assertTrue("a" in calls and "b" in calls)
+
+  def test_lost_writes_are_counted_without_default_acknowledgement(self):
+    # as with a pymongo Connection, writes without a write concern return None
+    collection = UnacknowledgedCollection([{"_id": 1, "__mmm": {"source_ts": 2000}}])
+    writer = BulkWriter()
+    writer.add(WriteOp('c', {"_id": 1, "__mmm.source_ts": {"$lt": 1000}}, {"$set": {"x": 1}}, False, None))
+    writer.add(WriteOp('c', {"_id": 1, "__mmm.source_ts": {"$lt": 1000}}, {"_id": 1}, True, None))
+    writer.write(collection)
+    self.assertEquals(2, writer.conflicts)
+
+    aggregate = AggregateReplicator("a", "mongodb://a", "foodb", "barcol", fake_connections({}))
+    aggregate._collection = collection
+    aggregate.conflict_policy = last_writer_wins
+    with patch.object(AggregateReplicator, "timestamp", return_value=1000):
+      aggregate.replicate_local_write({"$set": {"x": 1}}, {"_id": 1}, "u", NS, True)
+    self.assertEquals(1, self._conflicts())
+
+  def test_policy_from_config(self):
+    self.assertEquals(None, policy_from_config(None))
+    self.assertEquals(last_writer_wins, policy_from_config({"policy": "lww"}))
+    self.assertEquals(250, policy_from_config({"policy": "fww", "window_ms": 250}).window_ms)
+    self.assertEquals(last_writer_wins, policy_from_config({"policy": "mmm.conflicts.last_writer_wins"}))
+    self.assertRaises(ValueError, policy_from_config, {"policy": "newest"})
+    self.assertTrue(isinstance(policy_from_config({"policy": "fww"}), FirstWriterWins))
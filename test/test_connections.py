@@ -0,0 +1,75 @@
+from unittest import TestCase
+import gevent
+from mock import MagicMock
+from pymongo.errors import AutoReconnect
+from mmm.connections import ConnectionManager
+
+class ConnectionManagerTest(TestCase):
+
+  def setUp(self):
+    self.factory = MagicMock(side_effect=lambda uri, *args, **kwargs: MagicMock(name=uri))
+    self.manager = ConnectionManager(self.factory)
+
+  def test_one_connection_per_uri(self):
+    first, generation = self.manager.connect("mongodb://a")
+    second, _ = self.manager.connect("mongodb://a")
+    other, _ = self.manager.connect("mongodb://b")
+
+    self.assertIs(first, second)
+    self.assertIsNot(first, other)
+    self.assertEquals(0, generation)
+    self.assertEquals(2, self.factory.call_count)
+
+  def test_connection_options_are_part_of_the_key(self):
+    plain, _ = self.manager.connect("mongodb://a")
+    tuned, _ = self.manager.connect("mongodb://a", None, max_pool_size=50)
+
+    self.assertIsNot(plain, tuned)
+    self.factory.assert_called_with("mongodb://a", max_pool_size=50)
+
+  def test_reconnects_once_per_failure(self):
+    connection, seen = self.manager.connect("mongodb://a")
+    # every component using the connection reports the failure of the same generation
+    results = [self.manager.connect("mongodb://a", seen) for _ in range(3)]
+
+    self.assertEquals(1, connection.disconnect.call_count)
+    connection.admin.command.assert_called_once_with("ping")
+    self.assertEquals([(connection, seen + 1)] * 3, results)
+
+  def test_concurrent_failures_wait_for_one_reconnect(self):
+    connection, seen = self.manager.connect("mongodb://a")
+    connection.admin.command.side_effect = lambda *args: gevent.sleep(0.01)
+    greenlets = [gevent.spawn(self.manager.connect, "mongodb://a", seen) for _ in range(5)]
+    gevent.joinall(greenlets)
+
+    self.assertEquals(1, connection.disconnect.call_count)
+    self.assertEquals([seen + 1] * 5, [g.value[1] for g in greenlets])
+
+  def test_failed_reconnect_is_retried(self):
+    connection, seen = self.manager.connect("mongodb://a")
+    connection.admin.command.side_effect = AutoReconnect("down")
+    self.assertRaises(AutoReconnect, self.manager.connect, "mongodb://a", seen)
+
+    connection.admin.command.side_effect = None
+    self.assertEquals(seen + 1, self.manager.connect("mongodb://a", seen)[1])
+    self.assertEquals(2, connection.disconnect.call_count)
+
+  def test_healthy(self):
+    self.assertFalse(self.manager.healthy("mongodb://a"))
+    connection, _ = self.manager.connect("mongodb://a")
+    connection.alive.return_value = True
+    self.assertTrue(self.manager.healthy("mongodb://a"))
+
+class SharedConnectionsTest(TestCase):
+
+  def test_components_share_one_connection_per_server(self):
+    from mmm.testing import FakeMesh
+    mesh = FakeMesh(["a", "b", "c"], ["foodb.barcol", "foodb.bazcol"])
+    engine = mesh.engines["a"]
+    aggregates = list(engine.triggers._unique_callbacks())
+    replicators = [r for aggregate in aggregates for r in aggregate._unique_replicators()]
+
+    self.assertEquals(3, len(mesh.connections._connections))
+    self.assertEquals([engine._connection] * 2, [aggregate._connection for aggregate in aggregates])
+    self.assertEquals(set([mesh.uri("b"), mesh.uri("c")]), set(r.destination_uri for r in replicators))
+    self.assertEquals(2, len(set(id(r._connection) for r in replicators)))
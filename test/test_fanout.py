@@ -0,0 +1,123 @@
+from unittest import TestCase
+import bson
+from bson.errors import InvalidDocument
+import gevent
+import gevent.event
+from mock import MagicMock
+from mmm import metrics
+from mmm.batching import BulkWriter
+from mmm.connections import ConnectionManager
+from mmm.fanout import DestinationQueue
+from mmm.metadata import MMM_METADATA
+from mmm.replication import Replicator
+from mmm.testing import FakeCollection
+
+class StubWriter(object):
+
+  def __len__(self):
+    return 0
+
+class StubReplicator(object):
+
+  def __init__(self, destination_id):
+    self.source_id = "source"
+    self.destination_id = destination_id
+    self.destination_namespace = "foodb.barcol"
+    self.writer = StubWriter()
+    self.replicated = []
+    self.healthy = gevent.event.Event()
+    self.healthy.set()
+
+  def replicate(self, op, ns, o, o2=None, b=False, ts=None):
+    self.healthy.wait()
+    self.replicated.append(ts)
+
+  def flush(self):
+    pass
+
+  def oldest_pending(self):
+    return None
+
+class DestinationQueueTest(TestCase):
+
+  def setUp(self):
+    self.fast = StubReplicator("fast")
+    self.slow = StubReplicator("slow")
+    self.slow.healthy.clear()
+    self.fast_queue = DestinationQueue(self.fast, 10)
+    self.slow_queue = DestinationQueue(self.slow, 10)
+
+  def tearDown(self):
+    self.fast_queue.close()
+    self.slow_queue.close()
+
+  def _replicate(self, count):
+    for i in range(count):
+      ts = bson.Timestamp(1000, i)
+      for queue in (self.fast_queue, self.slow_queue):
+        queue.replicate("i", "foodb.barcol", {"_id": i}, ts=ts)
+
+  def test_slow_destination_does_not_block_others(self):
+    self._replicate(5)
+    gevent.sleep(0)
+
+    self.assertEquals([bson.Timestamp(1000, i) for i in range(5)], self.fast.replicated)
+    self.assertEquals([], self.slow.replicated)
+    self.assertEquals(None, self.fast_queue.oldest_pending())
+    self.assertEquals(bson.Timestamp(1000, 0), self.slow_queue.oldest_pending())
+    self.assertTrue(self.slow_queue.depth() >= 4)
+    self.assertTrue(self.slow_queue.lag() >= 0)
+
+  def test_unhealthy_destination_catches_up_in_order(self):
+    self._replicate(5)
+    gevent.sleep(0)
+    self.slow.healthy.set()
+    gevent.sleep(0.01)
+
+    self.assertEquals([bson.Timestamp(1000, i) for i in range(5)], self.slow.replicated)
+    self.assertEquals(None, self.slow_queue.oldest_pending())
+    self.assertEquals(0, self.slow_queue.lag())
+
+  def test_full_queue_blocks_producer(self):
+    producer = gevent.spawn(self._replicate, 20)
+    gevent.sleep(0.01)
+
+    self.assertFalse(producer.ready())
+    self.slow.healthy.set()
+    producer.join(1)
+    self.assertTrue(producer.successful())
+
+class FatalErrorTest(TestCase):
+
+  def setUp(self):
+    self.replicator = Replicator("source", "destination", "uri", "foodb", "barcol", ConnectionManager(MagicMock()))
+    self.replicator._collection = FakeCollection()
+    self.replicator.writer = BulkWriter(size=1)
+    self.queue = DestinationQueue(self.replicator, 10)
+
+  def tearDown(self):
+    self.queue.close()
+    metrics.registry.remove(source="source")
+
+  def test_write_failing_with_a_fatal_error_is_skipped(self):
+    # a duplicate key fails however often the insert is retried
+    self.replicator._collection.insert({"_id": 0})
+    for i in range(2):
+      self.queue.replicate("i", "foodb.barcol", {"_id": i, MMM_METADATA: {"source_ts": 1}}, ts=bson.Timestamp(1000, i))
+
+    with gevent.Timeout(1):
+      while self.queue.oldest_pending() is not None:
+        gevent.sleep(0.01)
+    self.assertEquals([0, 1], [document["_id"] for document in self.replicator._collection.documents])
+
+  def test_unhandled_fatal_error_stops_the_queue(self):
+    self.replicator._collection.fail(InvalidDocument("BSON document too large"), "insert", times=10)
+    for i in range(2):
+      self.queue.replicate("i", "foodb.barcol", {"_id": i, MMM_METADATA: {"source_ts": 1}}, ts=bson.Timestamp(1000, i))
+    gevent.sleep(0.01)
+
+    self.assertEquals(bson.Timestamp(1000, 0), self.queue.oldest_pending())
+    self.assertRaises(InvalidDocument, self.queue.flush)
+    self.assertRaises(InvalidDocument, self.queue.drain)
+    self.assertRaises(InvalidDocument, self.queue.replicate, "i", "foodb.barcol", {"_id": 2}, ts=bson.Timestamp(1000, 2))
+    self.assertEquals([], self.replicator._collection.documents)
@@ -0,0 +1,86 @@
+from unittest import TestCase
+from bson.json_util import dumps
+from mock import patch
+import bson
+import datetime
+import hashlib
+from mmm.hashing import DocumentDigest, HASH_FAST, HASH_LEGACY, HASH_MD5, hash_document, ordered
+from mmm.replication import AggregateReplicator, MMM_METADATA
+from mmm.testing import FakeMesh
+
+DOCUMENT = {
+  "_id": bson.ObjectId("51d2daa81fa97fc9611102cf"),
+  "name": u"caf\xe9",
+  "count": 3,
+  "ratio": 0.5,
+  "tags": ["a", {"b": 1, "a": [None, True]}],
+  "created": datetime.datetime(2013, 7, 2, 12, 0),
+  MMM_METADATA: {"source": "a", "hash": "whatever"}
+}
+
+class HashDocumentTest(TestCase):
+
+  def test_legacy_hash_is_unchanged(self):
+    without_mmm = dict((k, v) for k, v in DOCUMENT.iteritems() if k != MMM_METADATA)
+    expected = hashlib.md5(dumps(ordered(without_mmm))).hexdigest()
+    self.assertEquals(expected, AggregateReplicator.hash(DOCUMENT))
+    self.assertEquals(expected, hash_document(DOCUMENT, HASH_LEGACY, MMM_METADATA))
+
+  def test_prefixed_with_algorithm(self):
+    self.assertTrue(hash_document(DOCUMENT, HASH_MD5).startswith("md5:"))
+    self.assertTrue(hash_document(DOCUMENT, HASH_FAST).startswith("fast:"))
+
+  def test_key_order_and_metadata_do_not_matter(self):
+    reordered = dict(reversed(DOCUMENT.items()))
+    reordered["tags"] = ["a", {"a": [None, True], "b": 1}]
+    reordered[MMM_METADATA] = {"source": "b"}
+    for algorithm in (HASH_MD5, HASH_FAST):
+      self.assertEquals(hash_document(DOCUMENT, algorithm, MMM_METADATA), hash_document(reordered, algorithm, MMM_METADATA))
+
+  def test_content_and_types_matter(self):
+    for algorithm in (HASH_MD5, HASH_FAST):
+      original = hash_document({"a": 1}, algorithm)
+      self.assertNotEquals(original, hash_document({"a": 2}, algorithm))
+      self.assertNotEquals(original, hash_document({"a": "1"}, algorithm))
+      self.assertNotEquals(original, hash_document({"a": [1]}, algorithm))
+      self.assertNotEquals(hash_document({"a": "bc"}, algorithm), hash_document({"ab": "c"}, algorithm))
+
+  def test_unknown_algorithm(self):
+    self.assertRaises(ValueError, hash_document, DOCUMENT, "sha0")
+
+class DocumentDigestTest(TestCase):
+
+  def test_matches_any_stored_format(self):
+    digest = DocumentDigest(DOCUMENT, HASH_FAST, MMM_METADATA)
+    for algorithm in (HASH_LEGACY, HASH_MD5, HASH_FAST):
+      self.assertTrue(digest.matches(hash_document(DOCUMENT, algorithm, MMM_METADATA)))
+    self.assertFalse(digest.matches(hash_document({"other": 1}, HASH_FAST)))
+    self.assertFalse(digest.matches("crc7:0000"))
+
+  def test_hashes_once_per_algorithm(self):
+    with patch("mmm.hashing.hash_document", side_effect=hash_document) as hashed:
+      digest = DocumentDigest(DOCUMENT, HASH_FAST, MMM_METADATA)
+      digest.hexdigest()
+      digest.matches(digest.hexdigest())
+      self.assertEquals(1, hashed.call_count)
+
+  def test_local_write_hashed_once(self):
+    mesh = FakeMesh(["a", "b"], ["foodb.barcol"], {"hash": HASH_FAST})
+    mesh.collection("a", "foodb.barcol").update({"_id": 1}, {"_id": 1, "x": 1, MMM_METADATA: {"hash": "fast:0123456789abcdef"}}, True)
+    with patch("mmm.hashing.hash_document", side_effect=hash_document) as hashed:
+      mesh.engines["a"].triggers._tail_oplog(bson.Timestamp(0, 0))
+      self.assertEquals(1, hashed.call_count)
+    stored = mesh.collection("b", "foodb.barcol").documents[0][MMM_METADATA]["hash"]
+    self.assertTrue(stored.startswith("fast:"))
+
+  def test_mixed_algorithms_settle(self):
+    mesh = FakeMesh(["a", "b"], ["foodb.barcol"], {"hash": HASH_FAST})
+    # b has not been switched over yet
+    for callbacks in mesh.engines["b"].triggers._callbacks.values():
+      for aggregate in callbacks:
+        aggregate.hash_algorithm = HASH_LEGACY
+    mesh.collection("a", "foodb.barcol").insert({"_id": 1, "x": 1})
+    mesh.collection("b", "foodb.barcol").insert({"_id": 2, "x": 2})
+    mesh.pump()
+    self.assertEquals(2, mesh.collection("a", "foodb.barcol").count())
+    self.assertEquals(2, mesh.collection("b", "foodb.barcol").count())
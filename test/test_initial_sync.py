@@ -0,0 +1,84 @@
+from unittest import TestCase
+import bson
+from mock import patch
+from pymongo.errors import AutoReconnect, OperationFailure
+from mmm.initial_sync import InitialSync
+from mmm.testing import FakeMesh, UnacknowledgedCollection
+
+NS = "foodb.barcol"
+
+class InitialSyncTest(TestCase):
+
+  def setUp(self):
+    self.mesh = FakeMesh(["a", "b"], [NS], {"checkpoint": {"ops": 1}, "initial_sync": {"partitions": 4, "batch_size": 3}})
+    self.a = self.mesh.collection("a", NS)
+    self.b = self.mesh.collection("b", NS)
+    for i in range(20):
+      self.a.insert({"_id": i, "x": i})
+    # documents written before replication was set up, the oplog no longer has them
+    self.mesh.server("a").oplog._documents.clear()
+    self.engine = self.mesh.engines["a"]
+
+  def _content(self, collection):
+    return sorted((d["_id"], d["x"]) for d in collection.documents)
+
+  def test_copies_existing_documents_with_metadata(self):
+    self.assertEquals(20, self.engine.initial_sync())
+
+    self.assertEquals(self._content(self.a), self._content(self.b))
+    metadata = self.b.documents[0]["__mmm"]
+    self.assertEquals("a", metadata["source"])
+    self.assertEquals(metadata["source_ts"], metadata["b"])
+    # 4 partitions of 5 documents in batches of at most 3
+    self.assertEquals(8, self.b.calls["insert"])
+
+    # the copies are recognized as replicated, b only acknowledges them
+    self.mesh.pump()
+    self.assertEquals(self._content(self.a), self._content(self.b))
+    self.assertEquals(20, len(self.b.documents))
+
+  def test_writes_during_the_copy_are_replayed(self):
+    def write_during_copy():
+      self.a.insert({"_id": 20, "x": 20})
+      self.a.update({"_id": 3}, {"$set": {"x": 33}})
+      return []
+    with patch.object(InitialSync, "_bounds", side_effect=write_during_copy):
+      self.engine.initial_sync()
+    self.mesh.pump()
+
+    self.assertEquals(self._content(self.a), self._content(self.b))
+    self.assertEquals((3, 33), self._content(self.b)[3])
+
+  def test_interrupted_sync_resumes(self):
+    insert = InitialSync._insert
+    batches = []
+    def fail_third_batch(sync, key, batch):
+      batches.append(key)
+      if len(batches) == 3:
+        raise AutoReconnect("connection reset")
+      return insert(sync, key, batch)
+    with patch.object(InitialSync, "_insert", fail_third_batch):
+      self.assertRaises(AutoReconnect, self.engine.initial_sync)
+
+    # only the partition that failed is copied again
+    self.assertEquals(5, self.engine.initial_sync())
+    self.assertEquals(self._content(self.a), self._content(self.b))
+    self.assertEquals(8, self.b.calls["insert"])
+    self.assertEquals(0, self.engine.initial_sync())
+
+  def test_failed_batch_is_not_recorded_as_copied(self):
+    sync = InitialSync("a", self.mesh.uri("a"), "b", self.mesh.uri("b"), NS, NS, self.engine.checkpoints,
+      self.mesh.connections, 1, 5)
+    # writes are not acknowledged unless asked for, as with a pymongo 2 Connection
+    sync._destination = UnacknowledgedCollection()
+    sync._destination.fail(OperationFailure("no space left on device", 14031), "insert")
+
+    self.assertRaises(OperationFailure, sync.run)
+    state = sync._progress.find_one({"_id": sync._progress_id})
+    self.assertFalse(any("last" in partition for partition in state["partitions"].values()))
+
+  def test_replicated_namespaces_are_not_copied(self):
+    self.engine.checkpoints.save("b", NS, bson.Timestamp(1, 1))
+
+    self.assertEquals(0, self.engine.initial_sync())
+    self.assertEquals([], self.b.documents)
@@ -0,0 +1,140 @@
+from unittest import TestCase
+import bson
+import gevent
+import gevent.event
+import time
+from mmm.lanes import ApplyLanes
+from mmm.testing import FakeMesh
+
+NS = "foodb.barcol"
+
+def op(i, _id, op="u"):
+  op_doc = {"ts": bson.Timestamp(1000, i), "op": op, "ns": NS, "o": {"$set": {"x": i}}, "o2": {"_id": _id}}
+  if op != "u":
+    op_doc["o"] = {"_id": _id}
+    del op_doc["o2"]
+  return op_doc
+
+class StubLane(object):
+
+  def __init__(self, latency=0):
+    self.latency = latency
+    self.applied = []
+    self.healthy = gevent.event.Event()
+    self.healthy.set()
+    self.failures = 0
+    self.positions = []
+
+  def __call__(self, ts, op, ns, o, o2=None):
+    self.healthy.wait()
+    if self.failures:
+      self.failures -= 1
+      raise RuntimeError("destination down")
+    gevent.sleep(self.latency)
+    self.applied.append(((o2 or o)["_id"], ts))
+
+  def save_positions(self, last_applied):
+    self.positions.append(last_applied)
+
+class ApplyLanesTest(TestCase):
+
+  def _lanes(self, count, latency=0):
+    self.stubs = [StubLane(latency) for _ in range(count)]
+    self.lanes = ApplyLanes("source", NS, self.stubs, 100)
+
+  def tearDown(self):
+    self.lanes.close()
+
+  def test_ops_on_a_document_stay_ordered_on_one_lane(self):
+    self._lanes(4)
+    for i in range(40):
+      self.lanes(**op(i, i % 8))
+    self.lanes.drain()
+
+    for _id in range(8):
+      lanes = [n for n, stub in enumerate(self.stubs) if any(applied_id == _id for applied_id, _ in stub.applied)]
+      self.assertEquals(1, len(lanes))
+      applied = [ts for applied_id, ts in self.stubs[lanes[0]].applied if applied_id == _id]
+      self.assertEquals([bson.Timestamp(1000, i) for i in range(_id, 40, 8)], applied)
+    self.assertEquals(40, sum(len(stub.applied) for stub in self.stubs))
+
+  def test_lanes_apply_in_parallel(self):
+    self._lanes(4, latency=0.01)
+    started = time.time()
+    for i in range(40):
+      self.lanes(**op(i, i))
+    self.lanes.drain()
+
+    # serially this would take 0.4 seconds
+    self.assertTrue(time.time() - started < 0.3)
+    self.assertTrue(all(stub.applied for stub in self.stubs))
+
+  def test_slowest_lane_holds_the_checkpoint(self):
+    self._lanes(2)
+    blocked = self.lanes.lanes[hash((NS, 0)) % 2]
+    blocked.healthy.clear()
+    for i in range(10):
+      self.lanes(**op(i, i))
+    gevent.sleep(0)
+
+    self.assertEquals(bson.Timestamp(1000, 0), self.lanes.oldest_pending())
+    self.lanes.save_positions(bson.Timestamp(1000, 9))
+    self.assertEquals([bson.Timestamp(999, 4294967295)] * 2, [stub.positions[-1] for stub in self.stubs])
+
+    blocked.healthy.set()
+    self.lanes.drain()
+    self.assertEquals(None, self.lanes.oldest_pending())
+    self.lanes.save_positions(bson.Timestamp(1000, 9))
+    self.assertEquals([bson.Timestamp(1000, 9)] * 2, [stub.positions[-1] for stub in self.stubs])
+
+  def test_flush_does_not_wait_for_the_lanes(self):
+    self._lanes(2)
+    blocked = self.lanes.lanes[hash((NS, 0)) % 2]
+    blocked.healthy.clear()
+    for i in range(10):
+      self.lanes(**op(i, i))
+
+    with gevent.Timeout(1):
+      self.lanes.flush()
+    self.assertEquals(bson.Timestamp(1000, 0), self.lanes.oldest_pending())
+    blocked.healthy.set()
+
+  def test_failed_lane_is_replayed_from_the_checkpoint(self):
+    self._lanes(2)
+    failing = self.lanes.lanes[hash((NS, 0)) % 2]
+    healthy = self.stubs[1 - self.stubs.index(failing)]
+    failing.failures = 1
+    for i in range(10):
+      self.lanes(**op(i, i))
+    self.assertRaises(RuntimeError, self.lanes.drain)
+    self.assertEquals(bson.Timestamp(1000, 0), self.lanes.oldest_pending())
+    healthy_applied = list(healthy.applied)
+
+    # Triggers replays everything after its checkpoint
+    for i in range(10):
+      self.lanes(**op(i, i))
+    self.lanes.drain()
+
+    self.assertEquals(healthy_applied, healthy.applied)
+    self.assertEquals(10, len(failing.applied) + len(healthy.applied))
+    self.assertEquals(None, self.lanes.oldest_pending())
+
+class ParallelApplyTest(TestCase):
+
+  def test_mesh_converges_with_lanes(self):
+    mesh = FakeMesh(["a", "b"], [NS], {"parallel_apply": {"lanes": 4}, "checkpoint": {"ops": 1}})
+    a, b = mesh.collection("a", NS), mesh.collection("b", NS)
+    for i in range(20):
+      a.insert({"_id": i, "x": i})
+    mesh.pump()
+    for i in range(0, 20, 2):
+      b.update({"_id": i}, {"$set": {"x": -i}})
+    for i in range(0, 20, 5):
+      a.remove({"_id": i})
+    mesh.pump()
+
+    content = lambda collection: sorted((d["_id"], d["x"]) for d in collection.documents)
+    self.assertEquals([(i, -i if i % 2 == 0 else i) for i in range(20) if i % 5], content(a))
+    self.assertEquals(content(a), content(b))
+    for engine in mesh.engines.values():
+      engine.close()
@@ -0,0 +1,91 @@
+from unittest import TestCase
+import datetime
+from mock import MagicMock
+from mmm.connections import ConnectionManager
+from mmm.members import OplogSource
+from mmm.testing import FakeServer, fake_connections
+from mmm.triggers import Triggers
+
+SOURCE = "mongodb://rs0"
+NOW = datetime.datetime(2014, 1, 1)
+
+def member(name, state, behind=0, health=1):
+  return {"name": name, "stateStr": state, "health": health, "optimeDate": NOW - datetime.timedelta(seconds=behind)}
+
+class OplogSourceTest(TestCase):
+
+  def setUp(self):
+    self.members = [member("h1:27017", "PRIMARY"), member("h2:27017", "SECONDARY", 2),
+      member("h3:27017", "SECONDARY", 1), member("h4:27017", "SECONDARY", 0)]
+    self.tags = {"h2:27017": {"dc": "east"}, "h3:27017": {"dc": "east"}, "h4:27017": {"dc": "west"}}
+    self.latencies = {"h2:27017": 0.001, "h3:27017": 0.005, "h4:27017": 0.0005}
+    self.connections = ConnectionManager(self._connect)
+    self.source = OplogSource("a", SOURCE, self.connections, tags={"dc": "east"}, max_lag_seconds=10)
+    self.source._ping = lambda host: self.latencies[host]
+
+  def _connect(self, uri, *args, **kwargs):
+    connection = MagicMock()
+    connection.admin.command.side_effect = lambda name: {"members": self.members}
+    connection.local.system.replset.find_one.side_effect = lambda: {"members": [{"host": host, "tags": tags}
+      for host, tags in self.tags.iteritems()]}
+    return connection
+
+  def test_selects_the_fastest_tagged_secondary(self):
+    self.assertEquals("h2:27017", self.source.select())
+    self.assertEquals(2, self.source.lag)
+
+  def test_falls_back_to_the_primary(self):
+    self.members[1] = member("h2:27017", "SECONDARY", 60)
+    self.assertEquals("h3:27017", self.source.select())
+    self.assertEquals(None, self.source.select(exclude=["h3:27017"]))
+
+    # back to a secondary once one qualifies again
+    self.members[1] = member("h2:27017", "SECONDARY", 1)
+    self.assertTrue(self.source.check())
+
+  def test_lagging_member_is_replaced(self):
+    self.source.select()
+    self.assertFalse(self.source.check())
+
+    self.members[1] = member("h2:27017", "SECONDARY", 30)
+    self.assertTrue(self.source.check())
+    self.assertEquals(30, self.source.lag)
+    self.assertEquals("h3:27017", self.source.select(exclude=[self.source.host]))
+
+  def test_member_that_went_away_is_replaced(self):
+    self.source.select()
+    self.members[1] = member("h2:27017", "(not reachable/healthy)", 0, health=0)
+
+    self.assertTrue(self.source.check())
+    self.assertEquals("h3:27017", self.source.select())
+
+  def test_from_config(self):
+    self.assertEquals(None, OplogSource.from_config("a", SOURCE, self.connections, None))
+    source = OplogSource.from_config("a", SOURCE, self.connections, {"read_from": "secondary", "max_lag_seconds": 5})
+    self.assertEquals(5, source.max_lag_seconds)
+    self.assertRaises(ValueError, OplogSource.from_config, "a", SOURCE, self.connections, {"read_from": "nearest"})
+
+class SecondaryTailingTest(TestCase):
+
+  def setUp(self):
+    self.servers = {SOURCE: FakeServer()}
+    self.triggers = Triggers("a", SOURCE)
+    self.triggers.connections = fake_connections(self.servers)
+    self.triggers.oplog_source = MagicMock()
+    self.triggers.oplog_source.host = None
+    self.triggers.oplog_source.select.return_value = "h2:27017"
+
+  def test_tails_the_secondary_and_checkpoints_on_the_source(self):
+    self.triggers.connect()
+
+    self.assertTrue(self.triggers._oplog is self.servers["mongodb://h2:27017"].collection("local.oplog.rs"))
+    self.assertTrue(self.triggers._checkpoint is self.servers[SOURCE].collection("local.mmm"))
+
+  def test_reconnect_fails_over_to_another_member(self):
+    self.triggers.connect()
+    self.triggers.oplog_source.host = "h2:27017"
+    self.triggers.oplog_source.select.return_value = "h3:27017"
+    self.triggers.connect()
+
+    self.triggers.oplog_source.select.assert_called_with(exclude=["h2:27017"])
+    self.assertTrue(self.triggers._oplog is self.servers["mongodb://h3:27017"].collection("local.oplog.rs"))
@@ -0,0 +1,100 @@
+from unittest import TestCase
+from mock import patch
+from mmm import metrics
+from mmm.metrics import MetricsServer, Registry
+from mmm.testing import FakeMesh
+
+NS = "foodb.barcol"
+
+class RegistryTest(TestCase):
+
+  def setUp(self):
+    self.registry = Registry()
+
+  def test_same_name_and_labels_is_the_same_metric(self):
+    counter = self.registry.counter("ops", ns="a")
+    self.assertIs(counter, self.registry.counter("ops", ns="a"))
+    self.assertIsNot(counter, self.registry.counter("ops", ns="b"))
+
+  def test_histogram_quantiles(self):
+    histogram = self.registry.histogram("latency")
+    self.assertEquals(None, histogram.quantile(0.5))
+    for _ in range(99):
+      histogram.observe(0.001)
+    histogram.observe(1)
+
+    self.assertTrue(0.001 <= histogram.quantile(0.5) < 0.002)
+    self.assertTrue(0.001 <= histogram.quantile(0.99) < 0.002)
+    self.assertTrue(1 <= histogram.quantile(1) < 2)
+    self.assertEquals(100, histogram.count)
+
+  def test_render(self):
+    self.registry.counter("ops", ns="foo.bar").inc(3)
+    self.registry.gauge("depth", lambda: 7)
+    self.registry.gauge("broken", lambda: 1 / 0)
+    self.registry.histogram("latency").observe(0.5)
+    lines = self.registry.render().splitlines()
+
+    self.assertIn('ops{ns="foo.bar"} 3', lines)
+    self.assertIn('depth 7', lines)
+    self.assertIn('latency_bucket{le="+Inf"} 1', lines)
+    self.assertIn('latency_count 1', lines)
+    self.assertFalse(any(line.startswith("broken") for line in lines))
+
+  def test_summary_and_remove(self):
+    self.registry.counter("ops", source="a").inc()
+    self.registry.counter("ops", source="b").inc(2)
+    self.registry.remove(source="a")
+    self.assertEquals({'ops{source="b"}': 2}, self.registry.summary())
+
+  def test_server(self):
+    self.registry.counter("ops").inc()
+    server = MetricsServer(0, registry=self.registry)
+    responses = []
+    body = server.application({"PATH_INFO": "/metrics"}, lambda status, headers: responses.append(status))
+
+    self.assertEquals(["200 OK"], responses)
+    self.assertEquals("ops 1\n", "".join(body))
+
+class StartTest(TestCase):
+
+  def test_nothing_is_started_by_default(self):
+    self.assertEquals((None, None), metrics.start(None))
+    self.assertEquals((None, None), metrics.start({}))
+
+  def test_logger_is_opt_in(self):
+    server, logger = metrics.start({"log_interval": 30})
+    self.assertEquals(None, server)
+    self.assertEquals(30, logger.interval)
+    logger.stop()
+
+class ReplicationMetricsTest(TestCase):
+
+  def test_replication_is_instrumented(self):
+    mesh = FakeMesh(["metrics-a", "metrics-b"], [NS], {"checkpoint": {"ops": 1}, "hash": "fast"})
+    mesh.collection("metrics-a", NS).insert({"_id": 1})
+    mesh.pump()
+    registry = metrics.registry
+
+    # the insert, its metadata write back and the acknowledgement from metrics-b
+    self.assertEquals(3, registry.counter("oplog_ops", source="metrics-a", ns=NS).value)
+    self.assertEquals(3, registry.histogram("oplog_apply_seconds", source="metrics-a").count)
+    self.assertEquals(3, registry.histogram("oplog_read_seconds", source="metrics-a").count)
+    # the insert and the acknowledgement of the copy on metrics-b
+    self.assertEquals(2, registry.counter("destination_writes", source="metrics-a", destination="metrics-b", ns=NS).value)
+    self.assertEquals(2, registry.histogram("destination_write_seconds", source="metrics-a", destination="metrics-b", ns=NS).count)
+    self.assertTrue(registry.histogram("hash_seconds", algorithm="fast").count > 0)
+    self.assertEquals(0, registry.get("checkpoint_lag_seconds", source="metrics-a").value)
+
+  def test_lag_gauges_do_not_query_the_source(self):
+    mesh = FakeMesh(["lag-a", "lag-b"], [NS], {"checkpoint": {"ops": 1}})
+    mesh.collection("lag-a", NS).insert({"_id": 1})
+    mesh.pump()
+    triggers = mesh.engines["lag-a"].triggers
+    newest = triggers._newest_seen
+
+    with patch.object(mesh.server("lag-a").oplog, "find_one") as find_one:
+      self.assertEquals(0, metrics.registry.get("oplog_lag_seconds", source="lag-a").value)
+      triggers._persisted = type(newest)(newest.time - 5, 0)
+      self.assertEquals(5, metrics.registry.get("checkpoint_lag_seconds", source="lag-a").value)
+    self.assertFalse(find_one.called)
@@ -0,0 +1,48 @@
+from unittest import TestCase
+import bson
+from mock import MagicMock
+from mmm.oplog import OplogOp, dispatch
+
+NS = "foodb.barcol"
+
+def entry():
+  return {"ts": bson.Timestamp(1000, 1), "h": 7L, "v": 2, "op": "u", "ns": NS,
+    "o": {"$set": {"a": [1, {"b": u"c"}], "d": bson.Binary("x" * 10)}}, "o2": {"_id": bson.ObjectId()}}
+
+class OplogOpTest(TestCase):
+
+  def test_fields_read_by_attribute_and_key(self):
+    doc = entry()
+    op = OplogOp.from_document(dict(doc, extra=1))
+
+    self.assertEquals((doc["ts"], 7L, 2, "u", NS), (op.ts, op.h, op.v, op.op, op.ns))
+    self.assertEquals(doc["o2"], op["o2"])
+    self.assertEquals(None, op.b)
+    self.assertEquals(False, op.get("b", False))
+    self.assertRaises(KeyError, lambda: op["extra"])
+    self.assertEquals(doc, op.document())
+
+  def test_op_is_immutable(self):
+    op = OplogOp.from_document(entry())
+    def assign():
+      op.ns = "other.ns"
+    self.assertRaises(AttributeError, assign)
+
+    replaced = op.replace(o={"$set": {"a": 2}})
+    self.assertEquals({"$set": {"a": 2}}, replaced.o)
+    self.assertEquals((op.ts, op.o2), (replaced.ts, replaced.o2))
+    self.assertEquals(entry()["o"], op.o)
+
+  def test_dispatch(self):
+    class Consumer(object):
+      def __init__(self):
+        self.ops = []
+      def apply_op(self, op):
+        self.ops.append(op)
+    op = OplogOp.from_document(entry())
+    consumer, function = Consumer(), MagicMock()
+    dispatch(consumer, op)
+    dispatch(function, op)
+
+    self.assertEquals([op], consumer.ops)
+    function.assert_called_once_with(**op.document())
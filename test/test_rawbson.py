@@ -0,0 +1,120 @@
+from unittest import TestCase
+import bson
+from bson.son import SON
+from mock import MagicMock
+from pymongo import message
+from pymongo.errors import DuplicateKeyError, OperationFailure
+import struct
+from mmm import rawbson
+from mmm.rawbson import RawDocument
+from mmm.testing import FakeServer
+
+def messages(data):
+  """
+  :return: the wire protocol messages in data, without their request ids
+  """
+  parts = []
+  while data:
+    length = struct.unpack("<i", data[:4])[0]
+    parts.append(data[:4] + data[8:length])
+    data = data[length:]
+  return parts
+
+class RawDocumentTest(TestCase):
+
+  def setUp(self):
+    self.document = SON([("_id", 1), ("a", "x"), ("__mmm", {"old": 1}), ("b", [1, 2])])
+    self.raw = RawDocument.encode(self.document, "__mmm", {"source": "a"})
+
+  def test_encoded_with_the_new_value(self):
+    self.assertEquals({"_id": 1, "a": "x", "b": [1, 2], "__mmm": {"source": "a"}}, self.raw.decode())
+
+  def test_id_and_value_read_without_decoding(self):
+    self.raw.body = None
+    self.assertEquals(1, self.raw["_id"])
+    self.assertEquals({"source": "a"}, self.raw["__mmm"])
+    self.assertTrue("__mmm" in self.raw)
+
+  def test_replace_shares_the_encoded_rest(self):
+    other = self.raw.replace({"source": "b"})
+    self.assertTrue(other.body is self.raw.body)
+    self.assertEquals({"source": "b"}, other.decode()["__mmm"])
+    self.assertEquals({"source": "a"}, self.raw.decode()["__mmm"])
+
+  def test_encode_splices_raw_documents(self):
+    command = SON([("update", "c"), ("updates", [{"q": {"_id": 1}, "u": self.raw, "upsert": True}])])
+    self.assertEquals({"update": "c", "updates": [{"q": {"_id": 1}, "u": self.raw.decode(), "upsert": True}]},
+      bson.BSON(rawbson.encode(command)).decode())
+
+  def test_encoded_size(self):
+    self.assertEquals(len(self.raw.raw), rawbson.encoded_size(self.raw))
+    self.assertEquals(len(bson.BSON.encode({"_id": 1})), rawbson.encoded_size({"_id": 1}))
+
+class MessageTest(TestCase):
+
+  def setUp(self):
+    self.raw = RawDocument.encode({"_id": 1, "a": "x"}, "__mmm", {"source": "a"})
+    self.document = SON([("_id", 1), ("a", "x"), ("__mmm", {"source": "a"})])
+
+  def assertLastError(self, data, w):
+    # after the namespace, numberToSkip and numberToReturn
+    error = bson.BSON(data[data.index("$cmd\x00") + 13:]).decode()
+    self.assertEquals({"getlasterror": 1, "w": w}, error)
+
+  def test_insert_message_matches_pymongo(self):
+    request_id, data, size = rawbson.insert_message(u"foodb.barcol", [self.raw], True)
+    expected = message.insert(u"foodb.barcol", [self.document], False, False, {}, True, 3)
+    self.assertEquals(messages(expected[1]), messages(data))
+    self.assertEquals(expected[2], size)
+
+  def test_acknowledged_insert_asks_for_last_error(self):
+    data = rawbson.insert_message(u"foodb.barcol", [self.raw], w=1)[1]
+    insert, last_error = messages(data)
+    self.assertEquals(messages(message.insert(u"foodb.barcol", [self.document], False, False, {}, False, 3)[1]),
+      [insert])
+    self.assertLastError(last_error, 1)
+
+  def test_update_message_matches_pymongo(self):
+    data = rawbson.update_message(u"foodb.barcol", {"_id": 1}, self.raw, True)[1]
+    expected = message.update(u"foodb.barcol", True, False, {"_id": 1}, self.document, False, {}, False, 3)
+    self.assertEquals(messages(expected[1]), messages(data))
+
+  def test_command_message_matches_pymongo(self):
+    command = SON([("insert", "barcol"), ("ordered", True), ("documents", [self.raw])])
+    data = rawbson.command_message("foodb", command)[1]
+    expected = message.query(0, "foodb.$cmd", 0, -1,
+      SON([("insert", "barcol"), ("ordered", True), ("documents", [self.document])]))
+    self.assertEquals(messages(expected[1]), messages(data))
+
+  def test_command_returns_the_response(self):
+    database = MagicMock()
+    database.name = "foodb"
+    database.connection._send_message_with_response.return_value = struct.pack("<iqii", 0, 0, 0, 1) + \
+      bson.BSON.encode({"ok": 1, "n": 1})
+    self.assertEquals({"ok": 1, "n": 1}, rawbson.command(database, SON([("insert", "barcol"), ("documents", [self.raw])])))
+
+  def test_failed_command_raises(self):
+    database = MagicMock()
+    database.name = "foodb"
+    database.connection._send_message_with_response.return_value = struct.pack("<iqii", 0, 0, 0, 1) + \
+      bson.BSON.encode({"ok": 0, "errmsg": "unauthorized"})
+    self.assertRaises(OperationFailure, rawbson.command, database, SON([("insert", "barcol"), ("documents", [self.raw])]))
+
+class FakeServerTest(TestCase):
+
+  def setUp(self):
+    self.server = FakeServer()
+    self.collection = self.server.collection("foodb.barcol")
+    self.raw = RawDocument.encode({"_id": 1, "a": "x"}, "__mmm", {"source": "a"})
+
+  def test_raw_writes_are_applied(self):
+    rawbson.insert(self.collection, [self.raw], w=1)
+    self.assertEquals([{"_id": 1, "a": "x", "__mmm": {"source": "a"}}], self.collection.documents)
+    result = rawbson.update(self.collection, {"_id": 1}, self.raw.replace({"source": "b"}), w=1)
+    self.assertEquals(1, result["n"])
+    self.assertEquals({"source": "b"}, self.collection.documents[0]["__mmm"])
+
+  def test_errors_need_acknowledgement(self):
+    rawbson.insert(self.collection, [self.raw])
+    self.assertEquals(None, rawbson.insert(self.collection, [self.raw]))
+    self.assertRaises(DuplicateKeyError, rawbson.insert, self.collection, [self.raw], w=1)
@@ -0,0 +1,180 @@
+from unittest import TestCase
+import bson
+from mock import patch
+from mmm.replication import METADATA_DESTINATION, METADATA_INLINE, METADATA_SIDECAR
+from mmm.testing import FakeMesh, FakeServer, SyntheticWorkload
+
+NS = "foodb.barcol"
+OTHER_NS = "foodb.othercol"
+
+class BidirectionalReplicationTest(TestCase):
+
+  def _mesh(self, metadata_mode):
+    self.mesh = FakeMesh(["a", "b"], [NS], {"metadata": metadata_mode, "checkpoint": {"ops": 1}})
+    self.a = self.mesh.collection("a", NS)
+    self.b = self.mesh.collection("b", NS)
+
+  def _content(self, collection):
+    return [dict((k, v) for k, v in d.iteritems() if k != "__mmm") for d in collection.documents]
+
+  def _write_and_settle(self):
+    self.a.insert({"_id": 1, "x": 1})
+    self.mesh.pump()
+    self.a.update({"_id": 1}, {"$set": {"x": 2}})
+    self.mesh.pump()
+    self.b.update({"_id": 1}, {"_id": 1, "x": 3, "y": 1})
+    self.mesh.pump()
+    self.b.remove({"_id": 1})
+    self.b.insert({"_id": 2, "x": 4})
+    self.mesh.pump()
+
+  def test_inline_metadata(self):
+    self._mesh(METADATA_INLINE)
+    self._write_and_settle()
+    self.assertEquals([{"_id": 2, "x": 4}], self._content(self.a))
+    self.assertEquals(self._content(self.a), self._content(self.b))
+
+  def test_destination_metadata_converges_without_source_writes(self):
+    self._mesh(METADATA_DESTINATION)
+    self.a.insert({"_id": 1, "x": 1})
+    self.mesh.pump()
+    self.assertEquals([{"_id": 1, "x": 1}], self._content(self.b))
+    # the application insert and the acknowledgement from b, no write-back
+    self.assertEquals(["i", "u"], [entry["op"] for entry in self.mesh.server("a").oplog.documents])
+    self.assertEquals({"b": self.b.documents[0]["__mmm"]["source_ts"]}, self.a.documents[0]["__mmm"])
+
+    self.a.remove({"_id": 1})
+    self.mesh.pump()
+    self._write_and_settle()
+    self.assertEquals([{"_id": 2, "x": 4}], self._content(self.a))
+    self.assertEquals(self._content(self.a), self._content(self.b))
+
+  def test_sidecar_metadata(self):
+    self._mesh(METADATA_SIDECAR)
+    self.a.insert({"_id": 1, "x": 1})
+    self.mesh.pump()
+    sidecar = self.mesh.collection("a", "local.mmm_metadata").documents
+    self.assertEquals(1, len(sidecar))
+    self.assertEquals({"ns": NS, "_id": 1}, dict(sidecar[0]["_id"]))
+    self.assertEquals("a", sidecar[0]["source"])
+
+    self.a.remove({"_id": 1})
+    self.mesh.pump()
+    self._write_and_settle()
+    self.assertEquals(self._content(self.a), self._content(self.b))
+
+  def test_read_modify_write_is_replicated_in_every_mode(self):
+    for mode in (METADATA_INLINE, METADATA_DESTINATION, METADATA_SIDECAR):
+      self._mesh(mode)
+      self.a.insert({"_id": 1, "x": 1})
+      self.mesh.pump()
+      # the document read back carries the acknowledgement of b
+      document = self.a.find_one({"_id": 1})
+      document["x"] = 2
+      self.a.update({"_id": 1}, document)
+      self.mesh.pump()
+      self.assertEquals([{"_id": 1, "x": 2}], self._content(self.b), mode)
+
+  def test_fewer_oplog_entries_without_write_back(self):
+    counts = {}
+    for mode in (METADATA_INLINE, METADATA_DESTINATION):
+      self._mesh(mode)
+      self._write_and_settle()
+      counts[mode] = self.mesh.server("a").oplog.count() + self.mesh.server("b").oplog.count()
+    self.assertTrue(counts[METADATA_DESTINATION] < counts[METADATA_INLINE])
+
+  def test_raw_bson_converges(self):
+    self.mesh = FakeMesh(["a", "b", "c"], [NS], {"raw_bson": True, "checkpoint": {"ops": 1}})
+    self.a = self.mesh.collection("a", NS)
+    self.b = self.mesh.collection("b", NS)
+    with patch.object(FakeServer, "_send_message", autospec=True, side_effect=FakeServer._send_message) as send:
+      self._write_and_settle()
+      self.assertEquals([{"_id": 2, "x": 4}], self._content(self.a))
+      self.a.remove({"_id": 2})
+      SyntheticWorkload([NS], documents=20, doc_bytes=128, seed=1).run(self.mesh.server("a"), 100)
+      self.mesh.pump()
+    self.assertTrue(send.called)
+    self.assertTrue(self._content(self.a))
+    self.assertEquals(self._content(self.a), self._content(self.b))
+    self.assertEquals(self._content(self.a), self._content(self.mesh.collection("c", NS)))
+
+  def test_unknown_metadata_mode(self):
+    self.assertRaises(ValueError, FakeMesh, ["a", "b"], [NS], {"metadata": "elsewhere"})
+
+  def test_synthetic_workload_converges(self):
+    for mode in (METADATA_INLINE, METADATA_DESTINATION):
+      self._mesh(mode)
+      SyntheticWorkload([NS], documents=20, doc_bytes=128, seed=1).run(self.mesh.server("a"), 200)
+      self.mesh.pump()
+      self.assertTrue(self._content(self.a))
+      self.assertEquals(self._content(self.a), self._content(self.b))
+
+class ReconfigureTest(TestCase):
+
+  def setUp(self):
+    self.mesh = FakeMesh(["a", "b"], [NS])
+    self.engine = self.mesh.engines["a"]
+
+  def tearDown(self):
+    for engine in self.mesh.engines.values():
+      engine.close()
+
+  def _replications(self, namespaces):
+    return [{"id": "b", "uri": FakeMesh.uri("b"), "namespaces": [{"source": ns, "dest": ns} for ns in namespaces]}]
+
+  def _ids(self, node_id, ns):
+    return sorted(d["_id"] for d in self.mesh.collection(node_id, ns).documents)
+
+  def _ids_in(self, mesh, node_id):
+    return sorted(d["_id"] for d in mesh.collection(node_id, NS).documents)
+
+  def test_added_namespace_is_replicated_without_touching_the_others(self):
+    callback = self.engine.triggers._callbacks[(NS, "i")][0]
+    self.assertEquals([OTHER_NS], self.engine.reconfigure(self._replications([NS, OTHER_NS])))
+
+    self.assertIs(callback, self.engine.triggers._callbacks[(NS, "i")][0])
+    self.mesh.collection("a", NS).insert({"_id": 1})
+    self.mesh.collection("a", OTHER_NS).insert({"_id": 2})
+    self.mesh.pump()
+    self.assertEquals([1], self._ids("b", NS))
+    self.assertEquals([2], self._ids("b", OTHER_NS))
+
+  def test_removed_namespace_is_flushed_and_dropped(self):
+    self.mesh.collection("a", NS).insert({"_id": 1})
+    self.mesh.pump()
+    self.assertEquals([NS, OTHER_NS], self.engine.reconfigure(self._replications([OTHER_NS])))
+
+    self.mesh.collection("a", NS).insert({"_id": 2})
+    self.mesh.pump()
+    self.assertEquals([1], self._ids("b", NS))
+    self.assertEquals([OTHER_NS], self.engine.triggers._oplog_filter["ns"]["$in"])
+
+  def test_queued_ops_are_drained_before_a_rebuild(self):
+    mesh = FakeMesh(["a", "b"], [NS], destination_options={"queue_size": 10})
+    for i in range(5):
+      mesh.collection("a", NS).insert({"_id": i})
+    # queued for b, its worker did not run yet
+    last_applied = mesh.engines["a"].triggers._tail_oplog(bson.Timestamp(0, 0))
+    replications = self._replications([NS])
+    replications[0].update(queue_size=10, batch_size=2)
+    self.assertEquals([NS], mesh.engines["a"].reconfigure(replications))
+
+    self.assertEquals(range(5), self._ids_in(mesh, "b"))
+    self.assertEquals(last_applied, mesh.engines["a"].checkpoints.load("b", NS))
+    for engine in mesh.engines.values():
+      engine.close()
+
+  def test_unchanged_config_changes_nothing(self):
+    self.assertEquals([], self.engine.reconfigure(self._replications([NS])))
+
+class SyntheticWorkloadTest(TestCase):
+
+  def test_writes_are_reproducible(self):
+    writes = lambda: list(SyntheticWorkload(["a.x", "a.y"], documents=10, seed=3).writes(100))
+    self.assertEquals(writes(), writes())
+    self.assertEquals(set(["a.x", "a.y"]), set(ns for ns, _, _ in writes()))
+    self.assertEquals(set(["insert", "update", "remove"]), set(method for _, method, _ in writes()))
+
+  def test_documents_are_about_doc_bytes(self):
+    document = SyntheticWorkload([NS], doc_bytes=1024).document(1)
+    self.assertTrue(1000 <= len(bson.BSON.encode(document)) <= 1024)
@@ -0,0 +1,153 @@
+from unittest import TestCase
+from bson import Timestamp
+import gevent
+from mock import MagicMock, patch
+from pymongo.errors import AutoReconnect, DuplicateKeyError, OperationFailure
+from mmm.batching import BulkWriteError
+from mmm.retry import RetryPolicy, is_transient
+from mmm.testing import FakeMesh, FakeServer, fake_connections
+from mmm.triggers import Triggers
+
+NS = "foodb.barcol"
+
+class RetryPolicyTest(TestCase):
+
+  def setUp(self):
+    self.sleeps = []
+    self.policy = RetryPolicy(initial_ms=10, max_ms=100, attempts=3, sleep=self.sleeps.append, random=lambda: 1.0)
+
+  def test_is_transient(self):
+    self.assertTrue(is_transient(AutoReconnect("connection reset")))
+    self.assertTrue(is_transient(OperationFailure("not master", 10107)))
+    self.assertTrue(is_transient(OperationFailure("not master")))
+    self.assertFalse(is_transient(DuplicateKeyError("E11000", 11000)))
+    self.assertFalse(is_transient(OperationFailure("bad query", 2)))
+    self.assertFalse(is_transient(ValueError()))
+
+  def test_delay_grows_exponentially_up_to_max(self):
+    policy = RetryPolicy(initial_ms=10, max_ms=100, jitter=0)
+    self.assertEquals([0.01, 0.02, 0.04, 0.08, 0.1, 0.1], [policy.delay(n) for n in range(6)])
+
+  def test_delay_is_jittered(self):
+    self.assertAlmostEquals(0.005, self.policy.delay(0))
+    self.assertAlmostEquals(0.04, RetryPolicy(initial_ms=10, jitter=0.5, random=lambda: 0.0).delay(2))
+
+  def test_retries_transient_errors_and_recovers_in_between(self):
+    func = MagicMock(side_effect=[AutoReconnect("election"), AutoReconnect("election"), "done"])
+    recover = MagicMock()
+
+    self.assertEquals("done", self.policy.call(func, recover))
+    self.assertEquals(3, func.call_count)
+    self.assertEquals(2, recover.call_count)
+    self.assertEquals([0.005, 0.01], self.sleeps)
+
+  def test_fatal_errors_are_raised_at_once(self):
+    func = MagicMock(side_effect=DuplicateKeyError("E11000", 11000))
+    self.assertRaises(DuplicateKeyError, self.policy.call, func)
+    self.assertEquals(1, func.call_count)
+    self.assertEquals([], self.sleeps)
+
+  def test_gives_up_after_attempts(self):
+    func = MagicMock(side_effect=AutoReconnect("down"))
+    self.assertRaises(AutoReconnect, self.policy.call, func)
+    self.assertEquals(4, func.call_count)
+
+  def test_failed_recovery_is_retried(self):
+    func = MagicMock(side_effect=[AutoReconnect("down"), "done"])
+    recover = MagicMock(side_effect=[AutoReconnect("still down"), None])
+
+    self.assertEquals("done", self.policy.call(func, recover))
+    self.assertEquals(2, recover.call_count)
+    self.assertEquals(2, func.call_count)
+
+  def test_from_config(self):
+    policy = RetryPolicy.from_config({"initial_ms": 5, "attempts": 2})
+    self.assertEquals(5, policy.initial_ms)
+    self.assertEquals(2, policy.attempts)
+    self.assertRaises(ValueError, RetryPolicy.from_config, {"initial_ms": 0})
+
+class FailureInjectionTest(TestCase):
+  """
+  Replication through fake servers whose collections fail on demand
+  """
+
+  def setUp(self):
+    self.mesh = FakeMesh(["a", "b"], [NS], {"checkpoint": {"ops": 1}, "retry": {"initial_ms": 1, "max_ms": 2}})
+
+  def test_failed_destination_write_is_retried_once_applied(self):
+    self.mesh.collection("b", NS).fail(AutoReconnect("election"), "insert", times=2)
+    self.mesh.collection("a", NS).insert({"_id": 1, "x": 1})
+    self.mesh.pump()
+
+    self.assertEquals([1], [d["x"] for d in self.mesh.collection("b", NS).documents])
+    self.assertEquals(3, self.mesh.collection("b", NS).calls["insert"])
+
+  def test_destination_write_is_retried_by_its_flush_alone(self):
+    self.mesh.collection("b", NS).fail(AutoReconnect("down"), "insert", times=100)
+    self.mesh.collection("a", NS).insert({"_id": 1, "x": 1})
+
+    self.assertRaises(AutoReconnect, self.mesh.pump)
+    # 20 attempts by default, not 20 more for every one of them
+    self.assertEquals(21, self.mesh.collection("b", NS).calls["insert"])
+
+  def test_failed_source_write_back_does_not_duplicate_or_lose_the_op(self):
+    self.mesh.collection("a", NS).insert({"_id": 1, "x": 1})
+    # the metadata write back fails after nothing, then it is retried alone
+    self.mesh.collection("a", NS).fail(AutoReconnect("election"), "update")
+    self.mesh.pump()
+
+    self.assertEquals(1, self.mesh.collection("b", NS).calls["insert"])
+    self.assertEquals([1], [d["x"] for d in self.mesh.collection("b", NS).documents])
+    self.assertEquals("a", self.mesh.collection("a", NS).documents[0]["__mmm"]["source"])
+
+  def test_fatal_errors_are_not_retried(self):
+    self.mesh.collection("b", NS).fail(DuplicateKeyError("E11000", 11000), "insert", times=5)
+    self.mesh.collection("a", NS).insert({"_id": 1, "x": 1})
+
+    self.assertRaises(BulkWriteError, self.mesh.pump)
+    self.assertEquals(1, self.mesh.collection("b", NS).calls["insert"])
+
+class TriggersRetryTest(TestCase):
+
+  def setUp(self):
+    self.servers = {"mongodb://a": FakeServer()}
+    self.oplog = self.servers["mongodb://a"].oplog
+    self.triggers = Triggers("a", "mongodb://a")
+    self.triggers.connections = fake_connections(self.servers)
+    self.sleeps = []
+    self.triggers.retry_policy = RetryPolicy(initial_ms=1, attempts=3, sleep=self.sleeps.append)
+    self.triggers.register(NS, "i", MagicMock())
+
+  def _run_briefly(self):
+    with patch("mmm.triggers.IDLE_SLEEP_TIME", 0.001):
+      greenlet = gevent.spawn(self.triggers.run)
+      gevent.sleep(0.05)
+      self.triggers.stop()
+      greenlet.join()
+    return greenlet
+
+  def test_resumes_tailing_after_transient_errors(self):
+    self.oplog.fail(AutoReconnect("election"), "find", times=2)
+    greenlet = self._run_briefly()
+
+    self.assertTrue(greenlet.successful())
+    self.assertEquals(2, len(self.sleeps))
+    self.assertTrue(self.oplog.calls["find"] > 2)
+    self.assertEquals(2, self.triggers._generation)
+
+  def test_callback_errors_are_not_retried_again(self):
+    callback = MagicMock(side_effect=AutoReconnect("destination down"))
+    self.triggers.register(NS, "i", callback)
+    self.servers["mongodb://a"].oplog.insert({"ts": Timestamp(2 ** 31, 1), "op": "i", "ns": NS, "o": {"_id": 1}})
+    greenlet = self._run_briefly()
+
+    self.assertIsInstance(greenlet.exception, AutoReconnect)
+    self.assertEquals(1, callback.call_count)
+    self.assertEquals([], self.sleeps)
+
+  def test_fatal_error_stops_tailing(self):
+    self.oplog.fail(OperationFailure("bad query", 2), "find")
+    greenlet = self._run_briefly()
+
+    self.assertIsInstance(greenlet.exception, OperationFailure)
+    self.assertEquals([], self.sleeps)
@@ -0,0 +1,131 @@
+from unittest import TestCase
+import bson
+from bson.errors import InvalidDocument
+import gevent
+from mock import MagicMock
+from mmm import metrics
+from mmm.batching import BulkWriter
+from mmm.connections import ConnectionManager
+from mmm.metadata import MMM_METADATA
+from mmm.replication import ReplicationEngine, Replicator
+from mmm.scheduling import DestinationScheduler, ScheduledReplicator, op_bytes
+from mmm.testing import FakeCollection, fake_connections
+
+class RecordingReplicator(object):
+
+  def __init__(self, destination_id, delivered):
+    self.destination_id = destination_id
+    self.delivered = delivered
+    self.flushes = 0
+
+  def replicate(self, op, ns, o, o2=None, b=False, ts=None):
+    self.delivered.append((ns, o["_id"]))
+
+  def flush(self):
+    self.flushes += 1
+
+  def oldest_pending(self):
+    return None
+
+class DestinationSchedulerTest(TestCase):
+
+  def setUp(self):
+    self.delivered = []
+    self.scheduler = DestinationScheduler("a", "b", maxsize=100)
+    self.high = self.scheduler.handle(RecordingReplicator("b", self.delivered), "high")
+    self.low = self.scheduler.handle(RecordingReplicator("b", self.delivered), "low")
+
+  def tearDown(self):
+    self.scheduler.close()
+
+  def test_higher_classes_are_drained_first(self):
+    wait = metrics.registry.get("scheduler_wait_seconds", source="a", destination="b", priority="low")
+    waited = wait.count
+    for i in range(3):
+      self.low.replicate("i", "logs.events", {"_id": i}, ts=bson.Timestamp(1000, i))
+    for i in range(2):
+      self.high.replicate("i", "shop.orders", {"_id": i}, ts=bson.Timestamp(1000, 10 + i))
+    self.assertEquals(bson.Timestamp(1000, 0), self.low.oldest_pending())
+    gevent.sleep(0)
+
+    self.assertEquals([("shop.orders", 0), ("shop.orders", 1), ("logs.events", 0), ("logs.events", 1),
+      ("logs.events", 2)], self.delivered)
+    # flushed once none of their ops are queued
+    self.assertEquals((1, 1), (self.high.replicator.flushes, self.low.replicator.flushes))
+    self.assertEquals(None, self.low.oldest_pending())
+    self.assertEquals(3, wait.count - waited)
+
+  def test_rate_limits_take_ops_and_bytes(self):
+    self.scheduler.ops_limit = MagicMock()
+    self.scheduler.bytes_limit = MagicMock()
+    o = {"_id": 1, "x": "y" * 100}
+    self.low.replicate("u", "logs.events", o, {"_id": 1}, ts=bson.Timestamp(1000, 1))
+    gevent.sleep(0)
+
+    self.scheduler.ops_limit.acquire.assert_called_once_with()
+    self.scheduler.bytes_limit.acquire.assert_called_once_with(op_bytes(o, {"_id": 1}))
+    self.assertEquals([("logs.events", 1)], self.delivered)
+
+  def test_closed_handle_drops_its_queued_ops(self):
+    for i in range(3):
+      self.low.replicate("i", "logs.events", {"_id": i}, ts=bson.Timestamp(1000, i))
+    self.high.replicate("i", "shop.orders", {"_id": 0}, ts=bson.Timestamp(1000, 10))
+    self.low.close()
+    gevent.sleep(0)
+
+    self.assertEquals([("shop.orders", 0)], self.delivered)
+    self.assertEquals([self.high], self.scheduler.handles)
+
+  def test_write_failing_with_a_fatal_error_is_skipped(self):
+    replicator = Replicator("a", "b", "uri", "shop", "orders", ConnectionManager(MagicMock()))
+    replicator._collection = FakeCollection([{"_id": 0}])
+    replicator.writer = BulkWriter(size=1)
+    handle = self.scheduler.handle(replicator, "normal")
+    # a duplicate key fails however often the insert is retried
+    for i in range(2):
+      handle.replicate("i", "shop.orders", {"_id": i, MMM_METADATA: {"source_ts": 1}}, ts=bson.Timestamp(1000, i))
+
+    with gevent.Timeout(1):
+      while handle.oldest_pending() is not None:
+        gevent.sleep(0.01)
+    self.assertEquals([0, 1], [document["_id"] for document in replicator._collection.documents])
+    metrics.registry.remove(source="a", destination="b", ns="shop.orders")
+
+  def test_unhandled_fatal_error_stops_the_handle(self):
+    replicator = Replicator("a", "b", "uri", "shop", "orders", ConnectionManager(MagicMock()))
+    replicator._collection = FakeCollection()
+    replicator._collection.fail(InvalidDocument("BSON document too large"), "insert", times=10)
+    replicator.writer = BulkWriter(size=1)
+    handle = self.scheduler.handle(replicator, "normal")
+    for i in range(2):
+      handle.replicate("i", "shop.orders", {"_id": i, MMM_METADATA: {"source_ts": 1}}, ts=bson.Timestamp(1000, i))
+    self.low.replicate("i", "logs.events", {"_id": 0}, ts=bson.Timestamp(1000, 10))
+    gevent.sleep(0.01)
+
+    self.assertEquals(bson.Timestamp(1000, 0), handle.oldest_pending())
+    self.assertRaises(InvalidDocument, handle.flush)
+    self.assertRaises(InvalidDocument, handle.drain)
+    self.assertEquals([], replicator._collection.documents)
+    # the other handles of the destination carry on
+    self.assertEquals([("logs.events", 0)], self.delivered)
+    metrics.registry.remove(source="a", destination="b", ns="shop.orders")
+
+class EngineSchedulingTest(TestCase):
+
+  def test_namespaces_of_a_destination_share_its_scheduler(self):
+    destinations = [{"id": "b", "uri": "mongodb://b", "scheduler": {"ops_per_second": 500},
+      "namespaces": [{"source": "shop.orders", "dest": "shop.orders", "priority": "high"},
+        {"source": "logs.events", "dest": "logs.events", "priority": "low"}]}]
+    engine = ReplicationEngine("a", "mongodb://a", destinations, {}, fake_connections({}))
+    handles = [engine._namespaces[source]["callback"]._replicators[(source, "i")][0]
+      for source in ("shop.orders", "logs.events")]
+
+    self.assertTrue(all(isinstance(handle, ScheduledReplicator) for handle in handles))
+    self.assertEquals(["high", "low"], [handle.priority for handle in handles])
+    self.assertTrue(handles[0].scheduler is handles[1].scheduler)
+    self.assertEquals(500, handles[0].scheduler.ops_limit.rate)
+
+    # the scheduler goes with its destination
+    engine.reconfigure([])
+    self.assertEquals({}, engine._schedulers)
+    engine.close()
@@ -0,0 +1,218 @@
+from unittest import TestCase
+import bson
+import gevent
+import gevent.event
+import os
+import shutil
+import tempfile
+from bson.errors import InvalidDocument
+from pymongo.errors import AutoReconnect
+from mmm import metrics
+from mmm.batching import BulkWriteError, WriteOp
+from mmm.replication import Replicator
+from mmm.retry import RetryPolicy
+from mmm.spill import SpillLog, SpillQueue
+from mmm.testing import FakeMesh
+
+NS = "foodb.barcol"
+
+class SpillLogTest(TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _read_all(self, spill_log, position):
+    records = []
+    entry = spill_log.read(position)
+    while entry is not None:
+      records.append(entry[0]["i"])
+      position = entry[1]
+      entry = spill_log.read(position)
+    return records
+
+  def test_records_survive_a_restart(self):
+    spill_log = SpillLog(self.directory, segment_bytes=100)
+    for i in range(10):
+      spill_log.append({"i": i})
+    spill_log.sync()
+    spill_log.close()
+
+    spill_log = SpillLog(self.directory, segment_bytes=100)
+    self.assertEquals(range(10), self._read_all(spill_log, spill_log.cursor))
+    self.assertTrue(len(os.listdir(self.directory)) > 1)
+    spill_log.append({"i": 10})
+    self.assertEquals(range(11), self._read_all(spill_log, spill_log.cursor))
+
+  def test_commit_deletes_read_segments(self):
+    spill_log = SpillLog(self.directory, segment_bytes=100)
+    for i in range(10):
+      position = spill_log.append({"i": i})
+      if i == 8:
+        committed = position
+    spill_log.commit(committed)
+    spill_log.close()
+
+    spill_log = SpillLog(self.directory, segment_bytes=100)
+    self.assertEquals(committed, spill_log.cursor)
+    self.assertEquals([9], self._read_all(spill_log, spill_log.cursor))
+    self.assertTrue("0000000000000000.spill" not in os.listdir(self.directory))
+
+  def test_torn_write_is_discarded(self):
+    spill_log = SpillLog(self.directory)
+    spill_log.append({"i": 0})
+    end = spill_log.append({"i": 1})
+    # a record whose length made it to disk but not its body
+    spill_log._maps[0][end[1]:end[1] + 4] = bson.BSON.encode({"i": 2})[:4]
+    spill_log.sync()
+    spill_log.close()
+
+    spill_log = SpillLog(self.directory)
+    self.assertEquals(end, spill_log.end)
+    self.assertEquals([0, 1], self._read_all(spill_log, spill_log.cursor))
+
+class StubReplicator(object):
+
+  def __init__(self):
+    self.source_id = "source"
+    self.destination_id = "destination"
+    self.destination_namespace = NS
+    self.replicated = []
+    self.positions = []
+    self.healthy = gevent.event.Event()
+    self.retry_policy = RetryPolicy()
+    # timestamps of the ops the destination rejects, the ops skipped for it, and the ops that can't be sent
+    self.rejected = []
+    self.skipped = []
+    self.invalid = []
+
+  def replicate(self, op, ns, o, o2=None, b=False, ts=None):
+    if not self.healthy.is_set():
+      raise AutoReconnect("destination down")
+    if ts in self.skipped:
+      return
+    if ts in self.rejected:
+      raise BulkWriteError(WriteOp(op, None, o, False, ts), "bad document", 10334)
+    if ts in self.invalid:
+      raise InvalidDocument("BSON document too large")
+    self.replicated.append(ts)
+
+  def skip_failed(self, error):
+    if not isinstance(error, BulkWriteError):
+      return False
+    self.skipped.append(error.write_op.ts)
+    return True
+
+  handle_failure = Replicator.__dict__["handle_failure"]
+
+  def flush(self):
+    pass
+
+  def oldest_pending(self):
+    return None
+
+  def save_position(self, position):
+    self.positions.append(position)
+
+class SpillQueueTest(TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.replicator = StubReplicator()
+    self.queue = SpillQueue(self.replicator, SpillLog(self.directory))
+
+  def tearDown(self):
+    self.queue.close()
+    metrics.registry.remove(source="source")
+    shutil.rmtree(self.directory)
+
+  def _replicate(self, start, count):
+    for i in range(start, start + count):
+      self.queue.replicate("i", NS, {"_id": i}, ts=bson.Timestamp(1000, i))
+
+  def test_checkpoint_only_waits_for_the_log(self):
+    self._replicate(0, 5)
+    self.assertEquals(bson.Timestamp(1000, 0), self.queue.oldest_pending())
+    self.queue.flush()
+    gevent.sleep(0)
+
+    self.assertEquals(None, self.queue.oldest_pending())
+    self.assertEquals([], self.replicator.replicated)
+    self.assertTrue(self.queue.log.size() > 0)
+
+  def test_destination_catches_up_from_the_log(self):
+    self._replicate(0, 5)
+    self.queue.flush()
+    self.queue.save_positions(bson.Timestamp(1000, 4))
+    self.assertEquals([], self.replicator.positions)
+
+    self.replicator.healthy.set()
+    with gevent.Timeout(5):
+      while len(self.replicator.replicated) < 5:
+        gevent.sleep(0.01)
+    self.queue.save_positions(bson.Timestamp(1000, 4))
+
+    self.assertEquals([bson.Timestamp(1000, i) for i in range(5)], self.replicator.replicated)
+    self.assertEquals([bson.Timestamp(1000, 4)], self.replicator.positions)
+    self.assertEquals(self.queue.log.end, self.queue.log.cursor)
+    self.assertEquals(0, self.queue.log.size())
+
+  def test_rejected_record_is_skipped(self):
+    self.replicator.rejected.append(bson.Timestamp(1000, 1))
+    self._replicate(0, 3)
+    self.replicator.healthy.set()
+    with gevent.Timeout(5):
+      while len(self.replicator.replicated) < 2:
+        gevent.sleep(0.01)
+
+    self.assertEquals([bson.Timestamp(1000, 0), bson.Timestamp(1000, 2)], self.replicator.replicated)
+
+  def test_unhandled_fatal_error_stops_the_queue(self):
+    self.replicator.invalid.append(bson.Timestamp(1000, 1))
+    self._replicate(0, 3)
+    self.queue.flush()
+    self.replicator.healthy.set()
+    gevent.sleep(0.01)
+    self.queue.save_positions(bson.Timestamp(1000, 2))
+
+    self.assertEquals([bson.Timestamp(1000, 0)], self.replicator.replicated)
+    self.assertEquals([bson.Timestamp(1000, 0)], self.replicator.positions)
+    self.assertTrue(self.queue.log.size() > 0)
+    self.assertRaises(InvalidDocument, self.queue.flush)
+    self.assertRaises(InvalidDocument, self.queue.replicate, "i", NS, {"_id": 3}, ts=bson.Timestamp(1000, 3))
+
+  def test_restart_drains_what_was_left(self):
+    self._replicate(0, 3)
+    self.queue.flush()
+    self.queue.close()
+
+    self.replicator.healthy.set()
+    self.queue = SpillQueue(self.replicator, SpillLog(self.directory))
+    gevent.sleep(0.01)
+    self.assertEquals([bson.Timestamp(1000, i) for i in range(3)], self.replicator.replicated)
+
+class SpilledReplicationTest(TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_mesh_converges_through_spill_logs(self):
+    mesh = FakeMesh(["a", "b"], [NS], {"spill": {"path": self.directory}})
+    a, b = mesh.collection("a", NS), mesh.collection("b", NS)
+    for i in range(10):
+      a.insert({"_id": i, "x": i})
+    for _ in range(5):
+      mesh.pump()
+      gevent.sleep(0.01)
+
+    content = lambda collection: sorted((d["_id"], d["x"]) for d in collection.documents)
+    self.assertEquals([(i, i) for i in range(10)], content(b))
+    self.assertEquals(content(a), content(b))
+    self.assertTrue(os.path.isdir(os.path.join(self.directory, "a", "b", NS, "0")))
+    for engine in mesh.engines.values():
+      engine.close()
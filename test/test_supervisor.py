@@ -0,0 +1,115 @@
+from unittest import TestCase
+import gevent
+import tempfile
+from mock import patch
+from pymongo.errors import OperationFailure
+from mmm.supervisor import ConfigWatcher, Supervisor, topology
+from mmm.testing import FakeServer, fake_connections
+
+NS = "foodb.barcol"
+
+def mesh_config(node_ids):
+  return {"masters": [{"id": node_id, "uri": "mongodb://%s" % node_id, "checkpoint": {"ops": 1},
+    "replications": [{"id": other, "uri": "mongodb://%s" % other, "namespaces": [{"source": NS, "dest": NS}]}
+      for other in node_ids if other != node_id]} for node_id in node_ids]}
+
+class TopologyTest(TestCase):
+
+  def test_single_master(self):
+    config = {"master": {"id": "a", "uri": "mongodb://a"}, "replications": []}
+    self.assertEquals({"a": (config["master"], [])}, topology(config))
+
+  def test_masters(self):
+    self.assertEquals(["a", "b"], sorted(topology(mesh_config(["a", "b"]))))
+
+  def test_duplicate_ids(self):
+    config = mesh_config(["a", "b"])
+    config["masters"][1]["id"] = "a"
+    self.assertRaises(ValueError, topology, config)
+
+class SupervisorTest(TestCase):
+
+  def setUp(self):
+    self.patcher = patch("mmm.triggers.IDLE_SLEEP_TIME", 0.001)
+    self.patcher.start()
+    self.servers = dict(("mongodb://%s" % node_id, FakeServer()) for node_id in "abc")
+    self.supervisor = Supervisor(fake_connections(self.servers), stop_timeout=1)
+
+  def tearDown(self):
+    self.supervisor.stop_all()
+    self.patcher.stop()
+
+  def collection(self, node_id):
+    return self.servers["mongodb://%s" % node_id].collection(NS)
+
+  def test_replicates_every_master_in_one_process(self):
+    self.supervisor.apply(mesh_config(["a", "b"]))
+    self.collection("a").insert({"_id": 1})
+    self.collection("b").insert({"_id": 2})
+    gevent.sleep(0.05)
+
+    for node_id in "ab":
+      self.assertEquals([1, 2], sorted(d["_id"] for d in self.collection(node_id).documents))
+    self.assertTrue(self.supervisor.healthy())
+
+  def test_apply_only_restarts_changed_masters(self):
+    self.supervisor.apply(mesh_config(["a", "b"]))
+    engines = dict(self.supervisor.engines)
+    config = mesh_config(["a", "b"])
+    config["masters"][1]["checkpoint"] = {"ops": 10}
+    self.supervisor.apply(config)
+
+    self.assertIs(engines["a"], self.supervisor.engines["a"])
+    self.assertIsNot(engines["b"], self.supervisor.engines["b"])
+    self.assertTrue(self.supervisor.running("b"))
+
+  def test_changed_replications_reconfigure_the_running_engine(self):
+    self.supervisor.apply(mesh_config(["a", "b"]))
+    engines = dict(self.supervisor.engines)
+    config = mesh_config(["a", "b"])
+    config["masters"][0]["replications"][0]["namespaces"].append({"source": "foodb.other", "dest": "foodb.other"})
+    self.supervisor.apply(config)
+    self.servers["mongodb://a"].collection("foodb.other").insert({"_id": 1})
+    gevent.sleep(0.05)
+
+    self.assertIs(engines["a"], self.supervisor.engines["a"])
+    self.assertIs(engines["b"], self.supervisor.engines["b"])
+    self.assertEquals([1], [d["_id"] for d in self.servers["mongodb://b"].collection("foodb.other").documents])
+
+  def test_apply_starts_and_stops_masters(self):
+    self.supervisor.apply(mesh_config(["a", "b"]))
+    engine_a = self.supervisor.engines["a"]
+    self.supervisor.apply(mesh_config(["a", "c"]))
+
+    self.assertEquals(["a", "c"], sorted(self.supervisor.engines))
+    self.assertIs(engine_a, self.supervisor.engines["a"]) # only its replications changed
+    self.assertFalse(engine_a.triggers.stop_event.isSet())
+
+  def test_failed_engine_is_reported_and_restarted_by_apply(self):
+    config = mesh_config(["a", "b"])
+    self.supervisor.apply(config)
+    self.servers["mongodb://b"].oplog.fail(OperationFailure("bad query", 2), "find")
+    gevent.sleep(0.05)
+
+    health = self.supervisor.health()
+    self.assertFalse(health["b"]["running"])
+    self.assertIn("bad query", health["b"]["error"])
+    self.assertTrue(health["a"]["running"])
+    self.assertFalse(self.supervisor.healthy())
+
+    self.supervisor.apply(config)
+    self.assertTrue(self.supervisor.healthy())
+
+class ConfigWatcherTest(TestCase):
+
+  def test_change_is_noticed_once(self):
+    changes = []
+    with tempfile.NamedTemporaryFile() as config:
+      watcher = ConfigWatcher(config.name, changes.append)
+      self.assertFalse(watcher.check())
+      config.write("masters: []\n")
+      config.flush()
+
+      self.assertTrue(watcher.check())
+      self.assertFalse(watcher.check())
+    self.assertEquals([config.name], changes)
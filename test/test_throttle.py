@@ -0,0 +1,31 @@
+from unittest import TestCase
+from mmm.throttle import TokenBucket
+
+class TokenBucketTest(TestCase):
+
+  def setUp(self):
+    self.now = 0.0
+    self.sleeps = []
+    self.bucket = TokenBucket(10, burst=5, clock=lambda: self.now, sleep=self._sleep)
+
+  def _sleep(self, seconds):
+    self.sleeps.append(seconds)
+    self.now += seconds
+
+  def test_burst_is_free(self):
+    self.assertEquals(0, self.bucket.acquire(5))
+    self.assertFalse(self.bucket.try_acquire())
+
+  def test_waits_for_refill(self):
+    self.bucket.acquire(5)
+    self.assertAlmostEquals(0.3, self.bucket.acquire(3))
+    self.now += 1
+    self.assertTrue(self.bucket.try_acquire(5))
+
+  def test_requests_larger_than_the_burst_keep_the_rate(self):
+    self.bucket.acquire(20)
+    self.assertAlmostEquals(1.6, self.bucket.wait_time(1))
+    self.assertAlmostEquals(1.6, self.bucket.acquire(1))
+
+  def test_invalid_rate(self):
+    self.assertRaises(ValueError, TokenBucket, 0)
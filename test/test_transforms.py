@@ -0,0 +1,93 @@
+from unittest import TestCase
+from mock import patch
+from mmm.replication import MMM_METADATA, ReplicationEngine
+from mmm.testing import FakeMesh, fake_connections
+from mmm.transforms import DocumentTransform
+
+NS = "foodb.barcol"
+DOCUMENT = {"_id": 1, "name": "n", "secret": "s", "address": {"city": "c", "street": "s"}}
+
+class DocumentTransformTest(TestCase):
+
+  def test_include(self):
+    transform = DocumentTransform(include=["name", "address.city"])
+    self.assertEquals({"_id": 1, "name": "n", "address": {"city": "c"}}, transform.apply(DOCUMENT))
+    self.assertEquals({"$set": {"name": "m", "address.city": "d", "address": {"city": "e"}}},
+      transform.apply({"$set": {"name": "m", "secret": "t", "address.city": "d", "address": {"city": "e", "street": "t"}}}))
+    self.assertEquals({"$unset": {"address": 1}}, transform.apply({"$unset": {"address": 1, "secret": 1}}))
+    self.assertEquals(None, transform.apply({"$set": {"secret": "t"}, "$inc": {"address.zip": 1}}))
+
+  def test_exclude(self):
+    transform = DocumentTransform(exclude=["secret", "address.street"])
+    self.assertEquals({"_id": 1, "name": "n", "address": {"city": "c"}}, transform.apply(DOCUMENT))
+    self.assertEquals({"$set": {"address": {"city": "e"}}},
+      transform.apply({"$set": {"address.street": "t", "address": {"city": "e", "street": "t"}}}))
+
+  def test_rename(self):
+    transform = DocumentTransform(include=["name", "address"], rename={"name": "title"})
+    self.assertEquals({"_id": 1, "title": "n", "address": DOCUMENT["address"]}, transform.apply(DOCUMENT))
+    self.assertEquals({"$set": {"title": "m"}}, transform.apply({"$set": {"name": "m"}}))
+
+  def test_metadata_and_id_are_kept(self):
+    transform = DocumentTransform(include=["name"])
+    self.assertEquals({"_id": 1, MMM_METADATA: {"source": "a"}},
+      transform.apply({"_id": 1, "x": 1, MMM_METADATA: {"source": "a"}}))
+    self.assertEquals({"$set": {MMM_METADATA + ".b": 1}}, transform.apply({"$set": {MMM_METADATA + ".b": 1, "x": 1}}))
+    # applying it again changes nothing, copies are recognized by their hash
+    projected = transform.apply(DOCUMENT)
+    self.assertEquals(projected, transform.apply(projected))
+
+  def test_invalid(self):
+    self.assertRaises(ValueError, DocumentTransform, ["a"], ["b"])
+    self.assertRaises(ValueError, DocumentTransform, None, None, {"_id": "id"})
+
+class TransformedReplicationTest(TestCase):
+
+  def setUp(self):
+    self.mesh = FakeMesh(["a", "b"], [NS], {"transforms": {NS: {"include": ["name", "address.city"]}}})
+    self.mesh.collection("a", NS).insert(dict(DOCUMENT))
+    self.mesh.pump()
+
+  def _document(self, node):
+    document = self.mesh.collection(node, NS).find_one({"_id": 1})
+    return dict((k, v) for k, v in document.iteritems() if k != MMM_METADATA)
+
+  def test_destinations_get_the_projection(self):
+    self.assertEquals({"_id": 1, "name": "n", "address": {"city": "c"}}, self._document("b"))
+    # the source keeps the whole document
+    self.assertEquals(DOCUMENT, self._document("a"))
+
+  def test_updates_are_projected(self):
+    self.mesh.collection("a", NS).update({"_id": 1}, {"$set": {"secret": "t"}})
+    self.mesh.collection("a", NS).update({"_id": 1}, {"$set": {"address.city": "d", "address.street": "t"}})
+    self.mesh.pump()
+    self.assertEquals({"_id": 1, "name": "n", "address": {"city": "d"}}, self._document("b"))
+
+    self.mesh.collection("b", NS).update({"_id": 1}, {"$set": {"name": "m"}})
+    self.mesh.pump()
+    self.assertEquals(dict(DOCUMENT, name="m", secret="t", address={"city": "d", "street": "t"}), self._document("a"))
+
+  def test_initial_sync_copies_the_projection(self):
+    mesh = FakeMesh(["a", "b"], [NS], {"transforms": {NS: {"include": ["name", "address.city"]}}})
+    mesh.collection("a", NS).insert(dict(DOCUMENT))
+    # written before replication was set up
+    mesh.server("a").oplog._documents.clear()
+
+    self.assertEquals(1, mesh.engines["a"].initial_sync())
+    copy = mesh.collection("b", NS).find_one({"_id": 1})
+    self.assertEquals({"_id": 1, "name": "n", "address": {"city": "c"}},
+      dict((k, v) for k, v in copy.iteritems() if k != MMM_METADATA))
+
+  def test_verify_compares_and_repairs_the_projection(self):
+    engine = self.mesh.engines["a"]
+    self.assertEquals([("b", NS, [])], engine.verify())
+
+    with patch.object(self.mesh.server("b").oplog, "log"):
+      self.mesh.collection("b", NS).update({"_id": 1}, {"$set": {"name": "m", "secret": "t"}})
+    (_, _, repairs), = engine.verify(repair=True)
+    self.assertEquals(1, len(repairs))
+    self.assertEquals({"_id": 1, "name": "n", "address": {"city": "c"}}, self._document("b"))
+
+  def test_transform_of_a_namespace_not_replicated(self):
+    self.assertRaises(ValueError, ReplicationEngine, "a", "mongodb://a", [], {"transforms": {NS: {}}},
+      fake_connections({}))
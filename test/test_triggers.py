@@ -3,6 +3,7 @@ from unittest import TestCase
 from mock import MagicMock
 import bson
 import time
+from mmm.checkpoint import CheckpointPolicy
 from mmm.triggers import Triggers
 
 class TriggersTailTest(TestCase):
@@ -16,10 +17,12 @@ class TriggersTailTest(TestCase):
     self.trigger._checkpoint = MagicMock()
 
     self.callback_func = MagicMock()
+    self.callback_func.oldest_pending.return_value = None
     self.default_checkpoint = 0L
 
-  def _assert_calls(self, checkpoint):
-    self.trigger._oplog.find.assert_called_with({"ts": {'$gt': checkpoint}}, tailable=True, await_data=True)
+  def _assert_calls(self, checkpoint, namespaces, operations):
+    spec = {"ts": {'$gt': checkpoint}, "ns": {"$in": namespaces}, "op": {"$in": operations}}
+    self.trigger._oplog.find.assert_called_with(spec, fields=None, tailable=True, await_data=True)
     self.cursor.sort.assert_called_with('$natural')
 
   def test_tail_with_no_messages(self):
@@ -28,7 +31,7 @@ class TriggersTailTest(TestCase):
 
     new_checkpoint = self.trigger._tail_oplog(self.default_checkpoint)
 
-    self._assert_calls(self.default_checkpoint)
+    self._assert_calls(self.default_checkpoint, ["foodb.barcol"], ["i"])
     self.assertFalse(self.callback_func.called)
     self.assertEquals(self.default_checkpoint, new_checkpoint)
 
@@ -54,7 +57,7 @@ class TriggersTailTest(TestCase):
 
     new_checkpoint = self.trigger._tail_oplog(self.default_checkpoint)
 
-    self._assert_calls(self.default_checkpoint)
+    self._assert_calls(self.default_checkpoint, ["foodb.barcol"], ["u"])
     self.callback_func.assert_called_with(**op_message)
     self.assertEquals(op_timestamp, new_checkpoint)
 
@@ -70,7 +73,7 @@ class TriggersTailTest(TestCase):
 
     new_checkpoint = self.trigger._tail_oplog(self.default_checkpoint)
 
-    self._assert_calls(self.default_checkpoint)
+    self._assert_calls(self.default_checkpoint, ["adifferentdb.adifferentcol"], ["u"])
     self.assertFalse(self.callback_func.called)
     self.assertEquals(op_timestamp, new_checkpoint)
 
@@ -86,10 +89,88 @@ class TriggersTailTest(TestCase):
 
     new_checkpoint = self.trigger._tail_oplog(self.default_checkpoint)
 
-    self._assert_calls(self.default_checkpoint)
+    self._assert_calls(self.default_checkpoint, ["foodb.barcol"], ["i"])
     self.assertFalse(self.callback_func.called)
     self.assertEquals(op_timestamp, new_checkpoint)
 
+  def test_filter_covers_all_registrations(self):
+    self.cursor.sort.return_value = []
+    self.trigger.register("foodb.barcol", "iu", self.callback_func)
+    self.trigger.register("foodb.bazcol", "d", self.callback_func)
+    self.trigger.oplog_fields = ["ts", "op"]
+
+    self.trigger._tail_oplog(self.default_checkpoint)
+
+    spec = {"ts": {'$gt': self.default_checkpoint}, "ns": {"$in": ["foodb.barcol", "foodb.bazcol"]}, "op": {"$in": ["d", "i", "u"]}}
+    self.trigger._oplog.find.assert_called_with(spec, fields=["ts", "op"], tailable=True, await_data=True)
+
+  def test_register_during_tail_requeries(self):
+    op_messages = [{"ts": bson.Timestamp(1000, i), "op": "i", "ns": "foodb.barcol", "o": {}} for i in range(3)]
+    self.cursor.sort.return_value = op_messages
+    self.callback_func.side_effect = lambda **op: self.trigger.register("foodb.bazcol", "i", MagicMock())
+    self.trigger.register("foodb.barcol", "i", self.callback_func)
+
+    new_checkpoint = self.trigger._tail_oplog(self.default_checkpoint)
+
+    self.assertEquals(1, self.callback_func.call_count)
+    self.assertEquals(op_messages[0]["ts"], new_checkpoint)
+
+  def test_idle_cursor_is_kept_open(self):
+    self.cursor.sort.return_value = []
+    self.trigger.register("foodb.barcol", "i", self.callback_func)
+
+    checkpoint = self.trigger._tail_oplog(self.default_checkpoint)
+    self.trigger._tail_oplog(checkpoint)
+
+    self.assertEquals(1, self.trigger._oplog.find.call_count)
+    self.cursor.add_option.assert_called_with(8) # oplog replay
+    self.assertFalse(self.cursor.close.called)
+
+  def test_cursor_reopened_for_new_registrations(self):
+    self.cursor.sort.return_value = []
+    self.trigger.register("foodb.barcol", "i", self.callback_func)
+
+    checkpoint = self.trigger._tail_oplog(self.default_checkpoint)
+    self.trigger.register("foodb.bazcol", "i", self.callback_func)
+    self.trigger._tail_oplog(checkpoint)
+
+    self.assertEquals(2, self.trigger._oplog.find.call_count)
+    self.assertTrue(self.cursor.close.called)
+    self._assert_calls(checkpoint, ["foodb.barcol", "foodb.bazcol"], ["i"])
+
+  def test_checkpoint_written_once_per_window(self):
+    op_messages = [{"ts": bson.Timestamp(1000, i), "op": "i", "ns": "foodb.barcol", "o": {}} for i in range(5)]
+    self.cursor.sort.return_value = op_messages
+    self.trigger.checkpoint_policy = CheckpointPolicy(ops=2, interval_ms=60000)
+
+    self.trigger._tail_oplog(self.default_checkpoint)
+
+    self.assertEquals(2, self.trigger._checkpoint.update.call_count)
+    self.trigger._checkpoint.update.assert_called_with({"_id": "my-source-id"}, {'$set': {'checkpoint': op_messages[3]["ts"]}})
+
+  def test_save_checkpoint_flushes_remaining_ops(self):
+    op_messages = [{"ts": bson.Timestamp(1000, i), "op": "i", "ns": "foodb.barcol", "o": {}} for i in range(3)]
+    self.cursor.sort.return_value = op_messages
+    self.trigger.checkpoint_policy = CheckpointPolicy(ops=2, interval_ms=60000)
+
+    self.trigger._tail_oplog(self.default_checkpoint)
+    self.trigger.save_checkpoint()
+    self.trigger.save_checkpoint()
+
+    self.assertEquals(2, self.trigger._checkpoint.update.call_count)
+    self.trigger._checkpoint.update.assert_called_with({"_id": "my-source-id"}, {'$set': {'checkpoint': op_messages[2]["ts"]}})
+
+  def test_checkpoint_held_back_by_pending_callback(self):
+    op_messages = [{"ts": bson.Timestamp(1000, i), "op": "i", "ns": "foodb.barcol", "o": {}} for i in range(1, 4)]
+    self.cursor.sort.return_value = op_messages
+    self.callback_func.oldest_pending.return_value = op_messages[1]["ts"]
+    self.trigger.register("foodb.barcol", "i", self.callback_func)
+
+    self.trigger._tail_oplog(self.default_checkpoint)
+    self.trigger.save_checkpoint()
+
+    self.trigger._checkpoint.update.assert_called_with({"_id": "my-source-id"}, {'$set': {'checkpoint': op_messages[0]["ts"]}})
+
 class TriggersSetCheckpointTest(TestCase):
 
   def setUp(self):
@@ -0,0 +1,114 @@
+from unittest import TestCase
+from mock import patch
+from mmm.metadata import MMM_METADATA, MMM_TIMESTAMP
+from mmm.testing import FakeMesh
+from mmm.verify import Verifier, apply_repairs
+
+NS = "foodb.barcol"
+
+class VerifyTest(TestCase):
+
+  def setUp(self):
+    self.mesh = FakeMesh(["a", "b"], [NS], {"verify": {"partitions": 2, "fanout": 4, "leaf_size": 10}})
+    self.a = self.mesh.collection("a", NS)
+    self.b = self.mesh.collection("b", NS)
+    for i in range(200):
+      self.a.insert({"_id": i, "x": i})
+    self.mesh.pump()
+    self.engine = self.mesh.engines["a"]
+
+  def _content(self, collection):
+    return sorted((d["_id"], d["x"]) for d in collection.documents)
+
+  def _verifier(self, stored_hashes=False):
+    return Verifier("a", self.mesh.uri("a"), "b", self.mesh.uri("b"), NS, NS, self.mesh.connections, partitions=2,
+      fanout=4, leaf_size=10, stored_hashes=stored_hashes)
+
+  def _diverge(self):
+    # writes b lost or never replicated, they aren't in its oplog
+    with patch.object(self.mesh.server("b").oplog, "log"):
+      self.b.remove({"_id": 3})
+      self.b.update({"_id": 150}, {"_id": 150, "x": -1})
+      self.b.insert({"_id": 1000, "x": 1000})
+
+  def test_identical_namespaces_are_compared_once(self):
+    verifier = self._verifier()
+
+    self.assertEquals([], verifier.run())
+    self.assertEquals(400, verifier.documents_hashed)
+    self.assertEquals(2, verifier.ranges_compared)
+
+  def test_source_documents_written_whole_are_not_hashed(self):
+    self.a.update({"_id": 7}, {"$set": {"y": 1}})
+    self.mesh.pump()
+    verifier = self._verifier(stored_hashes=True)
+
+    self.assertEquals([], verifier.run())
+    # the destination, and the source document whose stored hash is the hash of an update
+    self.assertEquals(201, verifier.documents_hashed)
+
+  def test_stored_hashes_find_the_same_differences(self):
+    self._diverge()
+    with patch.object(self.mesh.server("b").oplog, "log"):
+      self.b.update({"_id": 5}, {"$set": {"x": -5}})
+
+    repairs = self._verifier(stored_hashes=True).run()
+    self.assertEquals([3, 5, 150, 1000], [r["o2" if r["op"] == "u" else "o"]["_id"] for r in repairs])
+
+  def test_copies_diverged_before_the_same_update_differ(self):
+    with patch.object(self.mesh.server("b").oplog, "log"):
+      self.b.update({"_id": 5}, {"$set": {"x": -5}})
+    # both copies then store the hash of this update
+    self.a.update({"_id": 5}, {"$set": {"y": 1}})
+    self.mesh.pump()
+
+    repairs = self._verifier().run()
+    self.assertEquals([5], [repair["o2"]["_id"] for repair in repairs])
+    self.assertEquals(5, repairs[0]["o"]["x"])
+
+  def test_only_differing_ranges_are_searched(self):
+    self._diverge()
+    verifier = self._verifier()
+    repairs = verifier.run()
+
+    self.assertEquals([(3, "u"), (150, "u"), (1000, "d")], [(r["o2" if r["op"] == "u" else "o"]["_id"], r["op"])
+      for r in repairs])
+    self.assertEquals(3, repairs[0]["o"]["x"])
+    self.assertEquals(150, repairs[1]["o"]["x"])
+    # 2 partitions, then 4 ranges per level around each of the 3 differences
+    self.assertTrue(verifier.ranges_compared <= 2 + 3 * 2 * 4)
+
+  def test_repairs_replayed_through_the_replicator_converge(self):
+    self._diverge()
+    results = self.engine.verify(repair=True)
+
+    self.assertEquals([("b", NS)], [(destination, namespace) for destination, namespace, _ in results])
+    self.assertEquals(3, len(results[0][2]))
+    self.assertEquals(self._content(self.a), self._content(self.b))
+    self.assertEquals([], self._verifier().run())
+    # b recognizes the repairs as replicated writes and doesn't send them back
+    self.mesh.pump()
+    self.assertEquals(self._content(self.a), self._content(self.b))
+    self.assertEquals(200, len(self.a.documents))
+
+  def test_apply_repairs_deletes_and_upserts(self):
+    self._diverge()
+    replicator = self.engine._namespaces[NS]["replicators"][0][2][0]
+
+    self.assertEquals(3, apply_repairs(replicator, self._verifier().run()))
+    self.assertEquals(None, self.b.find_one({"_id": 1000}))
+    self.assertEquals(3, self.b.find_one({"_id": 3})["x"])
+
+  def test_repairs_bypass_the_conflict_policy(self):
+    mesh = FakeMesh(["a", "b"], [NS], {"conflicts": {"policy": "lww"}})
+    a, b = mesh.collection("a", NS), mesh.collection("b", NS)
+    a.insert({"_id": 1, "x": 1})
+    mesh.pump()
+    with patch.object(mesh.server("b").oplog, "log"):
+      b.update({"_id": 1}, {"$set": {"x": -1, MMM_METADATA + ".source": "b",
+        MMM_METADATA + "." + MMM_TIMESTAMP: 2 ** 50}})
+
+    (_, _, repairs), = mesh.engines["a"].verify(repair=True)
+    self.assertEquals(1, len(repairs))
+    # the destination copy looks written later, the source wins all the same
+    self.assertEquals(1, b.find_one({"_id": 1})["x"])